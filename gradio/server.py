@@ -1,22 +1,45 @@
 import gradio as gr
 import threading
 import time
-from process import generate
+from process import generate, pipeline
 import os
 import random
 import argparse
 
-def run_generation(genre_prompt, lyrics, num_sequences, num_tokens, seed, num_songs):
+def run_generation(genre_prompt, lyrics, num_sequences, num_tokens, seed, num_songs, preview):
+    # Streams every intermediate result of `generate` to the audio player
     try:
         # Generate a random seed if seed is 0
         if seed == 0:
             seed = random.randint(1, 2**31 - 1)  # Use a wide range of positive integers
             print(f"Generated random seed: {seed}")
         
-        output_path = generate(genre_prompt, lyrics, num_sequences, num_tokens, seed, num_songs)
-        return "Generation complete!", output_path
+        for status, output_path in generate(genre_prompt, lyrics, num_sequences, num_tokens, seed, num_songs, preview=preview):
+            yield status, output_path
     except Exception as e:
-        return f"Error: {str(e)}", None
+        yield f"Error: {str(e)}", None
+
+def run_promotion(take):
+    # Stage 2 and the vocoder for a previewed take, from its saved Stage 1 tokens
+    if not take:
+        yield "Select a previewed take to promote", None
+        return
+    try:
+        for status, output_path in generate("", "", 0, 0, 0, 1, promote_stage1=os.path.join(stage1_dir, take)):
+            yield status, output_path
+    except Exception as e:
+        yield f"Error: {str(e)}", None
+
+def list_takes():
+    # Saved Stage 1 takes (vocal track files), most recent first
+    if not os.path.isdir(stage1_dir):
+        return []
+    takes = [name for name in os.listdir(stage1_dir) if name.endswith('_vtrack.npy')]
+    return sorted(takes, key=lambda name: os.path.getmtime(os.path.join(stage1_dir, name)), reverse=True)
+
+def refresh_takes():
+    takes = list_takes()
+    return gr.update(choices=takes, value=takes[0] if takes else None)
 
 # Load default content from files
 def load_text_file(file_path):
@@ -32,6 +55,8 @@ script_dir = os.path.dirname(os.path.abspath(__file__))
 base_dir = os.path.dirname(script_dir)
 genre_path = os.path.join(base_dir, "prompt_egs", "genre.txt")
 lyrics_path = os.path.join(base_dir, "prompt_egs", "lyrics.txt")
+# process.generate writes its outputs relative to the working directory
+stage1_dir = os.path.join("..", "output", "stage1")
 
 # Get default values from prompt_egs files
 genre_default = load_text_file(genre_path)
@@ -102,8 +127,21 @@ with gr.Blocks() as demo:
                 interactive=False
             )
             
+            preview = gr.Checkbox(
+                value=False,
+                label="Preview only (stop after Stage 1 with a rough codebook-0 mix of each take, no Stage 2 or vocoder)"
+            )
+            
             generate_button = gr.Button("Generate")
             
+            # Previewed takes can be finished with Stage 2 and the vocoder
+            take = gr.Dropdown(
+                choices=list_takes(),
+                label="Stage 1 take to promote (most recent first)"
+            )
+            
+            promote_button = gr.Button("Promote take (Stage 2 + vocoder)")
+            
             # Last Generated Song (audio player)
             audio_output = gr.Audio(
                 label="Last Generated Song", 
@@ -121,7 +159,15 @@ with gr.Blocks() as demo:
     # Event handlers
     generate_button.click(
         fn=run_generation,
-        inputs=[genre_prompt, lyrics, num_sequences, num_tokens, seed, num_songs],
+        inputs=[genre_prompt, lyrics, num_sequences, num_tokens, seed, num_songs, preview],
+        outputs=[status, audio_output]
+    ).then(
+        fn=refresh_takes,
+        outputs=[take]
+    )
+    promote_button.click(
+        fn=run_promotion,
+        inputs=[take],
         outputs=[status, audio_output]
     )
 
@@ -134,8 +180,12 @@ if __name__ == "__main__":
                         help="Port to run the server on (default: Gradio default)")
     parser.add_argument("--host", type=str, default="127.0.0.1", 
                         help="Host to bind to (default: 127.0.0.1)")
+    parser.add_argument("--preload_models", action="store_true",
+                        help="Load every model into the shared model pool before serving instead of on the first request")
     
     args = parser.parse_args()
+    if args.preload_models:
+        pipeline.warm()
     
     # Launch the interface with the specified parameters
     demo.queue().launch(
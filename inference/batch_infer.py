@@ -0,0 +1,189 @@
+import argparse
+import json
+import os
+import time
+import traceback
+import numpy as np
+from pipeline import YuEPipeline, TEMPERATURE, TOP_P, final_path, seed_everything, split_lyrics, take_paths
+
+# Runs every job of a JSONL manifest through one YuEPipeline: Stage 1 for all jobs, then Stage 2 for
+# all of them in one window queue, then the codec and vocoders, each model loaded once for the whole set.
+# One job per line:
+#   {"id": "song-0001", "genre": "pop female vocal ...", "lyrics": "[verse]\n...", "seed": 7}
+# "genre_txt" / "lyrics_txt" (paths) may be given instead of "genre" / "lyrics"; "seed", "run_n_segments",
+# "max_new_tokens" and "repetition_penalty" default to the command line values. Jobs whose final mix
+# already exists are skipped, jobs whose Stage 1 (or Stage 2) outputs exist start from there, and a Stage 1
+# batch or Stage 2 interrupted midway continues from its journal (output_dir/journal, see journal.py).
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--jobs", type=str, required=True, help="JSONL manifest, one job per line.")
+parser.add_argument("--output_dir", type=str, default="./output", help="Directory for the outputs of every job; the file names carry the job id.")
+parser.add_argument("--stage1_batch_size", type=int, default=4, help="Maximum number of jobs (with the same number of segments, max_new_tokens and repetition_penalty) decoded as one Stage 1 batch.")
+# Defaults of the per-job settings
+parser.add_argument("--max_new_tokens", type=int, default=3000, help="The maximum number of new tokens to generate in one pass during text generation.")
+parser.add_argument("--run_n_segments", type=int, default=2, help="The number of segments to process during the generation.")
+parser.add_argument("--repetition_penalty", type=float, default=1.1, help="Repetition penalty of Stage 1, see infer.py.")
+parser.add_argument("--seed", type=int, default=42, help="Seed of jobs without their own.")
+# Pipeline configuration, see infer.py
+parser.add_argument("--stage1_model", type=str, default="m-a-p/YuE-s1-7B-anneal-en-cot", help="The model checkpoint path or identifier for the Stage 1 model.")
+parser.add_argument("--stage2_model", type=str, default="m-a-p/YuE-s2-1B-general", help="The model checkpoint path or identifier for the Stage 2 model.")
+parser.add_argument("--stage2_batch_size", type=int, default=4, help="The batch size used in Stage 2 inference.")
+parser.add_argument("--stage2_cache", type=str, default="persistent", choices=["persistent", "per_frame", "static"], help="Stage 2 decoder, see infer.py.")
+parser.add_argument("--lm_head_slice", type=str, default="none", choices=["none", "allowed", "codec"], help="LM head slicing, see infer.py.")
+parser.add_argument("--invalid_code_repair", type=str, default="mode", choices=["mode", "nearest"], help="How out-of-range Stage 2 codes are replaced, see infer.py.")
+parser.add_argument("--stage1_window", type=str, default="tail", choices=["tail", "head"], help="Stage 1 context window handling, see infer.py ('head' needs --stage1_batch_size 1).")
+parser.add_argument("--cfg_tokens", type=int, default=None, help="Adaptive guidance, see infer.py.")
+parser.add_argument("--cfg_kl_threshold", type=float, default=None, help="Adaptive guidance, see infer.py.")
+parser.add_argument("--cfg_agree_steps", type=int, default=8, help="Consecutive agreeing tokens required by --cfg_kl_threshold.")
+parser.add_argument("--journal_kv", action="store_true", help="Also journal the Stage 1 KV cache after every segment (large), so interrupted batches continue bit for bit instead of rebuilding the cache with one prefill.")
+parser.add_argument("--prefix_cache_dir", type=str, default=None, help="Directory for prefilled Stage 1 instruction headers, shared with infer.py.")
+parser.add_argument("--disable_offload_model", action="store_true", help="Keep every model on the GPU between stages.")
+parser.add_argument("--cuda_idx", type=int, default=0)
+parser.add_argument('--basic_model_config', default='./xcodec_mini_infer/final_ckpt/config.yaml', help='YAML files for xcodec configurations.')
+parser.add_argument('--resume_path', default='./xcodec_mini_infer/final_ckpt/ckpt_00360000.pth', help='Path to the xcodec checkpoint (or its converted .safetensors).')
+parser.add_argument('--config_path', type=str, default='./xcodec_mini_infer/decoders/config.yaml', help='Path to Vocos config file.')
+parser.add_argument('--vocal_decoder_path', type=str, default='./xcodec_mini_infer/decoders/decoder_131000.pth', help='Path to Vocos decoder weights.')
+parser.add_argument('--inst_decoder_path', type=str, default='./xcodec_mini_infer/decoders/decoder_151000.pth', help='Path to Vocos decoder weights.')
+parser.add_argument('-r', '--rescale', action='store_true', help='Rescale output to avoid clipping.')
+args = parser.parse_args()
+if args.stage1_window == "head" and args.stage1_batch_size > 1:
+    parser.error("--stage1_window head needs --stage1_batch_size 1")
+
+
+def read_text(job, key):
+    if key in job:
+        return job[key]
+    with open(job[f"{key}_txt"]) as f:
+        return f.read()
+
+
+jobs = []
+with open(args.jobs) as f:
+    for line_number, line in enumerate(f, 1):
+        if not line.strip():
+            continue
+        job = json.loads(line)
+        job.setdefault("id", f"job{line_number:05d}")
+        if "genre" not in job and "genre_txt" not in job or "lyrics" not in job and "lyrics_txt" not in job:
+            raise ValueError(f"{args.jobs}:{line_number}: a job needs 'genre' (or 'genre_txt') and 'lyrics' (or 'lyrics_txt')")
+        job["genre"] = read_text(job, "genre").strip()
+        job["lyrics"] = read_text(job, "lyrics")
+        for key in ("seed", "run_n_segments", "max_new_tokens", "repetition_penalty"):
+            job.setdefault(key, getattr(args, key))
+        # the job id stands in for the random id in the file names, so reruns find earlier outputs
+        job["take"] = take_paths(os.path.join(args.output_dir, "stage1"), job["genre"], TOP_P, TEMPERATURE,
+                                 job["repetition_penalty"], job["max_new_tokens"], job["id"])
+        job["output"] = final_path(args.output_dir, job["take"])
+        jobs.append(job)
+if len({job["id"] for job in jobs}) != len(jobs):
+    raise ValueError(f"{args.jobs}: job ids must be unique")
+
+pipeline = YuEPipeline(
+    stage1_model=args.stage1_model,
+    stage2_model=args.stage2_model,
+    cuda_idx=args.cuda_idx,
+    basic_model_config=args.basic_model_config,
+    resume_path=args.resume_path,
+    config_path=args.config_path,
+    vocal_decoder_path=args.vocal_decoder_path,
+    inst_decoder_path=args.inst_decoder_path,
+    lm_head_slice=args.lm_head_slice,
+    stage2_cache=args.stage2_cache,
+    stage2_batch_size=args.stage2_batch_size,
+    invalid_code_repair=args.invalid_code_repair,
+    prefix_cache_dir=args.prefix_cache_dir,
+    offload=not args.disable_offload_model,
+    # every model is done with once its stage has run over the whole set
+    reuse_models=False,
+    journal_dir=os.path.join(args.output_dir, "journal"),
+    journal_kv=args.journal_kv,
+)
+seed_everything(args.seed)
+os.makedirs(args.output_dir, exist_ok=True)
+start = time.perf_counter()
+stage_seconds = {"stage1": 0.0, "stage2": 0.0, "decode": 0.0}
+results = {}
+for job in jobs:
+    if os.path.exists(job["output"]):
+        results[job["id"]] = {"status": "skipped", "output": job["output"]}
+todo = [job for job in jobs if job["id"] not in results]
+print(f"{len(jobs)} jobs, {len(jobs) - len(todo)} already done")
+
+# Jobs with the same number of segments and sampling settings are decoded as rows of one Stage 1 batch
+# (each from its own seed and prompt, left-padded to the longest); within a group jobs are batched by
+# header length, so rows of a batch need little padding. Batches run longest first (most segments, then
+# longest header), so memory problems show up at the start
+groups = {}
+for job in todo:
+    if not all(os.path.exists(path) for path in job["take"]):
+        job["segments"] = min(job["run_n_segments"], len(split_lyrics(job["lyrics"])) - 1)
+        job["prompt_length"] = pipeline.prompt_length(job["genre"], job["lyrics"])
+        groups.setdefault((job["segments"], job["max_new_tokens"], job["repetition_penalty"]), []).append(job)
+batches = []
+for group in groups.values():
+    group.sort(key=lambda job: job["prompt_length"], reverse=True)
+    batches += [group[i:i + args.stage1_batch_size] for i in range(0, len(group), args.stage1_batch_size)]
+batches.sort(key=lambda batch: (batch[0]["segments"], batch[0]["prompt_length"]), reverse=True)
+
+stage_start = time.perf_counter()
+for n, batch in enumerate(batches):
+    head = batch[0]
+    print(f"Stage 1 batch {n + 1}/{len(batches)}: {len(batch)} jobs, {head['segments']} segments, "
+          f"{batch[-1]['prompt_length']}-{head['prompt_length']} prompt tokens")
+    try:
+        for _ in pipeline.stage1([job["genre"] for job in batch], [job["lyrics"] for job in batch], args.output_dir, max_new_tokens=head["max_new_tokens"],
+                                 run_n_segments=head["segments"], repetition_penalty=head["repetition_penalty"],
+                                 stage1_window=args.stage1_window, cfg_tokens=args.cfg_tokens,
+                                 cfg_kl_threshold=args.cfg_kl_threshold, cfg_agree_steps=args.cfg_agree_steps,
+                                 seeds=[job["seed"] for job in batch], take_ids=[job["id"] for job in batch], resume=True):
+            pass
+    except Exception as e:
+        # one bad batch (e.g. lyrics without [section] tags) should not stop the rest of the set
+        print(f"Stage 1 failed for {[job['id'] for job in batch]}: {e!r}")
+        traceback.print_exc()
+        for job in batch:
+            results[job["id"]] = {"status": "failed", "error": repr(e)}
+stage_seconds["stage1"] = time.perf_counter() - stage_start
+if batches:
+    pipeline.release("stage1", upcoming=["stage2", "vocoder"])
+
+todo = [job for job in todo if job["id"] not in results]
+if todo:
+    # all windows of all jobs go through one Stage 2 queue
+    stage_start = time.perf_counter()
+    print(f"Stage 2 for {len(todo)} jobs...")
+    stage2_takes = pipeline.stage2([job["take"] for job in todo], os.path.join(args.output_dir, "stage2"), resume=True)
+    stage_seconds["stage2"] = time.perf_counter() - stage_start
+
+    stage_start = time.perf_counter()
+    for status, path in pipeline.decode(stage2_takes, args.output_dir, args.rescale):
+        print(f"{status}: {path}")
+    stage_seconds["decode"] = time.perf_counter() - stage_start
+    for job, stage2_take in zip(todo, stage2_takes):
+        # Stage 2 codes run at 50 frames per second
+        results[job["id"]] = {"status": "done", "output": job["output"], "audio_seconds": np.load(stage2_take[0], mmap_mode="r").shape[-1] / 50}
+
+total_seconds = time.perf_counter() - start
+done = [result for result in results.values() if result["status"] == "done"]
+audio_seconds = sum(result["audio_seconds"] for result in done)
+summary = {
+    "jobs": len(jobs),
+    "done": len(done),
+    "skipped": sum(result["status"] == "skipped" for result in results.values()),
+    "failed": sum(result["status"] == "failed" for result in results.values()),
+    "stage1_batches": len(batches),
+    "seconds": total_seconds,
+    "stage_seconds": stage_seconds,
+    "audio_seconds": audio_seconds,
+    "songs_per_hour": 3600 * len(done) / max(total_seconds, 1e-9),
+    "audio_seconds_per_second": audio_seconds / max(total_seconds, 1e-9),
+}
+with open(os.path.join(args.output_dir, "batch_results.jsonl"), "w") as f:
+    for job in jobs:
+        f.write(json.dumps({"id": job["id"], **results[job["id"]]}) + "\n")
+with open(os.path.join(args.output_dir, "batch_summary.json"), "w") as f:
+    json.dump(summary, f, indent=2)
+pipeline.log_models()
+print(f"{summary['done']} songs generated, {summary['skipped']} skipped, {summary['failed']} failed in {total_seconds:.1f} s "
+      f"(Stage 1 {stage_seconds['stage1']:.1f} s, Stage 2 {stage_seconds['stage2']:.1f} s, decode {stage_seconds['decode']:.1f} s): "
+      f"{summary['songs_per_hour']:.1f} songs/hour, {summary['audio_seconds_per_second']:.2f} s of audio per second")
@@ -0,0 +1,253 @@
+import argparse
+import copy
+import time
+from collections import Counter
+import numpy as np
+import torch
+from transformers import (
+    LlamaConfig,
+    LlamaForCausalLM,
+    LogitsProcessor,
+    LogitsProcessorList,
+    MinNewTokensLengthLogitsProcessor,
+    RepetitionPenaltyLogitsProcessor,
+    TopKLogitsWarper,
+    TopPLogitsWarper,
+)
+from codec_repair import fix_invalid_codes
+from logits_processors import BlockTokenRangeProcessor, FusedSamplingProcessor, IncrementalRepetitionPenaltyProcessor
+from speculative import NGramDrafter
+from stage1 import Stage1Engine
+from stage2 import StaticTeacherForcing, teacher_forcing
+
+
+def timeit(fn, steps, device):
+    # warm up, then time `steps` calls
+    for _ in range(3):
+        fn()
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    start = time.perf_counter()
+    for _ in range(steps):
+        fn()
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    return (time.perf_counter() - start) / steps * 1000
+
+
+class LegacyBlockTokenRangeProcessor(LogitsProcessor):
+    # the list-indexing processor Stage 1 used before logits_processors.py
+    def __init__(self, start_id, end_id):
+        self.blocked_token_ids = list(range(start_id, end_id))
+
+    def __call__(self, input_ids, scores):
+        scores[:, self.blocked_token_ids] = -float("inf")
+        return scores
+
+
+def bench_sampling(args, device):
+    vocab_size, eoa = 83734, 32002
+    torch.manual_seed(0)
+    logits = torch.randn(1, vocab_size, device=device)
+    input_ids = torch.randint(45334, 46358, (1, args.context), device=device)
+    prompt_length = args.context - 200
+    chain = LogitsProcessorList([
+        RepetitionPenaltyLogitsProcessor(penalty=1.1),
+        MinNewTokensLengthLogitsProcessor(prompt_length, 100, eoa),
+        LegacyBlockTokenRangeProcessor(0, 32002),
+        LegacyBlockTokenRangeProcessor(32016, 32016),
+        TopKLogitsWarper(50),
+        TopPLogitsWarper(0.93),
+    ])
+    fused = FusedSamplingProcessor(blocked_ranges=[(0, 32002)], repetition_penalty=1.1, top_k=50, top_p=0.93, eos_token_id=eoa)
+    fused.begin_segment(prompt_length, 100)
+    # equivalence with the chain is checked in tests/test_logits_processors.py
+
+    chain_ms = timeit(lambda: chain(input_ids, logits.clone()), args.steps, device)
+    fused_ms = timeit(lambda: fused(input_ids, logits.clone()), args.steps, device)
+    print(f"sampling chain ({device}, context={args.context}): {chain_ms:.3f} ms/step")
+    print(f"fused processor ({device}, context={args.context}): {fused_ms:.3f} ms/step ({chain_ms / fused_ms:.1f}x)")
+
+
+def bench_repetition(args, device):
+    vocab_size = 83734
+    torch.manual_seed(0)
+    history = torch.randint(45334, 46358, (1, args.context + args.steps + 6), device=device)
+    logits = torch.randn(1, vocab_size, device=device)
+    stock = RepetitionPenaltyLogitsProcessor(penalty=1.1)
+    # <EOA> and the codebook-0 codes, what Stage 1 tracks
+    incremental = IncrementalRepetitionPenaltyProcessor(1.1, token_ranges=[(32002, 32003), (45334, 46358)])
+    incremental(history[:, :args.context], logits.clone())
+    for length in range(args.context + 1, args.context + 4):
+        assert torch.equal(stock(history[:, :length], logits.clone()), incremental(history[:, :length], logits.clone()))
+    print(f"gather/scatter width: {incremental.max_distinct} for {len(history[0, :args.context + 3].unique())} distinct ids")
+
+    step = {"stock": args.context, "incremental": args.context + 3}
+    def run(name, processor):
+        # one new token per call, like a decoding step
+        step[name] += 1
+        processor(history[:, :step[name]], logits.clone())
+    stock_ms = timeit(lambda: run("stock", stock), args.steps, device)
+    incremental_ms = timeit(lambda: run("incremental", incremental), args.steps, device)
+    print(f"RepetitionPenaltyLogitsProcessor ({device}, context={args.context}): {stock_ms:.3f} ms/step")
+    print(f"IncrementalRepetitionPenaltyProcessor ({device}, context={args.context}): {incremental_ms:.3f} ms/step ({stock_ms / incremental_ms:.1f}x)")
+
+
+def bench_stage2(args, device):
+    # a small random-weight Llama with the YuE vocabulary, so this runs anywhere
+    vocab_size = 83734
+    torch.manual_seed(0)
+    config = LlamaConfig(vocab_size=vocab_size, hidden_size=128, intermediate_size=256, num_hidden_layers=2,
+                         num_attention_heads=4, num_key_value_heads=2, max_position_embeddings=4096)
+    model = LlamaForCausalLM(config).to(device).eval()
+    codec_ids = torch.randint(45334, 46358, (args.batch_size, args.frames), device=device)
+    prompt_ids = torch.cat([
+        torch.tensor([[32001, 32013]], device=device).expand(args.batch_size, -1),
+        codec_ids,
+        torch.tensor([[32017]], device=device).expand(args.batch_size, -1),
+    ], dim=1)
+    blocked_ranges = [(0, 46358), (53526, vocab_size)]
+    block_list = LogitsProcessorList([BlockTokenRangeProcessor(start, end) for start, end in blocked_ranges])
+    steps = args.frames * 8
+
+    start = time.perf_counter()
+    reference = teacher_forcing(model, prompt_ids, codec_ids, logits_processor=block_list)
+    dynamic_ms = (time.perf_counter() - start) / steps * 1000
+    static = StaticTeacherForcing(model, max_cache_len=prompt_ids.shape[1] + steps, blocked_ranges=blocked_ranges,
+                                  compile=args.compile)
+    for call in range(2):
+        output = static(prompt_ids, codec_ids)
+        print(f"static call {call}: {static.last_step_ms:.3f} ms/step, tokens match: {torch.equal(output, reference)}")
+    print(f"DynamicCache ({device}, batch={args.batch_size}, frames={args.frames}): {dynamic_ms:.3f} ms/step")
+    print(f"StaticTeacherForcing ({device}, compile={args.compile}): {static.last_step_ms:.3f} ms/step ({dynamic_ms / static.last_step_ms:.1f}x)")
+
+
+class RecordingSampler(object):
+    # passes through to the engine's sampler, keeping the guided scores it is called with
+    def __init__(self, sampler):
+        self.sampler = sampler
+        self.scores = []
+
+    def __getattr__(self, name):
+        return getattr(self.sampler, name)
+
+    def __call__(self, input_ids, scores):
+        self.scores.append(scores.clone())
+        return self.sampler(input_ids, scores)
+
+
+def bench_cfg(args, device):
+    # separate vs fused unconditional branch on a small random-weight Llama (sdpa attention)
+    vocab_size = 83734
+    torch.manual_seed(0)
+    config = LlamaConfig(vocab_size=vocab_size, hidden_size=128, intermediate_size=256, num_hidden_layers=2,
+                         num_attention_heads=4, num_key_value_heads=2, max_position_embeddings=16384,
+                         attn_implementation="sdpa")
+    model = LlamaForCausalLM(config).to(device).eval()
+    prompt_ids = torch.randint(45334, 46358, (1, args.context), device=device)
+    blocked_ranges = [(0, 32002), (46358, vocab_size)]
+
+    results = {}
+    for cfg in ("separate", "fused"):
+        torch.manual_seed(0)
+        engine = Stage1Engine(model, eos_token_id=32002, blocked_ranges=blocked_ranges, device=device, cfg=cfg)
+        engine.sampler = RecordingSampler(engine.sampler)
+        if device.type == "cuda":
+            torch.cuda.synchronize(device)
+        start = time.perf_counter()
+        engine.generate_segment(prompt_ids, max_new_tokens=args.steps, min_new_tokens=args.steps, guidance_scale=1.5)
+        if device.type == "cuda":
+            torch.cuda.synchronize(device)
+        results[cfg] = (engine, (time.perf_counter() - start) / args.steps * 1000)
+
+    (separate, separate_ms), (fused, fused_ms) = results["separate"], results["fused"]
+    diff = max(float((a - b).abs().masked_fill(torch.isinf(a), 0).max())
+               for a, b in zip(separate.sampler.scores, fused.sampler.scores))
+    print(f"guided scores max abs diff: {diff:.2e}, tokens match: {torch.equal(separate.raw_output, fused.raw_output)}")
+    print(f"separate unconditional stream ({device}, context={args.context}): {separate_ms:.3f} ms/token")
+    print(f"fused unconditional branch: {fused_ms:.3f} ms/token ({separate_ms / fused_ms:.2f}x)")
+    report = fused.cfg_memory_report()
+    print(f"KV for guidance: {report['guided_bytes'] / 2**20:.1f} MiB vs doubled batch "
+          f"{report['doubled_batch_bytes'] / 2**20:.1f} MiB, saved {report['saved_bytes'] / 2**20:.1f} MiB")
+
+
+def bench_spec(args, device):
+    # n-gram speculative decoding on a small random-weight Llama; without a repetition penalty its greedy
+    # output falls into loops, the kind of repetition the drafter is meant to pick up
+    vocab_size = 83734
+    torch.manual_seed(0)
+    config = LlamaConfig(vocab_size=vocab_size, hidden_size=128, intermediate_size=256, num_hidden_layers=2,
+                         num_attention_heads=4, num_key_value_heads=2, max_position_embeddings=16384)
+    model = LlamaForCausalLM(config).to(device).eval()
+    prompt_ids = torch.cat([torch.arange(45334, 45400).repeat(3), torch.tensor([32001, 32016])]).unsqueeze(0).to(device)
+
+    for name, top_k, temperature in (("greedy", 1, 1.0), ("sampled", 50, 0.5)):
+        outputs = []
+        for drafter in (None, NGramDrafter(num_draft=args.num_draft)):
+            torch.manual_seed(0)
+            engine = Stage1Engine(model, eos_token_id=32002, blocked_ranges=[(0, 32002)], top_k=top_k,
+                                  temperature=temperature, repetition_penalty=1.0, device=device, drafter=drafter)
+            start = time.perf_counter()
+            engine.generate_segment(prompt_ids, max_new_tokens=args.steps, min_new_tokens=args.steps, guidance_scale=1.5)
+            if device.type == "cuda":
+                torch.cuda.synchronize(device)
+            elapsed = time.perf_counter() - start
+            stats = engine.spec_stats[-1]
+            outputs.append(engine.raw_output)
+            label = "plain" if drafter is None else f"n-gram draft {args.num_draft}"
+            accepted = f", accepted {stats['accepted']}/{stats['drafted']} drafts" if drafter is not None else ""
+            print(f"{name} {label}: {stats['tokens'] / elapsed:.1f} tokens/s, "
+                  f"{stats['tokens'] / stats['forwards']:.2f} tokens/forward{accepted}")
+        if name == "greedy":
+            print(f"greedy tokens match: {torch.equal(outputs[0], outputs[1])}")
+
+
+def legacy_fix_invalid_codes(output):
+    # the nested-loop repair stage2_inference used before codec_repair.py
+    fixed_output = copy.deepcopy(output)
+    for i, line in enumerate(output):
+        for j, element in enumerate(line):
+            if element < 0 or element > 1023:
+                counter = Counter(line)
+                most_frequant = sorted(counter.items(), key=lambda x: x[1], reverse=True)[0][0]
+                fixed_output[i, j] = most_frequant
+    return fixed_output
+
+
+def bench_repair(args, device):
+    # a (8, T) Stage 2 output, 50 frames per second, with a fraction of out-of-range codes
+    rng = np.random.RandomState(0)
+    num_frames = int(args.seconds * 50)
+    # uint32 like CodecManipulator.ids2npy, so an id below its codebook's offset wraps to ~4.29e9
+    codes = rng.randint(0, 1024, (8, num_frames)).astype(np.uint32)
+    invalid = rng.rand(8, num_frames) < args.invalid_ratio
+    codes[invalid] = rng.randint(1024, 2048, invalid.sum())
+    wrapped = invalid & (rng.rand(8, num_frames) < 0.5)
+    codes[wrapped] = (-rng.randint(1, 1024, wrapped.sum())).astype(np.uint32)
+    assert np.array_equal(legacy_fix_invalid_codes(codes), fix_invalid_codes(codes))
+
+    cpu = torch.device("cpu")
+    legacy_ms = timeit(lambda: legacy_fix_invalid_codes(codes), args.steps, cpu)
+    mode_ms = timeit(lambda: fix_invalid_codes(codes), args.steps, cpu)
+    nearest_ms = timeit(lambda: fix_invalid_codes(codes, strategy="nearest"), args.steps, cpu)
+    print(f"nested-loop repair ({args.seconds:.0f}s, {invalid.sum()} invalid codes, {wrapped.sum()} wrapped): {legacy_ms:.3f} ms")
+    print(f"fix_invalid_codes mode: {mode_ms:.3f} ms ({legacy_ms / mode_ms:.1f}x)")
+    print(f"fix_invalid_codes nearest: {nearest_ms:.3f} ms ({legacy_ms / nearest_ms:.1f}x)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Microbenchmarks for YuE inference components.")
+    parser.add_argument("bench", choices=["sampling", "repetition", "stage2", "repair", "cfg", "spec"], help="Which component to benchmark.")
+    parser.add_argument("--steps", type=int, default=200, help="Timed iterations per variant (generated tokens for cfg / spec).")
+    parser.add_argument("--context", type=int, default=8000, help="Token history length seen by the repetition penalty / Stage 1 prompt length for cfg.")
+    parser.add_argument("--frames", type=int, default=50, help="Stage 2 frames per window.")
+    parser.add_argument("--batch_size", type=int, default=4, help="Stage 2 batch size.")
+    parser.add_argument("--compile", action="store_true", help="torch.compile the static Stage 2 step.")
+    parser.add_argument("--seconds", type=float, default=180, help="Song length for the invalid-code repair.")
+    parser.add_argument("--invalid_ratio", type=float, default=0.001, help="Fraction of out-of-range codes for the repair.")
+    parser.add_argument("--num_draft", type=int, default=8, help="Drafted tokens per speculative step.")
+    parser.add_argument("--cuda_idx", type=int, default=0)
+    args = parser.parse_args()
+    device = torch.device(f"cuda:{args.cuda_idx}" if torch.cuda.is_available() else "cpu")
+    {"sampling": bench_sampling, "repetition": bench_repetition, "stage2": bench_stage2, "repair": bench_repair,
+     "cfg": bench_cfg, "spec": bench_spec}[args.bench](args, device)
@@ -0,0 +1,79 @@
+import argparse
+import os
+import pickle
+import torch
+from safetensors.torch import load_file, save_file
+
+
+def safetensors_path(resume_path):
+    """
+    Where the converted weights of an xcodec `.pth` checkpoint live: next to it, as `.safetensors`.
+    """
+    return os.path.splitext(resume_path)[0] + ".safetensors"
+
+
+def load_pth_state_dict(resume_path):
+    """
+    The `codec_model` weights of a training checkpoint. Tries the tensors-only unpickler first and
+    only unpickles arbitrary objects when the checkpoint holds some.
+    """
+    try:
+        parameter_dict = torch.load(resume_path, map_location='cpu', weights_only=True)
+    except pickle.UnpicklingError:
+        parameter_dict = torch.load(resume_path, map_location='cpu', weights_only=False)
+    return parameter_dict['codec_model']
+
+
+def convert_checkpoint(resume_path, output_path=None):
+    """
+    Writes the `codec_model` weights of `resume_path` to a memory-mappable safetensors file (by default
+    next to it) and returns its path. Only needed once per checkpoint.
+    """
+    output_path = output_path or safetensors_path(resume_path)
+    state_dict = load_pth_state_dict(resume_path)
+    # safetensors stores every tensor on its own, shared storages are written as copies
+    save_file({name: tensor.detach().clone().contiguous() for name, tensor in state_dict.items()}, output_path)
+    return output_path
+
+
+def _has_meta_tensors(module):
+    return any(tensor.is_meta for tensor in list(module.parameters()) + list(module.buffers()))
+
+
+def load_codec_model(generator_cls, generator_config, resume_path, device):
+    """
+    The xcodec generator (e.g. `SoundStream`) with the weights of `resume_path`, in eval mode on `device`.
+
+    With a converted `.safetensors` file next to the checkpoint (or `resume_path` being one), the model
+    is built on the meta device and the memory-mapped weights are loaded straight onto `device` and
+    assigned in place, so neither a random initialization nor a full host copy of the checkpoint is
+    made, and nothing is unpickled. Models whose constructor computes buffers that are not in the
+    state dict are built normally instead. Without a safetensors file the `.pth` checkpoint is loaded.
+    """
+    path = resume_path if resume_path.endswith(".safetensors") else safetensors_path(resume_path)
+    if not os.path.exists(path):
+        codec_model = generator_cls(**generator_config).to(device)
+        codec_model.load_state_dict(load_pth_state_dict(resume_path))
+        codec_model.to(device)
+        return codec_model.eval()
+
+    state_dict = load_file(path, device=str(device))
+    try:
+        with torch.device("meta"):
+            codec_model = generator_cls(**generator_config)
+        codec_model.load_state_dict(state_dict, assign=True)
+    except (RuntimeError, NotImplementedError):
+        # e.g. a constructor that loads or computes tensors itself
+        codec_model = None
+    if codec_model is None or _has_meta_tensors(codec_model):
+        codec_model = generator_cls(**generator_config).to(device)
+        codec_model.load_state_dict(state_dict)
+    return codec_model.eval()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Extract the codec weights of an xcodec training checkpoint into a safetensors file.")
+    parser.add_argument('--resume_path', default='./xcodec_mini_infer/final_ckpt/ckpt_00360000.pth', help='Path to the xcodec checkpoint.')
+    parser.add_argument('--output', default=None, help='Output path (default: the checkpoint path with a .safetensors extension, where infer.py looks for it).')
+    args = parser.parse_args()
+    print(f"Wrote {convert_checkpoint(args.resume_path, args.output)}")
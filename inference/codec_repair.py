@@ -0,0 +1,45 @@
+import numpy as np
+
+
+def _row_mode(line):
+    # most frequent value of the row; ties go to the value that occurs first, like Counter + stable sort.
+    # np.unique rather than np.bincount: ids2npy returns uint32, so a code below its codebook's offset
+    # wraps to ~4.29e9 and a bincount over the value range would need tens of GiB
+    _, inverse, counts = np.unique(line, return_inverse=True, return_counts=True)
+    inverse = inverse.reshape(-1)
+    return line[np.argmax(counts[inverse] == counts.max())]
+
+
+def _nearest_valid(line, invalid):
+    # value of the closest valid element in time, the earlier one on ties
+    positions = np.arange(len(line))
+    previous = np.maximum.accumulate(np.where(invalid, -1, positions))
+    following = np.minimum.accumulate(np.where(invalid, len(line), positions)[::-1])[::-1]
+    use_previous = (previous >= 0) & ((following >= len(line)) | (positions - previous <= following - positions))
+    return line[np.where(use_previous, previous, following)]
+
+
+def fix_invalid_codes(codes, strategy="mode", codebook_size=1024):
+    """
+    Replace out-of-range codes of a (num_codebooks, T) array, one codebook row at a time.
+
+    strategy:
+        "mode": the most frequent value of the row (invalid ones included, ties to the first seen),
+            the same result as the original per-element `Counter` loop
+        "nearest": the nearest valid code of the same row in time; rows without any valid code fall
+            back to "mode"
+
+    Returns a fixed copy; `codes` is left untouched.
+    """
+    if strategy not in ("mode", "nearest"):
+        raise ValueError(f"unknown invalid code repair strategy: {strategy}")
+    codes = np.asarray(codes)
+    fixed = codes.copy()
+    invalid = (codes < 0) | (codes >= codebook_size)
+    for row in np.flatnonzero(invalid.any(axis=-1)):
+        line, mask = codes[row], invalid[row]
+        if strategy == "nearest" and not mask.all():
+            fixed[row, mask] = _nearest_valid(line, mask)[mask]
+        else:
+            fixed[row, mask] = _row_mode(line)
+    return fixed
@@ -0,0 +1,159 @@
+import glob
+import hashlib
+import json
+import os
+import shutil
+import numpy as np
+import torch
+
+
+def rng_state(device, generators=None):
+    """
+    The RNG states Stage 1 sampling draws from: the `generators` of its rows (and of a draft model),
+    and torch's global CPU (and CUDA) generator for anything left on it.
+    """
+    state = {"cpu": torch.get_rng_state(), "generators": [generator.get_state() for generator in generators or []]}
+    if device.type == "cuda":
+        state["cuda"] = torch.cuda.get_rng_state(device)
+    return state
+
+
+def set_rng_state(state, device, generators=None):
+    torch.set_rng_state(state["cpu"])
+    if "cuda" in state:
+        torch.cuda.set_rng_state(state["cuda"], device)
+    for generator, generator_state in zip(generators or [], state["generators"]):
+        generator.set_state(generator_state)
+
+
+def codes_digest(codes):
+    """
+    Short hash of an array of codes, e.g. to tell whether a Stage 2 journal belongs to the same Stage 1 take.
+    """
+    return hashlib.sha1(np.ascontiguousarray(codes).tobytes()).hexdigest()
+
+
+def _normalize(params):
+    # what the parameters look like once read back from meta.json
+    return json.loads(json.dumps(params, sort_keys=True, default=str))
+
+
+def _atomic_write(path, write, mode="wb"):
+    # a crash while writing leaves the previous file intact
+    with open(path + ".tmp", mode) as f:
+        write(f)
+    os.replace(path + ".tmp", path)
+
+
+def _read_meta(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+class Stage1Journal(object):
+    r"""
+    Checkpoint journal of one Stage 1 run (one take, or the rows of one batch) in `directory`, so a run
+    that crashes or runs out of memory late in a song continues from its last completed segment.
+
+    `meta.json` holds the parameters the run was started with (prompt, seeds, sampling and model
+    settings) and its take files; `stage1.pt` the `Stage1Engine.state_dict()` and the RNG states after
+    the last completed segment, replaced after every segment. A resumed run restores both and samples
+    exactly what the uninterrupted run would have (with the saved KV cache bit for bit; when the cache
+    is rebuilt by a prefill, up to the floating-point differences between a prefill and token-by-token
+    decoding).
+
+    Once the takes are saved, `finish_stage1` drops the engine state and keeps `meta.json`, so a rerun
+    finds the saved takes instead of starting over, until `close` removes the journal after Stage 2.
+    """
+    def __init__(self, directory, params=None, takes=None):
+        self.directory = directory
+        self.meta_path = os.path.join(directory, "meta.json")
+        self.state_path = os.path.join(directory, "stage1.pt")
+        self.meta = _read_meta(self.meta_path) or {"params": _normalize(params), "takes": takes, "stage1_done": False}
+
+    @classmethod
+    def find(cls, root, params):
+        """
+        The most recently updated journal under `root` started with `params`, or None.
+        """
+        params = _normalize(params)
+        journals = []
+        for meta_path in glob.glob(os.path.join(root, "*", "meta.json")):
+            meta = _read_meta(meta_path)
+            if meta is not None and meta.get("params") == params:
+                journals.append((os.path.getmtime(meta_path), os.path.dirname(meta_path)))
+        return cls(max(journals)[1]) if journals else None
+
+    @property
+    def takes(self):
+        return [tuple(take) for take in self.meta["takes"]]
+
+    @property
+    def stage1_done(self):
+        return self.meta["stage1_done"]
+
+    def _write_meta(self):
+        os.makedirs(self.directory, exist_ok=True)
+        _atomic_write(self.meta_path, lambda f: json.dump(self.meta, f, indent=2), mode="w")
+
+    def save_segment(self, segment, engine_state, rng):
+        """
+        Records the state after `segment` (the index of the lyric segment just completed).
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        _atomic_write(self.state_path, lambda f: torch.save({"segment": segment, "engine": engine_state, "rng": rng}, f))
+        self.meta["segment"] = segment
+        self._write_meta()
+
+    def load_segment(self):
+        """
+        {"segment", "engine", "rng"} of the last completed segment, or None.
+        """
+        if not os.path.exists(self.state_path):
+            return None
+        return torch.load(self.state_path, map_location="cpu", weights_only=True)
+
+    def finish_stage1(self):
+        self.meta["stage1_done"] = True
+        self._write_meta()
+        if os.path.exists(self.state_path):
+            os.remove(self.state_path)
+
+    def close(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+class Stage2Journal(object):
+    r"""
+    The Stage 2 windows of one track decoded so far, one `<start frame>.npy` per window in `directory`,
+    written after every batch so an interrupted Stage 2 only decodes the missing windows. `params` (the
+    Stage 2 settings and a digest of the track's codebook-0 input) are kept in `meta.json`; windows
+    written with other parameters are discarded.
+    """
+    def __init__(self, directory, params):
+        self.directory = directory
+        self.params = _normalize(params)
+        meta = _read_meta(os.path.join(directory, "meta.json"))
+        if meta is not None and meta.get("params") != self.params:
+            self.close()
+
+    def windows(self):
+        """
+        {start frame: decoded ids} of the windows already decoded.
+        """
+        windows = {}
+        for path in glob.glob(os.path.join(self.directory, "*.npy")):
+            windows[int(os.path.splitext(os.path.basename(path))[0])] = np.load(path)
+        return windows
+
+    def save(self, start, ids):
+        if not os.path.exists(os.path.join(self.directory, "meta.json")):
+            os.makedirs(self.directory, exist_ok=True)
+            _atomic_write(os.path.join(self.directory, "meta.json"), lambda f: json.dump({"params": self.params}, f), mode="w")
+        _atomic_write(os.path.join(self.directory, f"{start}.npy"), lambda f: np.save(f, ids))
+
+    def close(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
@@ -0,0 +1,122 @@
+import inspect
+import torch
+from transformers import DynamicCache
+
+
+def cache_layers(cache):
+    """
+    Return [(keys, values), ...] of a transformers `DynamicCache`, each (B, H, T, D).
+    Supports both the `cache.layers` layout and the older `key_cache` / `value_cache` lists.
+    """
+    if hasattr(cache, "layers"):
+        return [(layer.keys, layer.values) for layer in cache.layers]
+    return list(zip(cache.key_cache, cache.value_cache))
+
+
+def set_cache_layer(cache, idx, keys, values):
+    if hasattr(cache, "layers"):
+        cache.layers[idx].keys = keys
+        cache.layers[idx].values = values
+    else:
+        cache.key_cache[idx] = keys
+        cache.value_cache[idx] = values
+
+
+def logits_to_keep_kwargs(model):
+    """
+    Forward kwargs that restrict the LM head to the last position; only that one is sampled from,
+    so a prefill does not need logits for every prompt token.
+    """
+    params = inspect.signature(getattr(model, "_orig_mod", model).forward).parameters
+    for name in ("logits_to_keep", "num_logits_to_keep"):
+        if name in params:
+            return {name: 1}
+    return {}
+
+
+def find_rotary_emb(model):
+    """
+    Locate the rotary embedding module of a (possibly `torch.compile`d) Llama-style model.
+    """
+    model = getattr(model, "_orig_mod", model)
+    for owner in (getattr(model, "model", None), model):
+        if owner is not None and hasattr(owner, "rotary_emb"):
+            return owner.rotary_emb
+    raise ValueError(f"{type(model).__name__} has no rotary_emb, cannot shift cached key positions")
+
+
+def _rotate_half(x):
+    x1 = x[..., : x.shape[-1] // 2]
+    x2 = x[..., x.shape[-1] // 2 :]
+    return torch.cat((-x2, x1), dim=-1)
+
+
+def shift_key_positions(keys, shift, inv_freq):
+    """
+    Re-rotate RoPE keys (B, H, T, D) as if they had been computed `shift` positions later
+    (negative `shift` moves them back). RoPE rotations compose additively, so R(p + s) = R(s) R(p).
+    """
+    freqs = shift * inv_freq.to(device=keys.device, dtype=torch.float32)
+    emb = torch.cat((freqs, freqs), dim=-1)
+    cos = emb.cos().to(keys.dtype)
+    sin = emb.sin().to(keys.dtype)
+    return keys * cos + _rotate_half(keys) * sin
+
+
+def evict_span(cache, start, end, inv_freq=None):
+    """
+    Drop cached positions [start, end) from every layer. Keys after the span are re-rotated by
+    -(end - start) when `inv_freq` is given, so the cache stays position-contiguous and new tokens
+    (whose positions derive from the cache length) line up with the kept ones.
+    """
+    span = end - start
+    if span <= 0:
+        return cache
+    for idx, (keys, values) in enumerate(cache_layers(cache)):
+        tail_keys = keys[:, :, end:]
+        if inv_freq is not None and tail_keys.shape[-2] > 0:
+            tail_keys = shift_key_positions(tail_keys, -span, inv_freq)
+        keys = torch.cat([keys[:, :, :start], tail_keys], dim=-2)
+        values = torch.cat([values[:, :, :start], values[:, :, end:]], dim=-2)
+        set_cache_layer(cache, idx, keys, values)
+    return cache
+
+
+def cache_from_layers(layers, batch_size=1, device=None):
+    """
+    Build a `DynamicCache` from [(keys, values), ...] of batch 1 (e.g. a stored prefix), repeated to
+    `batch_size` rows and moved to `device`.
+    """
+    cache = DynamicCache()
+    for idx, (keys, values) in enumerate(layers):
+        keys = keys.to(device, non_blocking=True).repeat(batch_size, 1, 1, 1)
+        values = values.to(device, non_blocking=True).repeat(batch_size, 1, 1, 1)
+        cache.update(keys, values, idx)
+    return cache
+
+
+def select_positions(cache, index):
+    """
+    Keep only cached positions `index` (a 1-D LongTensor) in every layer. Unlike `evict_span` keys are
+    not re-rotated: this is for caches whose tokens were fed with explicit position ids.
+    """
+    for idx, (keys, values) in enumerate(cache_layers(cache)):
+        layer_index = index.to(keys.device)
+        set_cache_layer(cache, idx, keys.index_select(-2, layer_index), values.index_select(-2, layer_index))
+    return cache
+
+
+def kv_bytes_per_token(cache):
+    """
+    Bytes one token takes in the cache, summed over layers, keys and values (per batch row).
+    """
+    return sum(t.shape[1] * t.shape[-1] * t.element_size() for layer in cache_layers(cache) for t in layer)
+
+
+def crop_cache(cache, length):
+    """
+    Drop every cached position from `length` on (e.g. rejected speculative tokens).
+    """
+    for idx, (keys, values) in enumerate(cache_layers(cache)):
+        set_cache_layer(cache, idx, keys[..., :length, :], values[..., :length, :])
+    return cache
@@ -0,0 +1,253 @@
+import torch
+from transformers import LogitsProcessor
+
+
+def block_mask(blocked_ranges, vocab_size, device):
+    mask = torch.zeros(vocab_size, dtype=torch.bool, device=device)
+    for start_id, end_id in blocked_ranges:
+        mask[start_id:end_id] = True
+    return mask
+
+
+class BlockTokenRangeProcessor(LogitsProcessor):
+    r"""
+    Sets the scores of ids in [start_id, end_id) to -inf.
+
+    The boolean mask is built once per (device, vocab size) and applied with a single in-place
+    `masked_fill_`, instead of fancy-indexing with a Python list of ids on every decoding step.
+    """
+    def __init__(self, start_id, end_id):
+        self.start_id = start_id
+        self.end_id = end_id
+        self._masks = {}
+
+    def mask(self, scores):
+        key = (scores.device, scores.shape[-1])
+        if key not in self._masks:
+            self._masks[key] = block_mask([(self.start_id, self.end_id)], scores.shape[-1], scores.device)
+        return self._masks[key]
+
+    def __call__(self, input_ids, scores):
+        return scores.masked_fill_(self.mask(scores), -float("inf"))
+
+
+class IncrementalRepetitionPenaltyProcessor(LogitsProcessor):
+    r"""
+    Repetition penalty with incremental state, equivalent to `RepetitionPenaltyLogitsProcessor`.
+
+    The stock processor gathers/scatters over the whole `input_ids` every step, so its cost grows with
+    the song length. Here each row keeps
+        - a presence bitmap over the tracked ids (with `window`: per-id counts over the last `window` tokens)
+        - the list of distinct ids seen so far (with `window`, also those that left it, which the
+          presence check skips), and a bitmap of the ids on that list
+    both updated with only the ids appended since the previous call, and the penalty gathers/scatters
+    over the distinct ids, which for Stage 1 is bounded by the ~1k codebook-0 codes rather than the context.
+
+    token_ranges: [(start, end)] history ids that can be penalized, `end=None` meaning the vocabulary
+        size; None tracks every id. Other ids are ignored, so leaving out ids that are blocked (or never
+        sampled) anyway changes nothing, and the bitmap is only as wide as the tracked ids.
+    token_map: optional (vocab_size,) tensor mapping history ids into the scores' id space
+        (e.g. `VocabSlice.full_to_compact`); ids it maps to the last (sink) column are not tracked.
+
+    Call `reset` whenever the history is replaced rather than appended to.
+    """
+    def __init__(self, penalty, window=None, token_ranges=None, token_map=None):
+        self.penalty = penalty
+        self.window = window if window else None
+        self.token_ranges = token_ranges
+        self.token_map = token_map
+        self._tables = {}
+        self.reset()
+
+    def reset(self):
+        self.state = None
+        self.seen = 0
+
+    def _table(self, scores):
+        """
+        (history id -> tracked index, `size` for untracked ids; tracked index -> score column), built
+        once per device and scores width.
+        """
+        key = (scores.device, scores.shape[-1])
+        if key not in self._tables:
+            vocab_size = len(self.token_map) if self.token_map is not None else scores.shape[-1]
+            tracked = torch.zeros(vocab_size, dtype=torch.bool)
+            for start, end in self.token_ranges if self.token_ranges is not None else [(0, None)]:
+                tracked[start:end] = True
+            if self.token_map is not None:
+                # ids outside the slice all land in its -inf sink column, the last one
+                tracked &= self.token_map.cpu() < scores.shape[-1] - 1
+            tracked_ids = tracked.nonzero().squeeze(-1)
+            to_index = torch.full((vocab_size,), len(tracked_ids), dtype=torch.long)
+            to_index[tracked_ids] = torch.arange(len(tracked_ids))
+            columns = self.token_map.cpu()[tracked_ids] if self.token_map is not None else tracked_ids
+            self._tables[key] = (to_index.to(scores.device), columns.to(scores.device))
+        return self._tables[key]
+
+    def _init_state(self, batch_size, size, device):
+        dtype = torch.bool if self.window is None else torch.int32
+        # the extra last column collects untracked ids and is never read
+        self.state = torch.zeros((batch_size, size + 1), dtype=dtype, device=device)
+        # ids on the distinct list; without a window that is exactly the presence bitmap, with one an id
+        # stays listed after it left the window, so it is not listed twice when it comes back
+        self.listed = self.state if self.window is None else torch.zeros((batch_size, size + 1), dtype=torch.bool, device=device)
+        self.distinct = torch.full((batch_size, size), size, dtype=torch.long, device=device)
+        self.num_distinct = torch.zeros((batch_size, 1), dtype=torch.long, device=device)
+        self.max_distinct = 0
+        self.seen = 0
+
+    def _add(self, ids, size):
+        if ids.shape[-1] == 1:
+            # the common decoding step: one new id per row, appended to the distinct list if unseen
+            is_new = ~self.listed.gather(1, ids) & (ids < size)
+            slot = self.num_distinct.clamp(max=size - 1)
+            self.distinct.scatter_(1, slot, torch.where(is_new, ids, self.distinct.gather(1, slot)))
+            self.num_distinct += is_new.long()
+            # each row gains at most one id per step, so the widest row only grows when some row did
+            if bool(is_new.any()):
+                self.max_distinct = min(self.max_distinct + 1, size)
+        if self.window is None:
+            self.state.scatter_(1, ids, True)
+        else:
+            self.state.scatter_add_(1, ids, torch.ones_like(ids, dtype=self.state.dtype))
+            self.listed.scatter_(1, ids, True)
+        if ids.shape[-1] > 1:
+            # bulk update (prompt prefill): rebuild the distinct list from the bitmap
+            present = self.listed[:, :size]
+            positions = torch.arange(size, device=ids.device).expand_as(present)
+            self.distinct = torch.where(present, positions, size).sort(dim=1).values
+            self.num_distinct = present.sum(dim=1, keepdim=True)
+            self.max_distinct = int(self.num_distinct.max().item())
+
+    def __call__(self, input_ids, scores):
+        to_index, columns = self._table(scores)
+        size = len(columns)
+        if size == 0:
+            return scores
+        length = input_ids.shape[-1]
+        if self.state is None or self.state.shape[0] != input_ids.shape[0] or length < self.seen:
+            self._init_state(input_ids.shape[0], size, scores.device)
+        if length > self.seen:
+            self._add(to_index[input_ids[:, self.seen:]], size)
+        if self.window is not None:
+            leaving = input_ids[:, max(self.seen - self.window, 0):max(length - self.window, 0)]
+            if leaving.shape[-1] > 0:
+                leaving = to_index[leaving]
+                self.state.scatter_add_(1, leaving, torch.full_like(leaving, -1, dtype=self.state.dtype))
+        self.seen = length
+        if self.max_distinct == 0:
+            return scores
+
+        # padding entries point at the last tracked id; they rewrite its own (correct) value
+        ids = self.distinct[:, :self.max_distinct].clamp(max=size - 1)
+        present = self.state.gather(1, ids) > 0
+        ids = columns[ids]
+        score = scores.gather(1, ids)
+        penalized = torch.where(score < 0, score * self.penalty, score / self.penalty)
+        scores.scatter_(1, ids, torch.where(present, penalized, score))
+        return scores
+
+
+class FusedSamplingProcessor(LogitsProcessor):
+    r"""
+    One processor for the whole Stage 1 sampling chain, equivalent to
+        RepetitionPenaltyLogitsProcessor -> MinNewTokensLengthLogitsProcessor
+        -> BlockTokenRangeProcessor(s) -> TemperatureLogitsWarper -> TopKLogitsWarper -> TopPLogitsWarper
+
+    - the repetition penalty is an `IncrementalRepetitionPenaltyProcessor`, so it only looks at the
+      ids appended since the previous step (optionally over a look-back `repetition_window`)
+    - all blocked ranges (and <EOA> while fewer than `min_new_tokens` were generated) are folded into
+      one cached on-device mask, applied in place
+    - top-p runs on the `top_k` candidates only, rather than sorting the full ~83k vocabulary
+      (top-k first is what `generate` does anyway, so the kept set is the same); only when the top-p
+      cut falls between equal scores is the full sort done, since it decides which of them are kept
+
+    repetition_ranges: [(start, end)] history ids the repetition penalty tracks (see
+    `IncrementalRepetitionPenaltyProcessor`); by default every id after a blocked prefix.
+
+    Call `begin_segment` before each segment so the min-new-tokens rule knows where it starts, and
+    `reset_history` whenever the token history is replaced (e.g. after a context window slide).
+    """
+    def __init__(self, blocked_ranges=(), repetition_penalty=1.0, temperature=1.0, top_k=0, top_p=1.0,
+                 eos_token_id=None, min_tokens_to_keep=1, repetition_window=None, repetition_ranges=None, token_map=None):
+        self.blocked_ranges = list(blocked_ranges)
+        self.repetition_penalty = None
+        if repetition_penalty != 1.0:
+            if repetition_ranges is None:
+                # ids in a blocked prefix end up at -inf whatever their penalty, so they are not tracked
+                repetition_ranges = [(max([end for begin, end in self.blocked_ranges if begin == 0], default=0), None)]
+            self.repetition_penalty = IncrementalRepetitionPenaltyProcessor(
+                repetition_penalty, window=repetition_window, token_ranges=repetition_ranges, token_map=token_map)
+        self.temperature = temperature
+        self.top_k = top_k
+        self.top_p = top_p
+        self.eos_token_id = eos_token_id
+        self.min_tokens_to_keep = min_tokens_to_keep
+        self.prompt_length = 0
+        self.min_new_tokens = 0
+        self._masks = {}
+
+    def begin_segment(self, prompt_length, min_new_tokens):
+        self.prompt_length = prompt_length
+        self.min_new_tokens = min_new_tokens
+
+    def reset_history(self):
+        if self.repetition_penalty is not None:
+            self.repetition_penalty.reset()
+
+    def _mask(self, scores, block_eos):
+        key = (scores.device, scores.shape[-1], block_eos)
+        if key not in self._masks:
+            mask = block_mask(self.blocked_ranges, scores.shape[-1], scores.device)
+            if block_eos:
+                mask[self.eos_token_id] = True
+            self._masks[key] = mask
+        return self._masks[key]
+
+    def _top_p_mask(self, ascending):
+        # TopPLogitsWarper's rule on scores sorted ascending
+        cumulative_probs = ascending.softmax(dim=-1).cumsum(dim=-1)
+        to_remove = cumulative_probs <= (1 - self.top_p)
+        to_remove[..., -self.min_tokens_to_keep:] = False
+        return to_remove
+
+    def _top_k_top_p(self, scores):
+        vocab_size = scores.shape[-1]
+        top_k = min(max(self.top_k, self.min_tokens_to_keep), vocab_size) if self.top_k else vocab_size
+        values, indices = torch.topk(scores, top_k, dim=-1)
+        if top_k < vocab_size:
+            # TopKLogitsWarper keeps every id tied with the k-th score, so the candidates are widened to
+            # the ids of the row with the most ties; ids below a row's own k-th score are dropped again
+            threshold = values[..., -1:]
+            num_kept = int((scores >= threshold).sum(dim=-1).max())
+            if num_kept > top_k:
+                values, indices = torch.topk(scores, num_kept, dim=-1)
+                values = values.masked_fill(values < threshold, -float("inf"))
+        if self.top_p < 1.0:
+            # same rule as TopPLogitsWarper, on the ascending candidates
+            values, indices = values.flip(-1), indices.flip(-1)
+            to_remove = self._top_p_mask(values)
+            # the removed ids are a prefix; when the cut splits ids with equal scores, which of them go
+            # depends on the order TopPLogitsWarper's (unstable) sort of the whole vocabulary leaves them
+            # in, so that sort is done instead
+            num_removed = to_remove.sum(dim=-1, keepdim=True)
+            last_removed = values.gather(-1, (num_removed - 1).clamp(min=0))
+            first_kept = values.gather(-1, num_removed.clamp(max=values.shape[-1] - 1))
+            if bool(((num_removed > 0) & (last_removed == first_kept) & first_kept.isfinite()).any()):
+                scores = torch.full_like(scores, -float("inf")).scatter_(-1, indices, values)
+                ascending, order = torch.sort(scores, descending=False)
+                to_remove = self._top_p_mask(ascending)
+                return scores.masked_fill(to_remove.scatter(-1, order, to_remove), -float("inf"))
+            values = values.masked_fill(to_remove, -float("inf"))
+        return torch.full_like(scores, -float("inf")).scatter_(-1, indices, values)
+
+    def __call__(self, input_ids, scores):
+        if self.repetition_penalty is not None:
+            scores = self.repetition_penalty(input_ids, scores)
+        block_eos = self.eos_token_id is not None and input_ids.shape[-1] - self.prompt_length < self.min_new_tokens
+        scores.masked_fill_(self._mask(scores, block_eos), -float("inf"))
+        if self.temperature != 1.0:
+            scores.div_(self.temperature)
+        if self.top_k or self.top_p < 1.0:
+            scores = self._top_k_top_p(scores)
+        return scores
@@ -0,0 +1,136 @@
+import itertools
+import threading
+import time
+import torch
+
+
+def _modules(obj):
+    if isinstance(obj, torch.nn.Module):
+        return [obj]
+    if isinstance(obj, (tuple, list)):
+        return [module for item in obj for module in _modules(item)]
+    return []
+
+
+def module_bytes(obj):
+    """
+    Bytes of the parameters and buffers of every module of `obj`.
+    """
+    return sum(tensor.numel() * tensor.element_size()
+               for module in _modules(obj) for tensor in itertools.chain(module.parameters(), module.buffers()))
+
+
+def move_to_host(obj, pin_memory=False):
+    """
+    Moves every module of `obj` (a module, or a tuple/list of them) to the CPU, with its parameters and
+    buffers in page-locked memory if `pin_memory`, so moving it back is a plain asynchronous copy.
+    """
+    for module in _modules(obj):
+        module.to("cpu")
+        if pin_memory:
+            for tensor in itertools.chain(module.parameters(), module.buffers()):
+                tensor.data = tensor.data.pin_memory()
+    return obj
+
+
+def move_to_device(obj, device):
+    for module in _modules(obj):
+        module.to(device, non_blocking=True)
+    return obj
+
+
+class ModelPool(object):
+    r"""
+    Long-lived owner of the models of a server process, shared by all its requests.
+
+    Every model is registered with a loader that builds it ready to use on `device` (e.g. loaded and
+    `torch.compile`d). `get` loads it on first use only; later requests get the same object back, with
+    its compiled graphs, instead of loading it again. A model is on the device, offloaded to (pinned)
+    host memory with `offload`, or not loaded ("disk", after `evict`); `get` brings an offloaded model
+    back with a host-to-device copy.
+
+    `report` gives per-model load counts and times and an estimate of the load time saved: every `get`
+    that did not load is counted at the model's average load time, minus the time spent restoring it
+    from the host. Compile warm-up happening in the first forwards is saved as well but not counted.
+    """
+    def __init__(self, device, pin_memory=None):
+        self.device = device
+        self.pin_memory = device.type == "cuda" if pin_memory is None else pin_memory
+        self.loaders = {}
+        self.models = {}
+        self.residency = {}
+        self.stats = {}
+        self.locks = {}
+
+    def register(self, name, loader):
+        """
+        loader: callable without arguments returning the model (a module, a tuple of modules, or any
+        other object such as a tokenizer, which is kept as it is) on `device`.
+        """
+        self.loaders[name] = loader
+        self.residency[name] = "disk"
+        self.stats[name] = {"loads": 0, "load_seconds": 0.0, "hits": 0, "restores": 0, "restore_seconds": 0.0, "bytes": 0}
+        self.locks[name] = threading.RLock()
+
+    def get(self, name):
+        with self.locks[name]:
+            stats = self.stats[name]
+            if self.residency[name] == "disk":
+                start = time.perf_counter()
+                self.models[name] = self.loaders[name]()
+                stats["loads"] += 1
+                stats["load_seconds"] += time.perf_counter() - start
+                stats["bytes"] = module_bytes(self.models[name])
+                self.residency[name] = "device"
+                return self.models[name]
+            self.restore(name)
+            stats["hits"] += 1
+            return self.models[name]
+
+    def restore(self, name):
+        """
+        Moves an offloaded model back to the device; `get` does this as needed.
+        """
+        with self.locks[name]:
+            if self.residency[name] != "host":
+                return
+            stats = self.stats[name]
+            start = time.perf_counter()
+            move_to_device(self.models[name], self.device)
+            if self.device.type == "cuda":
+                # only waits for the copies (issued on the caller's stream, e.g. a prefetch stream)
+                torch.cuda.current_stream(self.device).synchronize()
+            stats["restores"] += 1
+            stats["restore_seconds"] += time.perf_counter() - start
+            self.residency[name] = "device"
+
+    def warm(self, names=None):
+        """
+        Loads the given (default: all) models up front, e.g. at server start.
+        """
+        for name in names if names is not None else list(self.loaders):
+            self.get(name)
+
+    def offload(self, name):
+        with self.locks[name]:
+            if self.residency[name] != "device" or not _modules(self.models[name]):
+                return
+            move_to_host(self.models[name], self.pin_memory)
+            self.residency[name] = "host"
+            if self.device.type == "cuda":
+                torch.cuda.empty_cache()
+
+    def evict(self, name):
+        with self.locks[name]:
+            self.models.pop(name, None)
+            self.residency[name] = "disk"
+            if self.device.type == "cuda":
+                torch.cuda.empty_cache()
+
+    def report(self):
+        report = {}
+        for name, stats in self.stats.items():
+            load_seconds = stats["load_seconds"] / max(stats["loads"], 1)
+            report[name] = dict(stats, residency=self.residency[name],
+                                saved_seconds=stats["hits"] * load_seconds - stats["restore_seconds"])
+        return report
@@ -0,0 +1,909 @@
+import glob
+import os
+import sys
+import random
+import re
+import time
+import uuid
+from argparse import Namespace
+
+INFERENCE_DIR = os.path.dirname(os.path.abspath(__file__))
+XCODEC_DIR = os.path.join(INFERENCE_DIR, 'xcodec_mini_infer')
+sys.path.append(XCODEC_DIR)
+sys.path.append(os.path.join(XCODEC_DIR, 'descriptaudiocodec'))
+
+# Heavy dependencies (torch, transformers, torchaudio, omegaconf, xcodec) are imported where they are
+# first needed, so importing this module, building a YuEPipeline and parsing CLI arguments stay cheap.
+
+
+def seed_everything(seed=42):
+    import numpy as np
+    import torch
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+    torch.cuda.manual_seed_all(seed)
+    torch.backends.cudnn.deterministic = True
+    torch.backends.cudnn.benchmark = False
+
+
+def split_lyrics(lyrics):
+    pattern = r"\[(\w+)\](.*?)(?=\[|\Z)"
+    segments = re.findall(pattern, lyrics, re.DOTALL)
+    structured_lyrics = [f"[{seg[0]}]\n{seg[1].strip()}\n\n" for seg in segments]
+    return structured_lyrics
+
+
+def load_audio_mono(filepath, sampling_rate=16000):
+    import torch
+    import torchaudio
+    from torchaudio.transforms import Resample
+    audio, sr = torchaudio.load(filepath)
+    # Convert to mono
+    audio = torch.mean(audio, dim=0, keepdim=True)
+    # Resample if needed
+    if sr != sampling_rate:
+        resampler = Resample(orig_freq=sr, new_freq=sampling_rate)
+        audio = resampler(audio)
+    return audio
+
+
+def encode_audio(codec_model, audio_prompt, device, target_bw=0.5):
+    import numpy as np
+    import torch
+    if len(audio_prompt.shape) < 3:
+        audio_prompt.unsqueeze_(0)
+    with torch.no_grad():
+        raw_codes = codec_model.encode(audio_prompt.to(device), target_bw=target_bw)
+    raw_codes = raw_codes.transpose(0, 1)
+    raw_codes = raw_codes.cpu().numpy().astype(np.int16)
+    return raw_codes
+
+
+# convert audio tokens to audio
+def save_audio(wav, path, sample_rate: int, rescale: bool = False):
+    import torchaudio
+    folder_path = os.path.dirname(path)
+    if not os.path.exists(folder_path):
+        os.makedirs(folder_path)
+    limit = 0.99
+    max_val = wav.abs().max()
+    wav = wav * min(limit / max_val, 1) if rescale else wav.clamp(-limit, limit)
+    torchaudio.save(str(path), wav, sample_rate=sample_rate, encoding='PCM_S', bits_per_sample=16)
+
+
+# Suggested Stage 1 decoding config, also part of the take file names
+TOP_P = 0.93
+TEMPERATURE = 1.0
+
+
+def take_paths(stage1_output_dir, genres, top_p, temperature, repetition_penalty, max_new_tokens, random_id):
+    """
+    The (vocal, instrumental) Stage 1 `.npy` paths of one take.
+    """
+    prefix = f"{genres.replace(' ', '-')}_tp{top_p}_T{temperature}_rp{repetition_penalty}_maxtk{max_new_tokens}_{random_id}"
+    return tuple(os.path.join(stage1_output_dir, f"{prefix}_{track}".replace('.', '@')+'.npy') for track in ('vtrack', 'itrack'))
+
+
+def final_path(output_dir, take):
+    """
+    Where `decode` writes the final mix of a (vocal, instrumental) take.
+    """
+    return os.path.join(output_dir, os.path.splitext(os.path.basename(take[1]))[0].replace('_itrack', '_mixed') + ".mp3")
+
+
+def saved_take(path):
+    """
+    The (vocal, instrumental) Stage 1 `.npy` pair a saved `_vtrack.npy` or `_itrack.npy` belongs to.
+    """
+    vocal_path = path.replace('_itrack', '_vtrack')
+    inst_path = vocal_path.replace('_vtrack', '_itrack')
+    for track_path in (vocal_path, inst_path):
+        if not os.path.exists(track_path):
+            raise FileNotFoundError(f"Stage 1 output {track_path} not found, a take is promoted from its saved _vtrack.npy or _itrack.npy file.")
+    return vocal_path, inst_path
+
+
+class YuEPipeline(object):
+    r"""
+    YuE generation as a library: Stage 1 (lyrics to codebook-0 tokens), Stage 2 (the other seven
+    codebooks), xcodec reconstruction and the Vocos vocoder, behind one object that a process keeps
+    for as many generations as it likes. `infer.py` and the Gradio server are thin front-ends over it.
+
+    Nothing is imported or loaded when the pipeline is built. Every model is loaded on first use into a
+    `ModelPool` (model_pool.py) and kept for later runs; after each stage a `ResidencyManager`
+    (residency.py) keeps it on the device, offloads it to pinned host memory or evicts it, depending on
+    free memory (`offload=False` keeps everything resident, `reuse_models=False` never offloads to the
+    host, for one-shot runs). Stage 2 and vocoder weights are read in the background while Stage 1 runs
+    (prefetch.py).
+
+    The constructor takes what is fixed per loaded model (checkpoints, attention implementation, LM
+    head slicing, Stage 2 decoder); `run` takes everything that may change from one song to the next.
+    Batch sizes bound memory: Stage 1 decodes at most `stage1_batch_size` takes together, Stage 2 at
+    most `stage2_batch_size` windows, and the codec and vocoder decode one track at a time.
+
+    With a `journal_dir` every Stage 1 run checkpoints itself after each segment and Stage 2 after each
+    batch (journal.py; `journal_kv` also saves the Stage 1 KV cache), and runs with `resume=True`
+    continue from the journal left by an interrupted run with the same parameters.
+    """
+    def __init__(self, stage1_model="m-a-p/YuE-s1-7B-anneal-en-cot", stage2_model="m-a-p/YuE-s2-1B-general",
+                 cuda_idx=0, tokenizer_path=os.path.join(INFERENCE_DIR, 'mm_tokenizer_v0.2_hf', 'tokenizer.model'),
+                 basic_model_config=os.path.join(XCODEC_DIR, 'final_ckpt', 'config.yaml'),
+                 resume_path=os.path.join(XCODEC_DIR, 'final_ckpt', 'ckpt_00360000.pth'),
+                 config_path=os.path.join(XCODEC_DIR, 'decoders', 'config.yaml'),
+                 vocal_decoder_path=os.path.join(XCODEC_DIR, 'decoders', 'decoder_131000.pth'),
+                 inst_decoder_path=os.path.join(XCODEC_DIR, 'decoders', 'decoder_151000.pth'),
+                 stage1_cfg="separate", lm_head_slice="none", stage2_cache="persistent", stage2_batch_size=4,
+                 stage1_batch_size=4, invalid_code_repair="mode", draft_model=None, prefix_cache=False, prefix_cache_dir=None,
+                 offload=True, reuse_models=True, journal_dir=None, journal_kv=False):
+        # also handed to the vocoder's process_audio, which reads cuda_idx from it
+        self.options = Namespace(
+            stage1_model=stage1_model, stage2_model=stage2_model, cuda_idx=cuda_idx, tokenizer_path=tokenizer_path,
+            basic_model_config=basic_model_config, resume_path=resume_path, config_path=config_path,
+            vocal_decoder_path=vocal_decoder_path, inst_decoder_path=inst_decoder_path, stage1_cfg=stage1_cfg,
+            lm_head_slice=lm_head_slice, stage2_cache=stage2_cache, stage2_batch_size=stage2_batch_size,
+            stage1_batch_size=stage1_batch_size, invalid_code_repair=invalid_code_repair, draft_model=draft_model, prefix_cache=prefix_cache,
+            prefix_cache_dir=prefix_cache_dir, offload=offload, reuse_models=reuse_models, journal_dir=journal_dir,
+            journal_kv=journal_kv,
+        )
+        self.device = None
+        self.pool = None
+        self.residency = None
+        self.weight_prefetch = None
+        self.prefix_cache = None
+        self.stage2_static = None
+        # Stage 1 journals by take, closed once Stage 2 of all their takes is saved
+        self.stage1_journals = {}
+        # (vocal, instrumental) Stage 1 files and final mixes (or previews) of the latest run
+        self.takes = []
+        self.outputs = []
+
+    def _setup(self):
+        if self.pool is not None:
+            return
+        import torch
+        from model_pool import ModelPool
+        from prefetch import BackgroundLoader
+        from prefix_cache import PrefixCache
+        from residency import ResidencyManager
+        from codecmanipulator import CodecManipulator
+        options = self.options
+        self.device = torch.device(f"cuda:{options.cuda_idx}" if torch.cuda.is_available() else "cpu")
+        self.codectool = CodecManipulator("xcodec", 0, 1)
+        self.codectool_stage2 = CodecManipulator("xcodec", 0, 8)
+        # LM and vocoder weights are read into (pinned) host memory, on background threads while earlier stages run
+        self.weight_prefetch = BackgroundLoader(pin_memory=self.device.type == "cuda")
+        self.weight_prefetch.register("stage1", lambda: self._load_lm_weights(
+            options.stage1_model,
+            # To enable flashattn, you have to install flash-attn; the fused CFG branch needs a 4D attention mask
+            "sdpa" if options.stage1_cfg == "fused" else "flash_attention_2",
+        ))
+        self.weight_prefetch.register("stage2", lambda: self._load_lm_weights(options.stage2_model))
+        self.weight_prefetch.register("vocoder", self._load_vocoders)
+        self.pool = ModelPool(self.device)
+        self.pool.register("tokenizer", self._load_tokenizer)
+        self.pool.register("stage1", lambda: self._load_lm("stage1"))
+        self.pool.register("codec", self._load_codec)
+        self.pool.register("stage2", lambda: self._load_lm("stage2"))
+        self.pool.register("vocoder", lambda: self._load_prefetched("vocoder"))
+        if options.draft_model:
+            self.pool.register("draft", self._load_draft_model)
+        # Whether a model stays on the GPU, goes to pinned host memory or is evicted after its stage depends on
+        # the memory that is free at that point; the LM sizes are estimated from their configs until loaded
+        self.residency = ResidencyManager(self.device, self.pool)
+        self.residency.expect("stage1", lambda: self._estimate_lm_bytes(options.stage1_model))
+        self.residency.expect("stage2", lambda: self._estimate_lm_bytes(options.stage2_model))
+        if options.prefix_cache or options.prefix_cache_dir:
+            # Prefilled Stage 1 headers, shared by every run of this pipeline
+            self.prefix_cache = PrefixCache(f"{options.stage1_model}:bfloat16", spill_dir=options.prefix_cache_dir)
+
+    def _load_tokenizer(self):
+        from mmtokenizer import _MMSentencePieceTokenizer
+        return _MMSentencePieceTokenizer(self.options.tokenizer_path)
+
+    def _load_lm_weights(self, model_path, attn_implementation="flash_attention_2"):
+        import torch
+        from transformers import AutoModelForCausalLM
+        return AutoModelForCausalLM.from_pretrained(
+            model_path,
+            torch_dtype=torch.bfloat16,
+            attn_implementation=attn_implementation,
+            # device_map="auto",
+            )
+
+    def _estimate_lm_bytes(self, model_path):
+        from transformers import AutoConfig
+        from residency import estimate_lm_bytes
+        return estimate_lm_bytes(AutoConfig.from_pretrained(model_path))
+
+    def _load_prefetched(self, name):
+        model = self.weight_prefetch.get(name, self.device)
+        self.weight_prefetch.log(name, name)
+        return model
+
+    def _load_lm(self, name):
+        import torch
+        model = self._load_prefetched(name)
+        model.eval()
+
+        if torch.__version__ >= "2.0.0":
+            model = torch.compile(model)
+        return model
+
+    def _load_draft_model(self):
+        model = self._load_lm_weights(self.options.draft_model)
+        model.to(self.device)
+        model.eval()
+        return model
+
+    def _load_codec(self):
+        from omegaconf import OmegaConf
+        from codec_checkpoint import load_codec_model
+        from models.soundstream_hubert_new import SoundStream
+        model_config = OmegaConf.load(self.options.basic_model_config)
+        # loads the converted .safetensors next to the checkpoint if there is one (see codec_checkpoint.py)
+        return load_codec_model(eval(model_config.generator.name), model_config.generator.config, self.options.resume_path, self.device)
+
+    def _load_vocoders(self):
+        from vocoder import build_codec_model
+        vocal_decoder, inst_decoder = build_codec_model(self.options.config_path, self.options.vocal_decoder_path, self.options.inst_decoder_path)
+        return vocal_decoder, inst_decoder
+
+    def prompt_length(self, genres, lyrics):
+        """
+        Number of tokens of the Stage 1 instruction header of a genres/lyrics prompt.
+        """
+        self._setup()
+        full_lyrics = "\n".join(split_lyrics(lyrics))
+        return len(self.pool.get("tokenizer").tokenize(f"Generate music from the given lyrics segment by segment.\n[Genre] {genres}\n{full_lyrics}"))
+
+    def warm(self):
+        """
+        Loads every model up front, e.g. before a server starts taking requests.
+        """
+        self._setup()
+        self.pool.warm()
+
+    def log_models(self):
+        if self.pool is None:
+            return
+        for name, stats in self.pool.report().items():
+            print(f"Model pool {name}: {stats['residency']}, loaded {stats['loads']}x in {stats['load_seconds']:.1f} s, "
+                  f"reused {stats['hits']}x, ~{stats['saved_seconds']:.1f} s of loading saved")
+
+    def release(self, name, upcoming):
+        """
+        Keeps, offloads or evicts a model whose stage is done, depending on the memory the models of the
+        `upcoming` stages still need.
+        """
+        if not self.options.offload:
+            return
+        decision = self.residency.release(name, upcoming=upcoming, reuse=self.options.reuse_models)
+        print(f"{name} model: {decision}")
+        if name == "stage2" and decision != "keep":
+            # the static decoder's cache and graphs belong to the weights on the device
+            self.stage2_static = None
+
+    def run(self, genres, lyrics, output_dir="./output", num_songs=1, seed=42, preview=False, promote_stage1=None,
+            rescale=False, resume=False, **stage1_options):
+        r"""
+        Generates songs and yields (status, audio file) as results come in: with `segment_previews` a
+        rough codebook-0 preview after every Stage 1 segment, the Stage 2 reconstruction of each song,
+        then ("Generation complete!", final mix) once all songs are done.
+
+        genres: one genres prompt, or a list of them (each gets `num_songs` takes, decoded in Stage 1
+            batches of at most `stage1_batch_size`, take `n` seeded with `seed + n`)
+        lyrics: the lyrics text, `[section]` headed
+        preview: stop after Stage 1 and yield a codebook-0 preview of every take instead; the saved
+            Stage 1 tokens (`self.takes`) can be promoted later
+        promote_stage1: a saved Stage 1 `_vtrack.npy` / `_itrack.npy`; skips Stage 1 and runs Stage 2
+            and the vocoder on that take
+        resume: continue from the journals (see `journal_dir`) of an interrupted run with the same parameters
+        stage1_options: see `stage1`
+        """
+        self._setup()
+        seed_everything(seed)
+        stage1_output_dir = os.path.join(output_dir, "stage1")
+        stage2_output_dir = os.path.join(output_dir, "stage2")
+        os.makedirs(stage1_output_dir, exist_ok=True)
+        os.makedirs(stage2_output_dir, exist_ok=True)
+
+        if promote_stage1:
+            # Stage 2 and the vocoder for a take saved by an earlier (e.g. preview) run, Stage 1 is not loaded
+            self.takes = [saved_take(promote_stage1)]
+            # the vocoder loads while Stage 2 runs
+            if self.pool.residency["vocoder"] == "disk":
+                self.weight_prefetch.start("vocoder")
+        else:
+            self.takes = []
+            batch_size = self.options.stage1_batch_size
+            for prompt in [genres] if isinstance(genres, str) else genres:
+                for first in range(0, num_songs, batch_size):
+                    seeds = [seed + n for n in range(first, min(first + batch_size, num_songs))]
+                    takes = yield from self.stage1(prompt, lyrics, output_dir, seed=seed, seeds=seeds,
+                                                   prefetch_next=not preview, resume=resume, **stage1_options)
+                    self.takes.extend(takes)
+            self.release("stage1", upcoming=[] if preview else ["stage2", "vocoder"])
+            if preview:
+                # a preview run is done after Stage 1, its saved takes are promoted rather than resumed
+                for journal in set(self.stage1_journals.pop(take) for take in self.takes if take in self.stage1_journals):
+                    journal.close()
+                self.outputs = yield from self.preview(self.takes, output_dir)
+                self.log_models()
+                return
+
+        print("Stage 2 inference...")
+        stage2_takes = self.stage2(self.takes, stage2_output_dir, resume=resume)
+        print(stage2_takes)
+        print('Stage 2 DONE.\n')
+        self.outputs = yield from self.decode(stage2_takes, output_dir, rescale)
+        # the final mixes supersede the Stage 1 segment previews
+        for vocal_path, _ in self.takes:
+            take_name = os.path.basename(vocal_path).replace('_vtrack.npy', '')
+            for path in glob.glob(glob.escape(os.path.join(output_dir, "preview", take_name)) + "_segment*.mp3"):
+                os.remove(path)
+        self.log_models()
+        print("Inference is done!")
+        print(f"Output file: {self.outputs[-1]}")
+        yield "Generation complete!", self.outputs[-1]
+
+    def generate(self, *args, **kwargs):
+        """
+        `run` to completion; returns the final mix (or with `preview` the preview) of every song.
+        """
+        for _ in self.run(*args, **kwargs):
+            pass
+        return self.outputs
+
+    def stage1(self, genres, lyrics, output_dir, num_songs=1, seed=42, max_new_tokens=3000, run_n_segments=2,
+               repetition_penalty=1.1, repetition_window=0, stage1_window="tail", cfg_tokens=None,
+               cfg_kl_threshold=None, cfg_agree_steps=8, speculative="none", num_draft=8, audio_prompt_path=None,
+               vocal_track_prompt_path=None, instrumental_track_prompt_path=None, prompt_start_time=0.0,
+               prompt_end_time=30.0, stream_stage2=False, segment_previews=False, prefetch_next=True, seeds=None,
+               take_ids=None, resume=False):
+        r"""
+        Stage 1 for one genres prompt, `num_songs` takes decoded as one batch (each row seeded with
+        `seed + row`). Yields (status, preview file) after each segment with `segment_previews` (a
+        preview is deleted once the next one is yielded, so one file per batch is left), and returns
+        the saved (vocal, instrumental) `.npy` paths of each take.
+
+        genres / lyrics: the prompt of every take, or with `seeds` a list with the prompt of each take
+            (left-padded to a common length in the batch); every take needs the same number of segments
+        seeds: one seed per take instead of `num_songs` and `seed`; every row samples from its own
+            generator, also when there is only one
+        take_ids: names used in the file names of the takes instead of random ids
+        resume: continue the journal of an interrupted run with the same parameters, if there is one
+
+        audio_prompt_path / vocal_track_prompt_path + instrumental_track_prompt_path: a mix or a pair of
+            stems whose `prompt_start_time`..`prompt_end_time` seconds are used as reference
+        speculative: "ngram", or "draft" with the pipeline's `draft_model`; `num_draft` tokens per step
+        stream_stage2: refine each 6s window with Stage 2 on a worker thread as soon as Stage 1 sampled it
+        """
+        import numpy as np
+        import torch
+        from einops import rearrange
+        from tqdm import tqdm
+        from preview import preview_mix, stage1_tracks
+        from speculative import DraftModelDrafter, NGramDrafter
+        from stage1 import Stage1Engine
+        from streaming import FrameDemuxer, Stage2Worker
+        from vocab_slice import VocabSlice
+        from journal import Stage1Journal, rng_state, set_rng_state
+        device = self.device
+        codectool = self.codectool
+        if seeds is not None:
+            num_songs = len(seeds)
+        journal = None
+        if self.options.journal_dir:
+            # everything the sampled tokens depend on: only a run with the same parameters resumes the journal
+            journal_params = {
+                "stage1_model": self.options.stage1_model, "stage1_cfg": self.options.stage1_cfg,
+                "lm_head_slice": self.options.lm_head_slice, "draft_model": self.options.draft_model if speculative == "draft" else None,
+                "genres": genres, "lyrics": lyrics, "output_dir": output_dir, "num_songs": num_songs, "seed": seed,
+                "seeds": seeds, "take_ids": take_ids, "max_new_tokens": max_new_tokens, "run_n_segments": run_n_segments,
+                "repetition_penalty": repetition_penalty, "repetition_window": repetition_window, "stage1_window": stage1_window,
+                "cfg_tokens": cfg_tokens, "cfg_kl_threshold": cfg_kl_threshold, "cfg_agree_steps": cfg_agree_steps,
+                "speculative": speculative, "num_draft": num_draft, "audio_prompt_path": audio_prompt_path,
+                "vocal_track_prompt_path": vocal_track_prompt_path, "instrumental_track_prompt_path": instrumental_track_prompt_path,
+                "prompt_start_time": prompt_start_time, "prompt_end_time": prompt_end_time,
+            }
+            journal = Stage1Journal.find(self.options.journal_dir, journal_params) if resume else None
+            if journal is not None and journal.stage1_done and all(os.path.exists(path) for take in journal.takes for path in take):
+                # the interrupted run got past Stage 1 already
+                print(f"Stage 1 outputs restored from {journal.directory}")
+                for take in journal.takes:
+                    self.stage1_journals[take] = journal
+                return journal.takes
+            if journal is not None and stream_stage2 and os.path.exists(journal.state_path):
+                raise ValueError("a Stage 1 journal cannot be resumed with stream_stage2, the windows of its completed segments were never streamed")
+        mmtokenizer = self.pool.get("tokenizer")
+        codec_model = self.pool.get("codec")
+        model = self.pool.get("stage1")
+        if prefetch_next:
+            # Copy an offloaded Stage 2 back to the GPU while Stage 1 decodes, if both fit; models never
+            # loaded (or evicted) are read from disk in the background instead
+            self.residency.prefetch("stage2")
+            for name in ("stage2", "vocoder"):
+                if self.pool.residency[name] == "disk":
+                    self.weight_prefetch.start(name)
+
+        # Optionally slice the Stage 1 LM head to the ids the block lists allow
+        stage1_vocab_slice = None
+        if self.options.lm_head_slice == "allowed":
+            stage1_vocab_slice = VocabSlice.from_blocked_ranges([(0, 32002)], model.config.vocab_size)
+        elif self.options.lm_head_slice == "codec":
+            stage1_vocab_slice = VocabSlice(
+                [(mmtokenizer.eoa, mmtokenizer.eoa+1), (codectool.global_offset, codectool.global_offset+codectool.codebook_size)],
+                model.config.vocab_size,
+            )
+        # Tips:
+        # genre tags support instrumental，genre，mood，vocal timbr and vocal gender
+        # all kinds of tags are needed
+        row_genres = list(genres) if isinstance(genres, (list, tuple)) else [genres] * num_songs
+        row_lyrics = list(lyrics) if isinstance(lyrics, (list, tuple)) else [lyrics] * num_songs
+        if len(row_genres) != num_songs or len(row_lyrics) != num_songs:
+            raise ValueError(f"{len(row_genres)} genres and {len(row_lyrics)} lyrics prompts for {num_songs} takes")
+        # the instruction, then the lyrics segments, of every row
+        row_prompt_texts = []
+        for row_genre, row_lyric in zip(row_genres, row_lyrics):
+            segments = split_lyrics(row_lyric)
+            full_lyrics = "\n".join(segments)
+            row_prompt_texts.append([f"Generate music from the given lyrics segment by segment.\n[Genre] {row_genre}\n{full_lyrics}"] + segments)
+        segment_counts = {min(run_n_segments+1, len(texts) - 1) for texts in row_prompt_texts}
+        if len(segment_counts) > 1:
+            raise ValueError(f"the takes of one Stage 1 batch need the same number of segments, got {sorted(segment_counts)}")
+
+        # Here is suggested decoding config
+        top_p = TOP_P
+        temperature = TEMPERATURE
+        # special tokens
+        start_of_segment = mmtokenizer.tokenize('[start_of_segment]')
+        end_of_segment = mmtokenizer.tokenize('[end_of_segment]')
+        # with the codec slice only <EOA> and the codebook-0 codes can be sampled, so the repetition penalty
+        # only tracks those; otherwise every id the block list leaves open keeps its penalty
+        repetition_ranges = None
+        if self.options.lm_head_slice == "codec":
+            repetition_ranges = [(mmtokenizer.eoa, mmtokenizer.eoa+1), (codectool.global_offset, codectool.global_offset+codectool.codebook_size)]
+        # Every row samples from its own generator, seeded like torch's global one would be, so the
+        # sampled tokens (and the journaled RNG states) do not depend on anything else drawing from the
+        # global RNG, e.g. a model being built on a background loader thread
+        row_seeds = seeds if seeds is not None else [seed + row for row in range(num_songs)]
+        generators = [torch.Generator(device=device).manual_seed(row_seed) for row_seed in row_seeds]
+        stage1_drafter = None
+        if speculative == "draft":
+            draft_model = self.pool.get("draft")
+            if DraftModelDrafter.vocab_matches(draft_model, model):
+                stage1_drafter = DraftModelDrafter(
+                    draft_model,
+                    eos_token_id=mmtokenizer.eoa,
+                    num_draft=num_draft,
+                    blocked_ranges=[(0, 32002)],
+                    top_p=top_p,
+                    temperature=temperature,
+                    repetition_penalty=repetition_penalty,
+                    repetition_window=repetition_window,
+                    repetition_ranges=repetition_ranges,
+                    vocab_slice=stage1_vocab_slice,
+                    device=device,
+                    generator=torch.Generator(device=device).manual_seed(row_seeds[0] + 1),
+                )
+            else:
+                print(f"Draft model vocabulary ({draft_model.config.vocab_size}) does not match the Stage 1 model "
+                      f"({model.config.vocab_size}), decoding Stage 1 without a draft model.")
+        elif speculative == "ngram":
+            stage1_drafter = NGramDrafter(num_draft=num_draft)
+        # The num_songs variants of a prompt are decoded as one batch, each row with its own seed
+        # Stage 1 keeps its KV cache across segments, only the new segment prompt is prefilled
+        # Use window slicing (or header-pinned segment eviction) in case output sequence exceeds the context of model
+        stage1_engine = Stage1Engine(
+            model,
+            eos_token_id=mmtokenizer.eoa,
+            blocked_ranges=[(0, 32002)],
+            top_p=top_p,
+            temperature=temperature,
+            repetition_penalty=repetition_penalty,
+            repetition_window=repetition_window,
+            repetition_ranges=repetition_ranges,
+            max_context=16384-max_new_tokens-1,
+            window=stage1_window,
+            vocab_slice=stage1_vocab_slice,
+            device=device,
+            batch_size=num_songs,
+            generators=generators,
+            prefix_cache=self.prefix_cache,
+            cfg=self.options.stage1_cfg,
+            cfg_tokens=cfg_tokens,
+            cfg_kl_threshold=cfg_kl_threshold,
+            cfg_agree_steps=cfg_agree_steps,
+            drafter=stage1_drafter,
+        )
+        takes = [take_paths(os.path.join(output_dir, "stage1"), row_genres[row], top_p, temperature, repetition_penalty, max_new_tokens,
+                            take_ids[row] if take_ids is not None else uuid.uuid4())
+                 for row in range(num_songs)]
+        # the draft model's sampling generator is journaled with the rows'
+        stage1_generators = generators + [stage1_drafter.generator] if isinstance(stage1_drafter, DraftModelDrafter) else generators
+        start_segment = 0
+        if journal is not None:
+            takes = journal.takes
+            state = journal.load_segment()
+            if state is not None:
+                stage1_engine.load_state_dict(state["engine"])
+                set_rng_state(state["rng"], device, stage1_generators)
+                start_segment = state["segment"]
+                print(f"Stage 1: resuming after segment {start_segment} from {journal.directory}")
+        elif self.options.journal_dir:
+            journal = Stage1Journal(os.path.join(self.options.journal_dir, os.path.basename(takes[0][0]).replace('_vtrack.npy', '')),
+                                    journal_params, takes)
+        # created up front, so a missing directory does not fail the save after the whole Stage 1 decode
+        os.makedirs(os.path.join(output_dir, "stage1"), exist_ok=True)
+        stage2_worker = None
+        if stream_stage2:
+            os.makedirs(os.path.join(output_dir, "stage2"), exist_ok=True)
+            # Stage 2 refines each 6s window on a worker thread as soon as Stage 1 has sampled it
+            print("Stage 2 streaming...")
+            stage2_worker = Stage2Worker(self._stage2_scheduler(), device)
+            stage2_demuxers = [FrameDemuxer(
+                [os.path.join(output_dir, "stage2", os.path.basename(path)) for path in take],
+                stage2_worker.add,
+                eos_token_id=mmtokenizer.eoa,
+            ) for take in takes]
+            stage1_engine.on_tokens = lambda ids: [demuxer.feed(ids[row]) for row, demuxer in enumerate(stage2_demuxers)]
+        use_audio_prompt = bool(audio_prompt_path or vocal_track_prompt_path)
+        # Format text prompt
+        num_segments = segment_counts.pop()
+        segment_preview = None
+        for i in tqdm(range(num_segments), desc="Stage1 inference..."):
+            section_texts = [texts[i].replace('[start_of_segment]', '').replace('[end_of_segment]', '') for texts in row_prompt_texts]
+            guidance_scale = 1.5 if i <=1 else 1.2
+            if i==0 or i <= start_segment:
+                continue
+            if i==1:
+                if use_audio_prompt:
+                    if vocal_track_prompt_path:
+                        vocals_ids = load_audio_mono(vocal_track_prompt_path)
+                        instrumental_ids = load_audio_mono(instrumental_track_prompt_path)
+                        vocals_ids = encode_audio(codec_model, vocals_ids, device, target_bw=0.5)
+                        instrumental_ids = encode_audio(codec_model, instrumental_ids, device, target_bw=0.5)
+                        vocals_ids = codectool.npy2ids(vocals_ids[0])
+                        instrumental_ids = codectool.npy2ids(instrumental_ids[0])
+                        ids_segment_interleaved = rearrange([np.array(vocals_ids), np.array(instrumental_ids)], 'b n -> (n b)')
+                        audio_prompt_codec = ids_segment_interleaved[int(prompt_start_time*50*2): int(prompt_end_time*50*2)]
+                        audio_prompt_codec = audio_prompt_codec.tolist()
+                    else:
+                        audio_prompt = load_audio_mono(audio_prompt_path)
+                        raw_codes = encode_audio(codec_model, audio_prompt, device, target_bw=0.5)
+                        # Format audio prompt
+                        code_ids = codectool.npy2ids(raw_codes[0])
+                        audio_prompt_codec = code_ids[int(prompt_start_time *50): int(prompt_end_time *50)] # 50 is tps of xcodec
+                    audio_prompt_codec_ids = [mmtokenizer.soa] + codectool.sep_ids + audio_prompt_codec + [mmtokenizer.eoa]
+                    sentence_ids = mmtokenizer.tokenize("[start_of_reference]") +  audio_prompt_codec_ids + mmtokenizer.tokenize("[end_of_reference]")
+                else:
+                    sentence_ids = []
+                head_ids = [mmtokenizer.tokenize(texts[0]) + sentence_ids for texts in row_prompt_texts]
+                prompt_ids = [head_id + start_of_segment + mmtokenizer.tokenize(section_text) + [mmtokenizer.soa] + codectool.sep_ids
+                              for head_id, section_text in zip(head_ids, section_texts)]
+            else:
+                prompt_ids = [end_of_segment + start_of_segment + mmtokenizer.tokenize(section_text) + [mmtokenizer.soa] + codectool.sep_ids
+                              for section_text in section_texts]
+
+            # one prompt per row; the engine decodes identical ones as a shared prompt
+            segment_start = time.perf_counter()
+            stage1_engine.generate_segment(
+                prompt_ids,
+                max_new_tokens=max_new_tokens,
+                min_new_tokens=100,
+                guidance_scale=guidance_scale,
+                num_pinned=len(head_ids[0]) if i == 1 else 0,
+            )
+            if stage2_worker is not None:
+                for demuxer in stage2_demuxers:
+                    demuxer.end_segment()
+            stage1_seconds = time.perf_counter() - segment_start
+            stage1_engine.spec_stats[-1]["seconds"] = stage1_seconds
+            if stage1_engine.drafter is not None:
+                spec = stage1_engine.spec_stats[-1]
+                print(f"Segment {i}: {spec['tokens'] / stage1_seconds:.1f} tokens/s, accepted {spec['accepted']}/{spec['drafted']} "
+                      f"drafted tokens ({spec['accepted'] / max(spec['drafted'], 1):.0%}), "
+                      f"{spec['tokens'] / max(spec['forwards'], 1):.2f} tokens per forward")
+            if journal is not None:
+                journal.save_segment(i, stage1_engine.state_dict(include_cache=self.options.journal_kv),
+                                     rng_state(device, stage1_generators))
+            if segment_previews:
+                # Rough preview of the first song so far, decoded from its codebook-0 codes
+                vocals, instrumentals = stage1_tracks(stage1_engine.row_output(0)[0].cpu().numpy(), codectool, mmtokenizer.soa, mmtokenizer.eoa,
+                                                      range_begin=1 if use_audio_prompt else 0)
+                if vocals is not None:
+                    preview_path = os.path.join(output_dir, "preview", os.path.basename(takes[0][0]).replace('_vtrack.npy', f'_segment{i}.mp3'))
+                    save_audio(preview_mix(codec_model, vocals, instrumentals, device), preview_path, 16000)
+                    # only the latest segment preview of a take is kept, the consumer is done with the previous one
+                    if segment_preview is not None and segment_preview != preview_path:
+                        os.remove(segment_preview)
+                    segment_preview = preview_path
+                    yield f"Stage 1: segment {i}/{num_segments - 1} done, rough preview", preview_path
+        stage1_tokens = sum(spec["tokens"] for spec in stage1_engine.spec_stats)
+        stage1_seconds = sum(spec["seconds"] for spec in stage1_engine.spec_stats)
+        print(f"Stage 1: {stage1_tokens} tokens in {stage1_seconds:.1f} s ({stage1_tokens / max(stage1_seconds, 1e-9):.1f} tokens/s)")
+        if stage1_engine.drafter is not None:
+            drafted = sum(spec["drafted"] for spec in stage1_engine.spec_stats)
+            accepted = sum(spec["accepted"] for spec in stage1_engine.spec_stats)
+            print(f"Stage 1 speculative decoding: accepted {accepted}/{drafted} drafted tokens ({accepted / max(drafted, 1):.0%})")
+        if stage1_engine.prefix_cache is not None:
+            print(f"Stage 1 prefix cache: {stage1_engine.prefix_cache.hits} hits, {stage1_engine.prefix_cache.misses} misses")
+        cfg_memory = stage1_engine.cfg_memory_report()
+        print(f"Stage 1 CFG KV cache: {cfg_memory['guided_bytes'] / 2**20:.0f} MiB, "
+              f"{cfg_memory['saved_bytes'] / 2**20:.0f} MiB less than a doubled CFG batch")
+        skipped_uncond = stage1_engine.cfg_stats["skipped_uncond"]
+        print(f"Stage 1 CFG: skipped {skipped_uncond} of {skipped_uncond + stage1_engine.cfg_stats['uncond_passes']} unconditional passes")
+
+        for row, (vocal_save_path, inst_save_path) in enumerate(takes):
+            # save raw output and check sanity
+            ids = stage1_engine.row_output(row)[0].cpu().numpy()
+            soa_idx = np.where(ids == mmtokenizer.soa)[0].tolist()
+            eoa_idx = np.where(ids == mmtokenizer.eoa)[0].tolist()
+            if len(soa_idx)!=len(eoa_idx):
+                raise ValueError(f'invalid pairs of soa and eoa, Num of soa: {len(soa_idx)}, Num of eoa: {len(eoa_idx)}')
+
+            vocals = []
+            instrumentals = []
+            range_begin = 1 if use_audio_prompt else 0
+            for i in range(range_begin, len(soa_idx)):
+                codec_ids = ids[soa_idx[i]+1:eoa_idx[i]]
+                if codec_ids[0] == 32016:
+                    codec_ids = codec_ids[1:]
+                codec_ids = codec_ids[:2 * (codec_ids.shape[0] // 2)]
+                vocals_ids = codectool.ids2npy(rearrange(codec_ids,"(n b) -> b n", b=2)[0])
+                vocals.append(vocals_ids)
+                instrumentals_ids = codectool.ids2npy(rearrange(codec_ids,"(n b) -> b n", b=2)[1])
+                instrumentals.append(instrumentals_ids)
+            vocals = np.concatenate(vocals, axis=1)
+            instrumentals = np.concatenate(instrumentals, axis=1)
+            np.save(vocal_save_path, vocals)
+            np.save(inst_save_path, instrumentals)
+        if journal is not None:
+            # the saved takes are the checkpoint from here on
+            journal.finish_stage1()
+            for take in takes:
+                self.stage1_journals[take] = journal
+
+        if stage2_worker is not None:
+            for demuxer in stage2_demuxers:
+                demuxer.close()
+            outputs = stage2_worker.close()
+            print(f"Stage 2: {stage2_worker.num_windows} windows streamed, {stage2_worker.busy_seconds:.1f} s of decoding, "
+                  f"{stage2_worker.drain_seconds:.1f} s waited for after Stage 1")
+            self._save_stage2_outputs(outputs)
+        return takes
+
+    def preview(self, takes, output_dir):
+        """
+        Codebook 0 of every take straight through the codec: a rough 16 kHz mix without Stage 2 or the
+        vocoder, yielded as (status, file). Returns the preview files.
+        """
+        import numpy as np
+        from preview import preview_mix
+        codec_model = self.pool.get("codec")
+        previews = []
+        for n, (vocal_path, inst_path) in enumerate(takes):
+            preview_path = os.path.join(output_dir, "preview", os.path.basename(vocal_path).replace('_vtrack.npy', '_preview.mp3'))
+            save_audio(preview_mix(codec_model, np.load(vocal_path), np.load(inst_path), self.device), preview_path, 16000)
+            print(f"Created preview: {preview_path}")
+            previews.append(preview_path)
+            yield f"Preview of take {n + 1}/{len(takes)} ready", preview_path
+        yield "Preview complete! Promote a take to run Stage 2 and the vocoder on it.", preview_path
+        return previews
+
+    def _stage2_scheduler(self):
+        from transformers import LogitsProcessorList
+        from logits_processors import BlockTokenRangeProcessor
+        from stage2 import Stage2Scheduler, StaticTeacherForcing, teacher_forcing
+        from vocab_slice import VocabSlice
+        mmtokenizer = self.pool.get("tokenizer")
+        model = self.pool.get("stage2")
+        # Stage 2 only ever emits codebook 1-7 ids, the same range the block list leaves open
+        vocab_slice = VocabSlice([(46358, 53526)], model.config.vocab_size) if self.options.lm_head_slice != "none" else None
+        if self.options.stage2_cache == "static" and (self.stage2_static is None or self.stage2_static.model is not getattr(model, "_orig_mod", model)):
+            # one window: [soa, stage_1] + 300 cb0 + [stage_2] prompt, then 300 frames of 8 tokens
+            self.stage2_static = StaticTeacherForcing(
+                model,
+                max_cache_len=3 + 300 * 9,
+                blocked_ranges=[(0, 46358), (53526, mmtokenizer.vocab_size)],
+                vocab_slice=vocab_slice,
+                batch_buckets=sorted({1, 2, 4, 8, 16, self.options.stage2_batch_size}),
+            )
+        stage2_block_list = LogitsProcessorList([BlockTokenRangeProcessor(0, 46358), BlockTokenRangeProcessor(53526, mmtokenizer.vocab_size)])
+
+        def stage2_generate(prompt_ids, codec_ids, attention_mask=None):
+            # Teacher forcing generate loop
+            if self.options.stage2_cache == "static":
+                return self.stage2_static(prompt_ids, codec_ids, attention_mask)
+            return teacher_forcing(model, prompt_ids, codec_ids,
+                logits_processor=stage2_block_list,
+                vocab_slice=vocab_slice,
+                persistent_cache=self.options.stage2_cache == "persistent",
+                attention_mask=attention_mask,
+            )
+
+        # All 6s windows of all tracks go into one queue and are decoded in batches of batch_size
+        return Stage2Scheduler(
+            stage2_generate,
+            self.options.stage2_batch_size,
+            prefix_ids=[mmtokenizer.soa, mmtokenizer.stage_1],
+            suffix_ids=[mmtokenizer.stage_2],
+            pad_id=mmtokenizer.eoa,
+        )
+
+    def _save_stage2_outputs(self, outputs):
+        import numpy as np
+        from codec_repair import fix_invalid_codes
+        for output_filename, output in outputs.items():
+            output = self.codectool_stage2.ids2npy(output)
+
+            # Fix invalid codes (a dirty solution, which may harm the quality of audio)
+            # We are trying to find better one
+            fixed_output = fix_invalid_codes(output, strategy=self.options.invalid_code_repair)
+            # save output
+            np.save(output_filename, fixed_output)
+
+    def stage2(self, takes, stage2_output_dir, resume=False):
+        """
+        Stage 2 for every (vocal, instrumental) take whose outputs are not in `stage2_output_dir` yet;
+        returns the Stage 2 `.npy` pair of every take. With a `journal_dir` the decoded windows of each
+        track are journaled after every batch, and `resume` only decodes the windows an interrupted run
+        did not get to.
+        """
+        import numpy as np
+        from tqdm import tqdm
+        from journal import Stage2Journal, codes_digest
+        codectool = self.codectool
+        os.makedirs(stage2_output_dir, exist_ok=True)
+        stage2_takes = [tuple(os.path.join(stage2_output_dir, os.path.basename(path)) for path in take) for take in takes]
+        pending = [(path, output_filename) for take, stage2_take in zip(takes, stage2_takes)
+                   for path, output_filename in zip(take, stage2_take)]
+        for path, output_filename in pending:
+            if os.path.exists(output_filename):
+                print(f'{output_filename} stage2 has done.')
+        pending = [(path, output_filename) for path, output_filename in pending if not os.path.exists(output_filename)]
+        journals, done = {}, {}
+        if pending:
+            scheduler = self._stage2_scheduler()
+            for path, output_filename in pending:
+                # Load the prompt
+                prompt = np.load(path).astype(np.int32)
+                codec_ids = codectool.unflatten(prompt, n_quantizer=1)
+                codec_ids = codectool.offset_tok_ids(
+                                codec_ids,
+                                global_offset=codectool.global_offset,
+                                codebook_size=codectool.codebook_size,
+                                num_codebooks=codectool.num_codebooks,
+                            ).astype(np.int32)
+                scheduler.add(output_filename, codec_ids)
+                if self.options.journal_dir:
+                    journals[output_filename] = Stage2Journal(
+                        os.path.join(self.options.journal_dir, "stage2", os.path.splitext(os.path.basename(output_filename))[0]),
+                        {"stage2_model": self.options.stage2_model, "stage2_cache": self.options.stage2_cache,
+                         "lm_head_slice": self.options.lm_head_slice, "prompt": codes_digest(codec_ids)},
+                    )
+                    if resume:
+                        done[output_filename] = journals[output_filename].windows()
+                    else:
+                        journals[output_filename].close()
+
+            num_windows = len(scheduler.pending)
+            num_restored = sum(len(windows) for windows in done.values())
+            if num_restored:
+                print(f"Stage 2: {num_restored} of {num_windows} windows restored from the journal")
+            outputs = scheduler.run(self.device, progress=tqdm, done=done,
+                                    on_batch=lambda windows: [journals[key].save(start, ids) for key, start, ids in windows] if journals else None)
+            print(f"Stage 2: {num_windows - num_restored} windows in {scheduler.num_batches} batches")
+            self._save_stage2_outputs(outputs)
+            for journal in journals.values():
+                journal.close()
+            if self.stage2_static is not None:
+                print(f"Stage 2 static decoder: {self.stage2_static.last_step_ms:.2f} ms/step (last window), {self.stage2_static.step_latency_ms():.2f} ms/step over {self.stage2_static.stats['steps']} steps including compilation")
+        # Stage 2 of these takes is saved, their Stage 1 journals are no longer needed
+        for take in takes:
+            journal = self.stage1_journals.pop(take, None)
+            if journal is not None and journal not in self.stage1_journals.values():
+                journal.close()
+        if self.pool.residency["stage2"] == "device":
+            self.release("stage2", upcoming=["vocoder", "stage1"])
+        return stage2_takes
+
+    def decode(self, stage2_takes, output_dir, rescale=False):
+        """
+        xcodec reconstruction, Vocos upsampling and the final mix of every take. Yields (status, file)
+        for the reconstruction and the final mix of each song; returns the final mixes.
+        """
+        import numpy as np
+        import soundfile as sf
+        import torch
+        from vocoder import process_audio
+        from post_process_audio import replace_low_freq_with_energy_matched
+        device = self.device
+        codec_model = self.pool.get("codec")
+        # reconstruct tracks
+        recons_output_dir = os.path.join(output_dir, "recons")
+        recons_mix_dir = os.path.join(recons_output_dir, 'mix')
+        os.makedirs(recons_mix_dir, exist_ok=True)
+        # vocoder to upsample audios
+        vocal_decoder, inst_decoder = self.pool.get("vocoder")
+        vocoder_output_dir = os.path.join(output_dir, 'vocoder')
+        vocoder_stems_dir = os.path.join(vocoder_output_dir, 'stems')
+        vocoder_mix_dir = os.path.join(vocoder_output_dir, 'mix')
+        os.makedirs(vocoder_mix_dir, exist_ok=True)
+        os.makedirs(vocoder_stems_dir, exist_ok=True)
+        final_outputs = []
+        for song_result in stage2_takes:
+            tracks = []
+            for npy in song_result:
+                codec_result = np.load(npy)
+                decodec_rlt=[]
+                with torch.no_grad():
+                    decoded_waveform = codec_model.decode(torch.as_tensor(codec_result.astype(np.int16), dtype=torch.long).unsqueeze(0).permute(1, 0, 2).to(device))
+                decoded_waveform = decoded_waveform.cpu().squeeze(0)
+                decodec_rlt.append(torch.as_tensor(decoded_waveform))
+                decodec_rlt = torch.cat(decodec_rlt, dim=-1)
+                save_path = os.path.join(recons_output_dir, os.path.splitext(os.path.basename(npy))[0] + ".mp3")
+                tracks.append(save_path)
+                save_audio(decodec_rlt, save_path, 16000)
+            # mix tracks
+            for inst_path in tracks:
+                try:
+                    if (inst_path.endswith('.wav') or inst_path.endswith('.mp3')) \
+                        and '_itrack' in inst_path:
+                        # find pair
+                        vocal_path = inst_path.replace('_itrack', '_vtrack')
+                        if not os.path.exists(vocal_path):
+                            continue
+                        # mix
+                        recons_mix = os.path.join(recons_mix_dir, os.path.basename(inst_path).replace('_itrack', '_mixed'))
+                        vocal_stem, sr = sf.read(inst_path)
+                        instrumental_stem, _ = sf.read(vocal_path)
+                        mix_stem = (vocal_stem + instrumental_stem) / 1
+                        sf.write(recons_mix, mix_stem, sr)
+                except Exception as e:
+                    print(e)
+            yield "Stage 2 done, running the vocoder...", recons_mix
+
+            for npy in song_result:
+                if '_itrack' in npy:
+                    # Process instrumental
+                    instrumental_output = process_audio(
+                        npy,
+                        os.path.join(vocoder_stems_dir, 'itrack.mp3'),
+                        rescale,
+                        self.options,
+                        inst_decoder,
+                        codec_model
+                    )
+                else:
+                    # Process vocal
+                    vocal_output = process_audio(
+                        npy,
+                        os.path.join(vocoder_stems_dir, 'vtrack.mp3'),
+                        rescale,
+                        self.options,
+                        vocal_decoder,
+                        codec_model
+                    )
+            # mix tracks
+            try:
+                mix_output = instrumental_output + vocal_output
+                vocoder_mix = os.path.join(vocoder_mix_dir, os.path.basename(recons_mix))
+                save_audio(mix_output, vocoder_mix, 44100, rescale)
+                print(f"Created mix: {vocoder_mix}")
+            except RuntimeError as e:
+                print(e)
+                print(f"mix {vocoder_mix} failed! inst: {instrumental_output.shape}, vocal: {vocal_output.shape}")
+
+            # Post process
+            final_output = os.path.join(output_dir, os.path.basename(recons_mix))
+            replace_low_freq_with_energy_matched(
+                a_file=recons_mix,     # 16kHz
+                b_file=vocoder_mix,    # 48kHz
+                c_file=final_output,
+                cutoff_freq=5500.0
+            )
+            final_outputs.append(final_output)
+            yield f"Song {len(final_outputs)}/{len(stage2_takes)} done", final_output
+        return final_outputs
@@ -0,0 +1,73 @@
+import threading
+import time
+import torch
+from model_pool import move_to_device, move_to_host
+
+
+class BackgroundLoader(object):
+    r"""
+    Reads the weights of later stages on background threads while an earlier stage is still running,
+    so switching stages is a host-to-device copy instead of a load from disk.
+
+    Every model is registered with a loader that builds it on the host (e.g. `from_pretrained`, which
+    reads safetensors checkpoints memory-mapped). `start` runs the loader on a thread and moves the
+    weights into pinned memory; `get` waits for that thread if it is still running (or loads right
+    away if it was never started), copies the model to the device and hands it over. A model is read
+    once per `start`: after `get` the loader keeps no reference to it.
+
+    `stats[name]` has the seconds the thread spent loading, how long `get` still had to wait for it
+    and the host-to-device copy; `overlapped_seconds` is the part of the load hidden behind other work.
+    """
+    def __init__(self, pin_memory=False):
+        self.pin_memory = pin_memory
+        self.loaders = {}
+        self.jobs = {}
+        self.stats = {}
+
+    def register(self, name, loader):
+        """
+        loader: callable without arguments returning the model (a module or a tuple of modules) on the host.
+        """
+        self.loaders[name] = loader
+
+    def start(self, name):
+        if name in self.jobs:
+            return
+        job = {"model": None, "error": None, "seconds": 0.0}
+
+        def load():
+            start = time.perf_counter()
+            try:
+                job["model"] = move_to_host(self.loaders[name](), self.pin_memory)
+            except Exception as e:
+                job["error"] = e
+            job["seconds"] = time.perf_counter() - start
+
+        job["thread"] = threading.Thread(target=load, name=f"load-{name}", daemon=True)
+        self.jobs[name] = job
+        job["thread"].start()
+
+    def get(self, name, device):
+        self.start(name)
+        job = self.jobs.pop(name)
+        start = time.perf_counter()
+        job["thread"].join()
+        wait_seconds = time.perf_counter() - start
+        if job["error"] is not None:
+            raise job["error"]
+        start = time.perf_counter()
+        model = move_to_device(job["model"], device)
+        if device.type == "cuda":
+            torch.cuda.synchronize(device)
+        self.stats[name] = {
+            "load_seconds": job["seconds"],
+            "wait_seconds": wait_seconds,
+            "copy_seconds": time.perf_counter() - start,
+            "overlapped_seconds": max(job["seconds"] - wait_seconds, 0.0),
+        }
+        return model
+
+    def log(self, name, label):
+        stats = self.stats[name]
+        print(f"{label} weights: loaded in {stats['load_seconds']:.1f} s, {stats['overlapped_seconds']:.1f} s of it "
+              f"overlapped with earlier stages, {stats['copy_seconds']:.1f} s host-to-device copy")
@@ -0,0 +1,73 @@
+from collections import OrderedDict
+import hashlib
+import os
+import torch
+
+
+class PrefixCache(object):
+    r"""
+    Prefilled KV states of prompt prefixes (the Stage 1 instruction header and audio reference),
+    keyed by their token ids, so later takes of the same brief start decoding without re-prefilling it.
+
+    Entries are kept on the host, least recently used evicted beyond `max_entries`. With `spill_dir`
+    every entry is also written there as `<key>.pt`, so other processes (e.g. the next CLI run) and
+    evicted entries can be loaded back instead of prefilled.
+
+    namespace: identifies the model (checkpoint and dtype); states of different models never mix.
+    """
+    def __init__(self, namespace="", max_entries=4, spill_dir=None):
+        self.namespace = namespace
+        self.max_entries = max_entries
+        self.spill_dir = spill_dir
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        if spill_dir is not None:
+            os.makedirs(spill_dir, exist_ok=True)
+
+    def key(self, token_ids):
+        token_ids = torch.as_tensor(token_ids).reshape(-1).to("cpu", torch.int64)
+        digest = hashlib.sha1(self.namespace.encode())
+        digest.update(token_ids.numpy().tobytes())
+        return digest.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.spill_dir, f"{key}.pt")
+
+    def _insert(self, key, layers):
+        self.entries[key] = layers
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def get(self, token_ids):
+        """
+        Returns the stored [(keys, values), ...] (batch 1, on the host) or None.
+        """
+        key = self.key(token_ids)
+        layers = self.entries.get(key)
+        if layers is not None:
+            self.entries.move_to_end(key)
+        elif self.spill_dir is not None and os.path.exists(self._path(key)):
+            layers = torch.load(self._path(key), map_location="cpu")
+            self._insert(key, layers)
+        if layers is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return layers
+
+    def put(self, token_ids, layers):
+        """
+        layers: [(keys, values), ...] of shape (B, H, T, D); only the first row is stored.
+        """
+        key = self.key(token_ids)
+        pin = torch.cuda.is_available()
+        layers = [tuple(t[:1].detach().to("cpu").pin_memory() if pin else t[:1].detach().to("cpu", copy=True)
+                        for t in layer) for layer in layers]
+        self._insert(key, layers)
+        if self.spill_dir is not None and not os.path.exists(self._path(key)):
+            # write then rename, so a concurrent reader never sees a partial file
+            tmp_path = self._path(key) + f".{os.getpid()}.tmp"
+            torch.save(layers, tmp_path)
+            os.replace(tmp_path, self._path(key))
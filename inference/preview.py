@@ -0,0 +1,48 @@
+import numpy as np
+import torch
+from einops import rearrange
+
+
+def stage1_tracks(ids, codectool, soa_id, eoa_id, range_begin=0):
+    """
+    Vocal and instrumental codebook-0 codes, (1, T) each, of every <SOA> ... <EOA> span of Stage 1 ids
+    from `range_begin` on, the same arrays infer.py saves as the Stage 1 `.npy` files.
+    Returns (None, None) when no span is complete yet.
+    """
+    ids = np.asarray(ids).reshape(-1)
+    soa_idx = np.where(ids == soa_id)[0].tolist()
+    eoa_idx = np.where(ids == eoa_id)[0].tolist()
+    vocals, instrumentals = [], []
+    for i in range(range_begin, min(len(soa_idx), len(eoa_idx))):
+        codec_ids = ids[soa_idx[i]+1:eoa_idx[i]]
+        if len(codec_ids) and codec_ids[0] == 32016:
+            codec_ids = codec_ids[1:]
+        codec_ids = codec_ids[:2 * (codec_ids.shape[0] // 2)]
+        if not len(codec_ids):
+            continue
+        tracks = rearrange(codec_ids, "(n b) -> b n", b=2)
+        vocals.append(codectool.ids2npy(tracks[0]))
+        instrumentals.append(codectool.ids2npy(tracks[1]))
+    if not vocals:
+        return None, None
+    return np.concatenate(vocals, axis=1), np.concatenate(instrumentals, axis=1)
+
+
+def decode_codes(codec_model, codes, device):
+    """
+    16 kHz waveform (1, samples) of (n_quantizers, T) xcodec codes; with only codebook 0 this is the
+    codec's lowest bandwidth.
+    """
+    with torch.no_grad():
+        wav = codec_model.decode(torch.as_tensor(codes.astype(np.int16), dtype=torch.long).unsqueeze(0).permute(1, 0, 2).to(device))
+    return wav.cpu().squeeze(0)
+
+
+def preview_mix(codec_model, vocals, instrumentals, device):
+    """
+    Rough 16 kHz mix of one song straight from its codes, without Stage 2 or the vocoder.
+    """
+    vocal_wav = decode_codes(codec_model, vocals, device)
+    inst_wav = decode_codes(codec_model, instrumentals, device)
+    length = min(vocal_wav.shape[-1], inst_wav.shape[-1])
+    return vocal_wav[..., :length] + inst_wav[..., :length]
@@ -0,0 +1,139 @@
+from contextlib import nullcontext
+import os
+import threading
+import torch
+
+
+def estimate_lm_bytes(config, dtype_bytes=2):
+    """
+    Upper bound of the weight bytes of a llama-style causal LM from its config, before it is loaded
+    (attention projections counted without grouped-query sharing, embeddings untied).
+    """
+    hidden = config.hidden_size
+    layer = 4 * hidden * hidden + 3 * hidden * config.intermediate_size
+    return dtype_bytes * (2 * config.vocab_size * hidden + config.num_hidden_layers * layer)
+
+
+def host_free_bytes():
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (ValueError, OSError, AttributeError):
+        return float("inf")
+
+
+class ResidencyManager(object):
+    r"""
+    Decides where a model goes once its stage is done, from the memory that is actually free:
+
+    * "keep": the models of the upcoming stages (those not on the device yet) plus `reserve_bytes` of
+      headroom for activations and KV caches still fit next to it, so it stays on the device;
+    * "host": otherwise, if the model will be used again (`reuse`) and host memory can hold it, it is
+      moved to pinned host memory and comes back with a host-to-device copy;
+    * "evict": otherwise it is dropped and loaded from disk next time.
+
+    Free device memory is what the driver reports plus what PyTorch's allocator keeps cached; free
+    host memory is the available physical memory. With `device_budget` / `host_budget` (bytes) the
+    manager simulates memory of that size instead, used by the models of `pool` resident there, so the
+    policy can be exercised on CPU.
+
+    `prefetch` moves an offloaded model back to the device on a background thread (and its own CUDA
+    stream) while the current stage runs, if it fits next to everything already there.
+
+    pool: a `ModelPool`; `release` and `prefetch` act on its models. `decide` also works without one.
+    """
+    def __init__(self, device, pool=None, reserve_bytes=2 * 2**30, device_budget=None, host_budget=None):
+        self.device = device
+        self.pool = pool
+        self.reserve_bytes = reserve_bytes
+        self.device_budget = device_budget
+        self.host_budget = host_budget
+        self.expected = {}
+        self.decisions = []
+        self.prefetches = {}
+
+    def expect(self, name, nbytes):
+        """
+        Size of a model of the pool that has not been loaded yet; `nbytes` may be a callable, evaluated
+        when the size is first needed.
+        """
+        self.expected[name] = nbytes
+
+    def model_bytes(self, name):
+        if self.pool is not None and self.pool.stats[name]["bytes"]:
+            return self.pool.stats[name]["bytes"]
+        nbytes = self.expected.get(name, 0)
+        if callable(nbytes):
+            nbytes = self.expected[name] = nbytes()
+        return nbytes
+
+    def _resident_bytes(self, residency):
+        if self.pool is None:
+            return 0
+        return sum(self.model_bytes(name) for name, where in self.pool.residency.items() if where == residency)
+
+    def free_device_bytes(self):
+        if self.device_budget is not None:
+            return self.device_budget - self._resident_bytes("device")
+        if self.device.type != "cuda":
+            return host_free_bytes()
+        free, _ = torch.cuda.mem_get_info(self.device)
+        return free + torch.cuda.memory_reserved(self.device) - torch.cuda.memory_allocated(self.device)
+
+    def free_host_bytes(self):
+        if self.host_budget is not None:
+            return self.host_budget - self._resident_bytes("host")
+        return host_free_bytes()
+
+    def decide(self, nbytes, upcoming_bytes=0, reuse=True):
+        """
+        Where a model of `nbytes` on the device goes when the next stages need `upcoming_bytes` more.
+        """
+        if self.free_device_bytes() >= upcoming_bytes + self.reserve_bytes:
+            return "keep"
+        if reuse and self.free_host_bytes() >= nbytes:
+            return "host"
+        return "evict"
+
+    def release(self, name, upcoming=(), reuse=True):
+        """
+        Applies `decide` to a model of the pool whose stage is done; `upcoming` names the models of the
+        next stages, `reuse=False` (e.g. a one-shot CLI run) never offloads to the host. Returns the decision.
+        """
+        self.wait(name)
+        if self.pool.residency[name] != "device":
+            return self.pool.residency[name]
+        upcoming_bytes = sum(self.model_bytes(other) for other in upcoming
+                             if other != name and self.pool.residency[other] != "device")
+        decision = self.decide(self.model_bytes(name), upcoming_bytes, reuse)
+        if decision == "host":
+            self.pool.offload(name)
+        elif decision == "evict":
+            self.pool.evict(name)
+        self.decisions.append((name, decision))
+        return decision
+
+    def prefetch(self, name):
+        """
+        Starts moving an offloaded model of the pool back to the device if it fits; returns whether it did.
+        `pool.get(name)` (or `release`) afterwards waits for the copy to finish.
+        """
+        running = self.prefetches.get(name)
+        if self.pool.residency[name] != "host" or (running is not None and running.is_alive()):
+            return False
+        if self.free_device_bytes() < self.model_bytes(name) + self.reserve_bytes:
+            return False
+
+        def restore():
+            stream = torch.cuda.Stream(self.device) if self.device.type == "cuda" else None
+            with torch.cuda.stream(stream) if stream is not None else nullcontext():
+                self.pool.restore(name)
+
+        thread = threading.Thread(target=restore, name=f"prefetch-{name}", daemon=True)
+        self.prefetches[name] = thread
+        thread.start()
+        return True
+
+    def wait(self, name):
+        thread = self.prefetches.pop(name, None)
+        if thread is not None:
+            thread.join()
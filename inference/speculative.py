@@ -0,0 +1,167 @@
+from contextlib import nullcontext
+import torch
+import torch.nn.functional as F
+from transformers import DynamicCache
+from kvcache import crop_cache, logits_to_keep_kwargs
+from logits_processors import FusedSamplingProcessor
+
+
+def speculative_accept(probs, draft_id, draft_probs=None, generator=None):
+    """
+    The speculative sampling acceptance test for one drafted token: keep it with probability
+    min(1, p / q), otherwise resample from the normalized max(0, p - q). The kept or resampled token
+    is distributed exactly as `probs`, whatever the draft.
+
+    probs: (1, V) target distribution at this position, after every logits processor
+    draft_id: index of the drafted token in `probs`
+    draft_probs: (1, V) distribution the token was drafted from; None for a deterministic draft
+        (n-gram lookup), i.e. q is one-hot
+    Returns (accepted, residual): residual is None when accepted, else the (1, V) unnormalized
+    distribution to sample the replacement from.
+    """
+    p = probs[0, draft_id]
+    q = draft_probs[0, draft_id] if draft_probs is not None else 1.0
+    u = torch.rand((), generator=generator, device=probs.device)
+    if bool(u * q < p):
+        return True, None
+    if draft_probs is None:
+        residual = probs.clone()
+        residual[0, draft_id] = 0
+    else:
+        residual = (probs - draft_probs).clamp(min=0)
+    if not bool(residual.sum() > 0):
+        residual = probs
+    return False, residual
+
+
+class NGramDrafter(object):
+    r"""
+    Prompt-lookup drafting for Stage 1: the last `n` tokens of the song are looked up in everything
+    before them (header, audio reference codes, earlier segments) and the tokens that followed their
+    most recent earlier occurrence are proposed, longest `n` first, from `max_ngram` down to `min_ngram`.
+    Codec streams repeat a lot (choruses, loops, sustained notes), so these drafts are often right.
+    The draft is deterministic, so `speculative_accept` is called without draft probabilities.
+    """
+    def __init__(self, num_draft=8, max_ngram=4, min_ngram=2):
+        self.num_draft = num_draft
+        self.max_ngram = max_ngram
+        self.min_ngram = min_ngram
+
+    def propose(self, tokens, num_draft=None):
+        """
+        tokens: (1, T) ids of the whole song so far.
+        Returns (draft ids (1, K), None); K is 0 when no n-gram matches.
+        """
+        num_draft = self.num_draft if num_draft is None else num_draft
+        tokens = tokens.reshape(-1)
+        length = tokens.shape[0]
+        for n in range(self.max_ngram, self.min_ngram - 1, -1):
+            if length <= n or num_draft <= 0:
+                break
+            # every earlier n-gram; the suffix itself is excluded, so a match always has a continuation
+            windows = tokens[:-1].unfold(0, n, 1)
+            matches = (windows == tokens[-n:]).all(dim=-1).nonzero()
+            if len(matches):
+                start = int(matches[-1]) + n
+                return tokens[start:start + num_draft].unsqueeze(0), None
+        return tokens[:0].unsqueeze(0), None
+
+
+class DraftModelDrafter(object):
+    r"""
+    Drafting with a small LM over the same vocabulary (e.g. a small Stage 1 checkpoint that uses the
+    mm_tokenizer). It samples `num_draft` tokens through the same blocked ranges, repetition penalty,
+    temperature, top-k and top-p as the target and returns their probabilities, so
+    `speculative_accept` can apply the min(1, p / q) test. Guidance is left to the target: the draft
+    runs unguided, which only lowers the acceptance rate, never changes the output distribution.
+
+    The draft keeps its own KV cache of the song and on every call only feeds what changed since the
+    previous one (the tokens accepted or resampled by the target); its repetition penalty state is
+    rebuilt when the target rejected a draft. When the song outgrows `max_context` it restarts from
+    the last half window.
+
+    vocab_slice: the target's `VocabSlice`, if any; probabilities are then returned in its compact
+    space (with the sink column), like the target's.
+    generator: the `torch.Generator` drafts are sampled from (torch's global RNG when None).
+    """
+    def __init__(self, model, eos_token_id, num_draft=4, blocked_ranges=(), top_p=0.93, top_k=50, temperature=1.0,
+                 repetition_penalty=1.1, repetition_window=None, repetition_ranges=None, vocab_slice=None, max_context=None,
+                 device=None, generator=None):
+        self.model = model
+        self.eos_token_id = eos_token_id
+        self.num_draft = num_draft
+        self.vocab_slice = vocab_slice
+        self.max_context = max_context if max_context is not None else model.config.max_position_embeddings
+        self.device = device if device is not None else model.device
+        self.generator = generator
+        self.sampler = FusedSamplingProcessor(
+            blocked_ranges=blocked_ranges if vocab_slice is None else (),
+            repetition_penalty=repetition_penalty if repetition_penalty is not None else 1.0,
+            temperature=temperature if temperature is not None else 1.0,
+            top_k=top_k,
+            top_p=top_p if top_p is not None else 1.0,
+            repetition_window=repetition_window,
+            repetition_ranges=repetition_ranges,
+            token_map=vocab_slice.full_to_compact if vocab_slice is not None else None,
+        )
+        self.forward_kwargs = logits_to_keep_kwargs(model)
+        self.cache = None
+        # the ids self.cache holds, starting at song offset self.offset
+        self.cached = None
+        self.offset = 0
+
+    @staticmethod
+    def vocab_matches(draft_model, target_model):
+        return draft_model.config.vocab_size == target_model.config.vocab_size
+
+    def _forward(self, input_ids):
+        out = self.model(input_ids=input_ids, past_key_values=self.cache, use_cache=True, **self.forward_kwargs)
+        self.cache = out.past_key_values
+        return out.logits[:, -1, :].float()
+
+    @torch.no_grad()
+    def propose(self, tokens, num_draft=None):
+        """
+        tokens: (1, T) ids of the whole song so far.
+        Returns (draft ids (1, K), draft probabilities (K, V)); drafting stops early after an eos.
+        """
+        num_draft = self.num_draft if num_draft is None else num_draft
+        tokens = tokens.reshape(-1).to(self.device)
+        if num_draft <= 0:
+            return tokens[:0].unsqueeze(0), None
+        if len(tokens) - self.offset + num_draft > self.max_context:
+            self.offset = len(tokens) - self.max_context // 2
+            self.cache = None
+        window = tokens[self.offset:]
+        common = 0
+        if self.cache is None:
+            self.cache = DynamicCache()
+            self.sampler.reset_history()
+        else:
+            # keep the longest cached prefix that still matches; at least one token is fed
+            n = min(len(self.cached), len(window) - 1)
+            mismatch = (self.cached[:n] != window[:n]).nonzero()
+            common = int(mismatch[0]) if len(mismatch) else n
+            crop_cache(self.cache, common)
+            if common < len(self.cached):
+                # the repetition penalty still counts the drafts the target rejected and misses their
+                # replacements; it is rebuilt from the window on the next call
+                self.sampler.reset_history()
+
+        drafts, probs = [], []
+        with self.vocab_slice.applied(self.model) if self.vocab_slice is not None else nullcontext():
+            logits = self._forward(window[common:].unsqueeze(0))
+            for i in range(num_draft):
+                scores = self.vocab_slice.pad_scores(logits) if self.vocab_slice is not None else logits
+                scores = self.sampler(torch.cat([window] + drafts).unsqueeze(0), scores)
+                q = F.softmax(scores, dim=-1)
+                token = torch.multinomial(q, num_samples=1, generator=self.generator)
+                if self.vocab_slice is not None:
+                    token = self.vocab_slice.to_full(token)
+                drafts.append(token.view(1))
+                probs.append(q)
+                if i == num_draft - 1 or int(token) == self.eos_token_id:
+                    break
+                logits = self._forward(token.view(1, 1))
+        self.cached = torch.cat([window] + drafts[:-1])
+        return torch.cat(drafts).unsqueeze(0), torch.cat(probs)
@@ -0,0 +1,639 @@
+from contextlib import nullcontext
+import torch
+import torch.nn.functional as F
+from transformers import DynamicCache
+from kvcache import (
+    cache_from_layers,
+    cache_layers,
+    crop_cache,
+    evict_span,
+    find_rotary_emb,
+    kv_bytes_per_token,
+    logits_to_keep_kwargs,
+    select_positions,
+)
+from logits_processors import FusedSamplingProcessor
+from speculative import speculative_accept
+
+
+class TokenBuffer(object):
+    r"""
+    Preallocated (batch, capacity) token history that lives on the model device.
+    Appending writes in place and only reallocates (doubling) when the capacity is exceeded,
+    so the song history is never rebuilt with `torch.cat` per segment.
+    """
+    def __init__(self, device, batch_size=1, capacity=16384, dtype=torch.long):
+        self.data = torch.empty((batch_size, capacity), dtype=dtype, device=device)
+        self.length = 0
+
+    def __len__(self):
+        return self.length
+
+    @property
+    def capacity(self):
+        return self.data.shape[-1]
+
+    def append(self, ids):
+        """
+        ids: (B, T) tensor or python list of ids (broadcast over the batch)
+        """
+        ids = torch.as_tensor(ids, dtype=self.data.dtype, device=self.data.device)
+        if ids.dim() == 1:
+            ids = ids.unsqueeze(0)
+        n = ids.shape[-1]
+        if self.length + n > self.capacity:
+            new_capacity = max(2 * self.capacity, self.length + n)
+            data = torch.empty((self.data.shape[0], new_capacity), dtype=self.data.dtype, device=self.data.device)
+            data[:, :self.length] = self.data[:, :self.length]
+            self.data = data
+        self.data[:, self.length:self.length + n] = ids
+        self.length += n
+
+    def view(self, start=0, end=None):
+        end = self.length if end is None else min(end, self.length)
+        return self.data[:, start:end]
+
+    def clear(self):
+        self.length = 0
+
+
+class Stage1Engine(object):
+    r"""
+    Segment-by-segment Stage 1 decoder that keeps the KV cache alive across lyric segments.
+
+    `model.generate` on `cat([raw_output, prompt_ids])` re-prefills the header and every previously
+    generated segment for each new segment. Here the conditional `past_key_values` survive between
+    `generate_segment` calls, so each segment only prefills the tokens the cache has not seen yet
+    (the trailing <EOA> plus the new `[end_of_segment][start_of_segment]...<SOA><xcodec>` prompt).
+
+    When the context would exceed `max_context` at a segment boundary:
+        window="tail": keep the last `max_context` tokens and re-prefill them (the original behaviour)
+        window="head": keep the pinned header (see `num_pinned`), evict the oldest whole segments
+                       directly from the KV cache and keep decoding without any re-prefill
+
+    Sampling follows the `generate` pipeline used so far:
+        classifier-free guidance -> repetition penalty -> min new tokens -> block `blocked_ranges`
+        -> temperature -> top-k -> top-p -> multinomial
+    with everything after guidance done by one `FusedSamplingProcessor`.
+    `top_k=50` is the `GenerationConfig` default that `generate` has always applied on top of top-p.
+    `repetition_ranges` limits the ids the repetition penalty tracks (see logits_processors.py).
+
+    With a `vocab_slice` (see vocab_slice.py) the LM head only computes the allowed ids and the whole
+    sampling pipeline runs in that compact space; `blocked_ranges` is then ignored, since the slice
+    already excludes the blocked ids.
+
+    With `batch_size > 1` the rows are decoded together, each sampling from its own `generators[row]`:
+    variants of the same prompts, or (with one prompt per row, left-padded to a common length and
+    masked out like the padding below) different songs with the same number of segments. A row that
+    emits <EOA> is finished for the segment and is fed `pad_token_id` (masked out of attention; keep it
+    in a blocked range so the repetition penalty ignores it) until every row is done, so rows keep
+    independent segment lengths; positions follow each row's own tokens. Only window="tail" is
+    supported for batches, and `row_output` returns a row without its padding.
+
+    With a `prefix_cache` (see prefix_cache.py) the `num_pinned` header of the first segment is looked up
+    there and, on a hit, decoding starts from its stored KV state; on a miss it is prefilled on its own
+    and stored.
+
+    Classifier-free guidance follows `UnbatchedClassifierFreeGuidanceLogitsProcessor`: the unconditional
+    branch only sees the last prompt token and the tokens sampled since, never the 16k conditional
+    context, so it never costs a doubled batch. cfg="separate" runs it as its own stream with its own
+    cache; cfg="fused" keeps it in the conditional cache as a masked branch and advances both branches
+    in one 2-token forward per step (batch size 1, attention implementations that take a 4D mask, i.e.
+    not flash_attention_2). Its entries are dropped from the cache when the segment ends.
+    `cfg_memory_report` compares the guided KV footprint with a doubled batch.
+
+    Adaptive guidance: with `cfg_tokens` only the first `cfg_tokens` tokens of a segment are guided; with
+    `cfg_kl_threshold` guidance stops once KL(conditional || unconditional) stayed below the threshold
+    for `cfg_agree_steps` consecutive tokens (for every row of a batch). Either way the rest of the
+    segment is sampled from the conditional scores alone and no unconditional forward is run for it;
+    `cfg_stats["skipped_uncond"]` counts the skipped passes.
+
+    Speculative decoding: with a `drafter` (see speculative.py) every sampled token is followed by up to
+    `drafter.num_draft` drafted ones, verified with a single forward of the model (and of the
+    unconditional stream) and accepted or replaced by `speculative_accept`, so the output keeps the
+    exact sampling distribution (repetition penalty, guidance and all) while a forward can yield
+    several tokens. Batch size 1 with cfg="separate" only. `spec_stats` has one entry per segment.
+
+    on_tokens(ids): called with every generated (B, n) chunk as soon as it is appended (sampled ids,
+    accepted drafts, the closing eos), e.g. to stream Stage 1 output into Stage 2 (streaming.py).
+    """
+    def __init__(self, model, eos_token_id, blocked_ranges=(), top_p=0.93, top_k=50, temperature=1.0,
+                 repetition_penalty=1.1, repetition_window=None, repetition_ranges=None, max_context=None, window="tail", vocab_slice=None,
+                 device=None, batch_size=1, generators=None, pad_token_id=0, prefix_cache=None, cfg="separate",
+                 cfg_tokens=None, cfg_kl_threshold=None, cfg_agree_steps=8, drafter=None,
+                 on_tokens=None):
+        if window not in ("tail", "head"):
+            raise ValueError(f"window={window}, expected 'tail' or 'head'")
+        if batch_size > 1 and window != "tail":
+            raise ValueError("batched Stage 1 only supports window='tail'")
+        if cfg not in ("separate", "fused"):
+            raise ValueError(f"cfg={cfg}, expected 'separate' or 'fused'")
+        if cfg == "fused" and (batch_size > 1 or getattr(model, "config", None) is not None
+                               and getattr(model.config, "_attn_implementation", None) == "flash_attention_2"):
+            raise ValueError("cfg='fused' needs batch_size=1 and an attention implementation that takes a 4D mask")
+        if drafter is not None and (batch_size > 1 or cfg != "separate"):
+            raise ValueError("speculative decoding needs batch_size=1 and cfg='separate'")
+        self.model = model
+        self.eos_token_id = eos_token_id
+        self.max_context = max_context
+        self.window = window
+        self.vocab_slice = vocab_slice
+        self.sampler = FusedSamplingProcessor(
+            blocked_ranges=blocked_ranges if vocab_slice is None else (),
+            repetition_penalty=repetition_penalty if repetition_penalty is not None else 1.0,
+            temperature=temperature if temperature is not None else 1.0,
+            top_k=top_k,
+            top_p=top_p if top_p is not None else 1.0,
+            eos_token_id=eos_token_id if vocab_slice is None else vocab_slice.to_compact(torch.tensor(eos_token_id)).item(),
+            repetition_window=repetition_window,
+            repetition_ranges=repetition_ranges,
+            token_map=vocab_slice.full_to_compact if vocab_slice is not None else None,
+        )
+        self.device = device if device is not None else model.device
+        self.inv_freq = find_rotary_emb(model).inv_freq if window == "head" else None
+        self.batch_size = batch_size
+        self.generators = generators
+        self.pad_token_id = pad_token_id
+        self.prefix_cache = prefix_cache
+        self.cfg = cfg
+        self.cfg_tokens = cfg_tokens
+        self.cfg_kl_threshold = cfg_kl_threshold
+        self.cfg_agree_steps = cfg_agree_steps
+        # peak conditional context / unconditional tokens of a guided segment, for cfg_memory_report,
+        # and how many unconditional forwards were run / skipped by the adaptive schedule
+        self.cfg_stats = {"context_tokens": 0, "uncond_tokens": 0, "bytes_per_token": 0,
+                          "uncond_passes": 0, "skipped_uncond": 0}
+        self.drafter = drafter
+        self.on_tokens = on_tokens
+        # per segment: drafted / accepted tokens, generated tokens and conditional forwards while decoding
+        self.spec_stats = []
+        # output: the whole song, context: the tokens the model currently attends to,
+        # with 0/1 masks of which tokens are real (only consulted for batches)
+        self.output = TokenBuffer(self.device, batch_size)
+        self.context = TokenBuffer(self.device, batch_size)
+        self.output_mask = TokenBuffer(self.device, batch_size)
+        self.context_mask = TokenBuffer(self.device, batch_size)
+        self.forward_kwargs = logits_to_keep_kwargs(model)
+        self.reset()
+
+    def reset(self):
+        self.output.clear()
+        self.context.clear()
+        self.output_mask.clear()
+        self.context_mask.clear()
+        # number of real tokens of each row in context[:num_cached]
+        self.positions = torch.zeros((self.batch_size, 1), dtype=torch.long, device=self.device)
+        self.cache = None
+        # context[:num_cached] is what the conditional cache holds
+        self.num_cached = 0
+        self.num_pinned = 0
+        # context offsets where each segment prompt begins
+        self.segment_starts = []
+        self.sampler.reset_history()
+
+    @property
+    def raw_output(self):
+        return self.output.view()
+
+    def row_output(self, row):
+        """
+        The whole song of batch row `row`, (1, N) without padding.
+        """
+        return self.output.view()[row:row+1, self.output_mask.view()[row].bool()]
+
+    def state_dict(self, include_cache=False):
+        """
+        What decoding needs to continue after the current segment, on the CPU: the song and context ids
+        with their masks, the window/segment bookkeeping and the statistics. With `include_cache` also
+        the conditional KV cache; without it `load_state_dict` rebuilds the cache with one prefill.
+        RNG states are not included (see journal.py).
+        """
+        state = {
+            "output": self.output.view().cpu(),
+            "output_mask": self.output_mask.view().cpu(),
+            "context": self.context.view().cpu(),
+            "context_mask": self.context_mask.view().cpu(),
+            "positions": self.positions.cpu(),
+            "num_cached": self.num_cached,
+            "num_pinned": self.num_pinned,
+            "segment_starts": list(self.segment_starts),
+            "cfg_stats": dict(self.cfg_stats),
+            "spec_stats": [dict(stats) for stats in self.spec_stats],
+        }
+        if include_cache and self.cache is not None:
+            state["cache"] = [(keys.cpu(), values.cpu()) for keys, values in cache_layers(self.cache)]
+        return state
+
+    @torch.no_grad()
+    def load_state_dict(self, state):
+        """
+        Continue from a `state_dict` taken at a segment boundary by an engine with the same model and settings.
+        """
+        self.reset()
+        self.output.append(state["output"])
+        self.output_mask.append(state["output_mask"])
+        self.context.append(state["context"])
+        self.context_mask.append(state["context_mask"])
+        self.num_pinned = state["num_pinned"]
+        self.segment_starts = list(state["segment_starts"])
+        self.cfg_stats.update(state["cfg_stats"])
+        self.spec_stats = [dict(stats) for stats in state["spec_stats"]]
+        num_cached = state["num_cached"]
+        if "cache" in state:
+            self.cache = cache_from_layers(state["cache"], 1, self.device)
+            self.positions.copy_(state["positions"])
+        elif num_cached:
+            # the cache held context[:num_cached] (the closing eos is fed with the next prompt)
+            mask_args = () if self.batch_size == 1 else (self.context_mask.view(0, num_cached), self.positions)
+            _, self.cache = self._forward(self.context.view(0, num_cached), DynamicCache(), *mask_args)
+        self.num_cached = num_cached
+
+    def _append(self, ids, mask=None):
+        ids = torch.as_tensor(ids, device=self.device).expand(self.batch_size, -1)
+        mask = torch.ones_like(ids) if mask is None else mask.to(ids.dtype)
+        self.output.append(ids)
+        self.context.append(ids)
+        self.output_mask.append(mask)
+        self.context_mask.append(mask)
+
+    def _append_generated(self, ids, mask=None):
+        self._append(ids, mask)
+        if self.on_tokens is not None:
+            self.on_tokens(ids)
+
+    def _forward(self, input_ids, cache, mask=None, positions=None, num_logits=1):
+        """
+        mask: for batches, the (B, past + new) attention mask; positions: (B, 1) real tokens before the
+        new ones, advanced in place.
+        Returns the logits of the last position (B, V), or of the last `num_logits` ones (B, num_logits, V).
+        """
+        kwargs = {}
+        if mask is not None:
+            new_mask = mask[:, -input_ids.shape[-1]:]
+            kwargs = {"attention_mask": mask, "position_ids": positions + (new_mask.cumsum(dim=-1) - 1).clamp(min=0)}
+            positions += new_mask.sum(dim=-1, keepdim=True)
+        kwargs.update({name: num_logits for name in self.forward_kwargs})
+        out = self.model(input_ids=input_ids, past_key_values=cache, use_cache=True, **kwargs)
+        if num_logits == 1:
+            return out.logits[:, -1, :].float(), out.past_key_values
+        return out.logits[:, -num_logits:, :].float(), out.past_key_values
+
+    def _replace_context(self, ids, mask=None):
+        # ids may alias the buffer storage, so copy before overwriting in place
+        ids = ids.clone()
+        mask = torch.ones_like(ids) if mask is None else mask.clone()
+        self.context.clear()
+        self.context.append(ids)
+        self.context_mask.clear()
+        self.context_mask.append(mask)
+        self.sampler.reset_history()
+
+    def _slide_tail(self):
+        total = len(self.context)
+        print(f'Output length {total} exceeding context length {self.max_context}, now using the last {self.max_context} tokens.')
+        if self.batch_size > 1:
+            self._slide_tail_rows()
+        else:
+            self._replace_context(self.context.view(total - self.max_context))
+        self.positions.zero_()
+        self.cache = None
+        self.num_cached = 0
+        self.num_pinned = 0
+        self.segment_starts = [0]
+
+    def _slide_tail_rows(self):
+        # keep the last max_context real tokens of every row, left-padded to a common length
+        context, mask = self.context.view(), self.context_mask.view().bool()
+        rows = [context[row, mask[row]][-self.max_context:] for row in range(self.batch_size)]
+        length = max(len(ids) for ids in rows)
+        ids = torch.full((self.batch_size, length), self.pad_token_id, dtype=context.dtype, device=self.device)
+        new_mask = torch.zeros_like(ids)
+        for row, row_ids in enumerate(rows):
+            ids[row, length - len(row_ids):] = row_ids
+            new_mask[row, length - len(row_ids):] = 1
+        self._replace_context(ids, new_mask)
+
+    def _evict_segments(self):
+        """
+        Evict the oldest generated segments after the pinned header until the context fits.
+        Returns False when even dropping every previous segment is not enough.
+        """
+        total = len(self.context)
+        overflow = total - self.max_context
+        pinned = self.num_pinned
+        # the current segment prompt (last start) is never evicted
+        candidates = [s for s in self.segment_starts[:-1] if s > pinned] + [self.segment_starts[-1]]
+        cut = next((s for s in candidates if s - pinned >= overflow), None)
+        if cut is None:
+            return False
+        print(f'Output length {total} exceeding context length {self.max_context}, evicting {cut - pinned} tokens of the oldest segments after the {pinned} pinned header tokens.')
+        cached_cut = min(cut, self.num_cached)
+        evict_span(self.cache, pinned, cached_cut, self.inv_freq)
+        self.num_cached -= cached_cut - pinned
+        context = self.context.view()
+        self._replace_context(torch.cat([context[:, :pinned], context[:, cut:]], dim=1))
+        self.segment_starts = [s - (cut - pinned) for s in self.segment_starts if s >= cut]
+        return True
+
+    def _prefill(self, prompt_ids, num_pinned=0, mask=None):
+        """
+        Append the prompt (with its (B, T) `mask` if left-padded per row) to the history and feed every
+        token the cache has not seen yet.
+        """
+        self.segment_starts.append(len(self.context))
+        if num_pinned:
+            self.num_pinned = len(self.context) + num_pinned
+        if self.prefix_cache is not None and num_pinned and self.cache is None and not len(self.context):
+            self._load_prefix(prompt_ids[:, :num_pinned])
+            prompt_ids = prompt_ids[:, num_pinned:]
+        self._append(prompt_ids, mask)
+        if self.max_context is not None and len(self.context) > self.max_context:
+            if self.window != "head" or self.cache is None or not self._evict_segments():
+                self._slide_tail()
+        if self.cache is None:
+            self.cache = DynamicCache()
+        logits, self.cache = self._forward(self.context.view(self.num_cached), self.cache, *self._mask_args())
+        self.num_cached = len(self.context)
+        return logits
+
+    def _load_prefix(self, prefix_ids):
+        self._append(prefix_ids)
+        layers = self.prefix_cache.get(prefix_ids)
+        if layers is None:
+            _, self.cache = self._forward(self.context.view(), DynamicCache(), *self._mask_args())
+            self.prefix_cache.put(prefix_ids, cache_layers(self.cache))
+        else:
+            self.cache = cache_from_layers(layers, self.batch_size, self.device)
+            self.positions += prefix_ids.shape[-1]
+        self.num_cached = len(self.context)
+
+    def _mask_args(self):
+        if self.batch_size == 1:
+            return ()
+        return (self.context_mask.view(), self.positions)
+
+    def _unconditional_logits(self, uncond, input_ids, mask):
+        # mirrors transformers' UnbatchedClassifierFreeGuidanceLogitsProcessor: the unconditional
+        # stream starts from the last prompt token and is then fed every sampled token
+        if self.batch_size == 1:
+            logits, uncond["cache"] = self._forward(input_ids, uncond["cache"])
+            return logits
+        uncond["mask"].append(mask)
+        logits, uncond["cache"] = self._forward(input_ids, uncond["cache"], uncond["mask"].view(), uncond["positions"])
+        return logits
+
+    def _fused_forward(self, cond_token, uncond_token, branch):
+        """
+        One forward for both guidance branches: `cond_token` continues the conditional context,
+        `uncond_token` the unconditional branch (either may be None), each attending only to its own
+        cached entries (`branch` marks them 0 / 1). Returns (cond logits, uncond logits), None for a
+        branch that was not fed.
+        """
+        fed = [(token, kind, position) for token, kind, position in
+               ((cond_token, 0, self.num_cached), (uncond_token, 1, branch["position"])) if token is not None]
+        kinds = torch.tensor([kind for _, kind, _ in fed], dtype=torch.long, device=self.device)
+        kv_kinds = torch.cat([branch["kinds"].view()[0], kinds])
+        mask = kv_kinds[None, :] == kinds[:, None]
+        num_new = len(fed)
+        mask[:, -num_new:] &= torch.ones((num_new, num_new), dtype=torch.bool, device=self.device).tril()
+        out = self.model(input_ids=torch.cat([token for token, _, _ in fed], dim=1), past_key_values=self.cache,
+                         use_cache=True, attention_mask=mask[None, None],
+                         position_ids=torch.tensor([[position for _, _, position in fed]], device=self.device))
+        self.cache = out.past_key_values
+        branch["kinds"].append(kinds[None])
+        logits = out.logits[0, -num_new:, :].float()
+        cond_logits = logits[:1] if cond_token is not None else None
+        uncond_logits = None
+        if uncond_token is not None:
+            branch["position"] += 1
+            uncond_logits = logits[-1:]
+        return cond_logits, uncond_logits
+
+    def _drop_branch(self, branch):
+        keep = (branch["kinds"].view()[0] == 0).nonzero().squeeze(-1)
+        select_positions(self.cache, keep)
+
+    def cfg_memory_report(self):
+        """
+        KV memory of the largest guided segment: the doubled batch that batched CFG keeps (conditional
+        and unconditional rows of the full context) versus this engine (context plus the unconditional
+        tokens). Returns a dict of bytes per batch row.
+        """
+        stats = self.cfg_stats
+        doubled = 2 * stats["context_tokens"] * stats["bytes_per_token"]
+        used = (stats["context_tokens"] + stats["uncond_tokens"]) * stats["bytes_per_token"]
+        return {"doubled_batch_bytes": doubled, "guided_bytes": used, "saved_bytes": doubled - used}
+
+    def _next_probs(self, logits, uncond_logits, guide, generated):
+        """
+        Sampling distribution of the next token: guidance (while `guide["on"]`), then the sampler chain.
+        Updates the adaptive guidance state in `guide`.
+        """
+        if guide["on"] and self.cfg_tokens is not None and generated >= self.cfg_tokens:
+            guide["on"] = False
+        scores = logits
+        if guide["scale"] is not None:
+            # guided or not, a guided segment is sampled from log-probabilities throughout
+            scores = F.log_softmax(scores, dim=-1)
+        if guide["on"]:
+            self.cfg_stats["uncond_passes"] += 1
+            uncond_scores = F.log_softmax(uncond_logits, dim=-1)
+            if self.cfg_kl_threshold is not None:
+                kl = (scores.exp() * (scores - uncond_scores)).sum(dim=-1)
+                guide["agree"] = guide["agree"] + 1 if bool((kl < self.cfg_kl_threshold).all()) else 0
+                if guide["agree"] >= self.cfg_agree_steps:
+                    # this token is still guided, the following ones are not
+                    guide["on"] = False
+            scores = guide["scale"] * (scores - uncond_scores) + uncond_scores
+        elif guide["scale"] is not None:
+            self.cfg_stats["skipped_uncond"] += 1
+        if self.vocab_slice is not None:
+            scores = self.vocab_slice.pad_scores(scores)
+        scores = self.sampler(self.context.view(), scores)
+        return F.softmax(scores, dim=-1)
+
+    def _speculate(self, token, budget, guide, uncond, generated, stats):
+        """
+        Draft up to `budget` tokens after `token` (sampled and appended, not fed yet), verify them with
+        one forward of each stream and append the accepted ones, plus the replacement of the first
+        rejected one. Returns None when nothing was drafted, else
+        (logits, uncond_logits, uncond_input, generated, finished) like one step of `_decode`.
+        """
+        drafts, draft_probs = self.drafter.propose(self.output.view(), min(self.drafter.num_draft, budget))
+        num_draft = drafts.shape[-1]
+        if num_draft == 0:
+            return None
+        drafts = drafts.to(self.device)
+        fed = torch.cat([token, drafts], dim=1)
+        cached, uncond_cached = self.num_cached, uncond["cache"].get_seq_length()
+        cond_logits, self.cache = self._forward(fed, self.cache, num_logits=num_draft + 1)
+        uncond_logits = None
+        if guide["on"]:
+            uncond_logits, uncond["cache"] = self._forward(fed, uncond["cache"], num_logits=num_draft + 1)
+        stats["drafted"] += num_draft
+        stats["forwards"] += 1
+
+        sample_ids = self.vocab_slice.to_compact(drafts) if self.vocab_slice is not None else drafts
+        generator = self.generators[0] if self.generators is not None else None
+        finished = torch.zeros((1, 1), dtype=torch.bool, device=self.device)
+        accepted, replacement = 0, None
+        for i in range(num_draft):
+            probs = self._next_probs(cond_logits[:, i], None if uncond_logits is None else uncond_logits[:, i],
+                                     guide, generated)
+            ok, residual = speculative_accept(probs, int(sample_ids[0, i]),
+                                              None if draft_probs is None else draft_probs[i:i+1], generator)
+            if ok:
+                next_token = drafts[:, i:i+1]
+                accepted += 1
+            else:
+                next_token = self._sample(residual, finished)
+                if self.vocab_slice is not None:
+                    next_token = self.vocab_slice.to_full(next_token)
+                replacement = next_token
+            self._append_generated(next_token)
+            generated += 1
+            finished = next_token == self.eos_token_id
+            # drafts never exceed the budget, so the segment length limit needs no check here
+            if replacement is not None or bool(finished.all()):
+                break
+        stats["accepted"] += accepted
+
+        # keep the entries of `token` and the accepted drafts
+        kept = 1 + accepted
+        self.num_cached = cached + kept
+        crop_cache(self.cache, self.num_cached)
+        if uncond_logits is not None:
+            crop_cache(uncond["cache"], uncond_cached + kept)
+        if replacement is None:
+            if accepted < num_draft:
+                return None, None, None, generated, finished
+            next_uncond = uncond_logits[:, num_draft] if uncond_logits is not None and guide["on"] else None
+            return cond_logits[:, num_draft], next_uncond, None, generated, finished
+        if bool(finished.all()):
+            return None, None, None, generated, finished
+        logits, self.cache = self._forward(replacement, self.cache)
+        self.num_cached += 1
+        stats["forwards"] += 1
+        return logits, None, replacement, generated, finished
+
+    def _sample(self, probs, finished):
+        if self.generators is None:
+            return torch.multinomial(probs, num_samples=1)
+        # finished rows do not draw, so each row's generator only advances with its own tokens
+        next_token = torch.zeros((self.batch_size, 1), dtype=torch.long, device=self.device)
+        for row, done in enumerate(finished.squeeze(-1).tolist()):
+            if not done:
+                next_token[row] = torch.multinomial(probs[row:row+1], num_samples=1, generator=self.generators[row])
+        return next_token
+
+    @torch.no_grad()
+    def generate_segment(self, prompt_ids, max_new_tokens, min_new_tokens=100, guidance_scale=None, num_pinned=0):
+        """
+        prompt_ids: (1, T) ids of the new segment prompt, not including any history (shared by all rows),
+            or a list with the prompt ids of each row.
+        num_pinned: leading prompt tokens (instruction header and audio reference) that window="head" never
+            evicts and the prefix cache stores; ignored for per-row prompts.
+        Returns the newly generated ids (B, N); every row's real tokens end with `eos_token_id`.
+        """
+        prompt_mask = None
+        if isinstance(prompt_ids, (list, tuple)) and len(prompt_ids) and not isinstance(prompt_ids[0], int):
+            prompt_ids, prompt_mask = self._pad_prompts(prompt_ids)
+        prompt_ids = torch.as_tensor(prompt_ids, device=self.device)
+        if prompt_ids.dim() == 1:
+            prompt_ids = prompt_ids.unsqueeze(0)
+        output_len = len(self.output)
+        with self._sliced_head():
+            finished = self._decode(prompt_ids, max_new_tokens, min_new_tokens, guidance_scale,
+                                    num_pinned if prompt_mask is None else 0, prompt_mask)
+        if not finished.all():
+            ids = torch.where(finished, self.pad_token_id, self.eos_token_id)
+            self._append_generated(ids, None if self.batch_size == 1 else ~finished)
+        return self.output.view(output_len + prompt_ids.shape[-1])
+
+    def _pad_prompts(self, rows):
+        """
+        Per-row prompts as (B, T) ids left-padded with `pad_token_id` and their (B, T) mask, or
+        ((1, T) ids, None) when every row has the same prompt.
+        """
+        if len(rows) != self.batch_size:
+            raise ValueError(f"{len(rows)} prompts for a batch of {self.batch_size}")
+        rows = [torch.as_tensor(ids, dtype=torch.long, device=self.device).reshape(-1) for ids in rows]
+        if all(torch.equal(ids, rows[0]) for ids in rows[1:]):
+            return rows[0].unsqueeze(0), None
+        # right-aligned, so the last column is every row's last prompt token
+        length = max(len(ids) for ids in rows)
+        prompt_ids = torch.full((self.batch_size, length), self.pad_token_id, dtype=torch.long, device=self.device)
+        mask = torch.zeros_like(prompt_ids)
+        for row, ids in enumerate(rows):
+            prompt_ids[row, length - len(ids):] = ids
+            mask[row, length - len(ids):] = 1
+        return prompt_ids, mask
+
+    def _sliced_head(self):
+        return self.vocab_slice.applied(self.model) if self.vocab_slice is not None else nullcontext()
+
+    def _decode(self, prompt_ids, max_new_tokens, min_new_tokens, guidance_scale, num_pinned, prompt_mask=None):
+        logits = self._prefill(prompt_ids, num_pinned, prompt_mask)
+        self.sampler.begin_segment(len(self.context), min_new_tokens or 0)
+        use_guidance = guidance_scale is not None and guidance_scale != 1
+        fused = use_guidance and self.cfg == "fused"
+        uncond_logits = None
+        uncond = {"cache": DynamicCache()}
+        uncond_input = prompt_ids[:, -1:].expand(self.batch_size, -1)
+        if self.batch_size > 1:
+            uncond.update(mask=TokenBuffer(self.device, self.batch_size, capacity=max_new_tokens),
+                          positions=torch.zeros((self.batch_size, 1), dtype=torch.long, device=self.device))
+        if fused:
+            # branch markers of every cached entry: the conditional context so far is all 0
+            branch = {"kinds": TokenBuffer(self.device, capacity=self.num_cached + 2 * max_new_tokens), "position": 0}
+            branch["kinds"].append(torch.zeros((1, self.num_cached), dtype=torch.long))
+            _, uncond_logits = self._fused_forward(None, uncond_input, branch)
+        # rows that already emitted eos, fed masked padding from then on
+        finished = torch.zeros((self.batch_size, 1), dtype=torch.bool, device=self.device)
+        uncond_mask = ~finished
+
+        guide = {"scale": guidance_scale if use_guidance else None, "on": use_guidance, "agree": 0}
+        stats = {"drafted": 0, "accepted": 0, "tokens": 0, "forwards": 0}
+        generated = 0
+        while True:
+            if guide["on"] and uncond_logits is None:
+                uncond_logits = self._unconditional_logits(uncond, uncond_input, uncond_mask)
+            probs = self._next_probs(logits, uncond_logits, guide, generated)
+            next_token = self._sample(probs, finished)
+            if self.vocab_slice is not None:
+                next_token = self.vocab_slice.to_full(next_token)
+            if self.batch_size == 1:
+                self._append_generated(next_token)
+            else:
+                uncond_mask = ~finished
+                next_token = next_token.masked_fill(finished, self.pad_token_id)
+                self._append_generated(next_token, uncond_mask)
+            finished = finished | (next_token == self.eos_token_id)
+            generated += 1
+            if bool(finished.all()) or generated == max_new_tokens:
+                break
+            if self.drafter is not None:
+                step = self._speculate(next_token, max_new_tokens - generated, guide, uncond, generated, stats)
+                if step is not None:
+                    logits, uncond_logits, uncond_input, generated, finished = step
+                    if bool(finished.all()) or generated == max_new_tokens:
+                        break
+                    continue
+            if fused:
+                logits, uncond_logits = self._fused_forward(next_token, next_token if guide["on"] else None, branch)
+            else:
+                logits, self.cache = self._forward(next_token, self.cache, *self._mask_args())
+                uncond_logits = None
+            self.num_cached += 1
+            stats["forwards"] += 1
+            uncond_input = next_token
+
+        stats["tokens"] = generated
+        self.spec_stats.append(stats)
+        if use_guidance:
+            self.cfg_stats["context_tokens"] = max(self.cfg_stats["context_tokens"], self.num_cached)
+            self.cfg_stats["uncond_tokens"] = max(self.cfg_stats["uncond_tokens"], generated)
+            self.cfg_stats["bytes_per_token"] = kv_bytes_per_token(self.cache)
+        if fused:
+            self._drop_branch(branch)
+        return finished
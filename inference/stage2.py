@@ -0,0 +1,288 @@
+from contextlib import nullcontext
+import time
+import numpy as np
+import torch
+from transformers import DynamicCache, StaticCache
+from kvcache import logits_to_keep_kwargs
+from logits_processors import block_mask
+
+
+@torch.no_grad()
+def teacher_forcing(model, prompt_ids, codec_ids, logits_processor=None, vocab_slice=None, tokens_per_frame=7,
+                    persistent_cache=True, attention_mask=None):
+    """
+    Greedy Stage 2 teacher forcing against one persistent KV cache.
+
+    For every frame the codebook-0 token from Stage 1 is appended and `tokens_per_frame` residual
+    codebook tokens are decoded greedily, exactly like calling `model.generate(max_new_tokens=7)` on the
+    whole sequence per frame, but the prompt is prefilled once and each frame only feeds its new tokens:
+    the last residual token of a frame goes in together with the next frame's codebook-0 token.
+    In float32 the tokens are identical to the per-frame `generate` loop; in bfloat16 the cached and the
+    re-prefilled attention round differently, so near-tied argmaxes can flip. `persistent_cache=False`
+    re-prefills every frame like the original loop, as a reference.
+
+    logits_processor: applied to the float32 last-position logits before the argmax (the block list).
+    vocab_slice: optional `VocabSlice` (the codebook 1-7 ids); the logits and argmax then only cover
+        the slice and `logits_processor` is not needed.
+    attention_mask: optional (B, L) mask of left-padded prompts; positions then start at each row's first
+        real token, as in `generate`.
+
+    prompt_ids: (B, L) tensor, codec_ids: (B, T) codebook-0 tensor. Returns (B, L + T * (1 + tokens_per_frame)).
+    """
+    batch_size, len_prompt = prompt_ids.shape
+    frame_len = 1 + tokens_per_frame
+    output = torch.empty((batch_size, len_prompt + codec_ids.shape[1] * frame_len), dtype=torch.long, device=prompt_ids.device)
+    output[:, :len_prompt] = prompt_ids
+    forward_kwargs = logits_to_keep_kwargs(model)
+    if attention_mask is not None:
+        full_mask = torch.ones(output.shape, dtype=torch.long, device=output.device)
+        full_mask[:, :len_prompt] = attention_mask
+        position_ids = (full_mask.cumsum(dim=-1) - 1).clamp(min=0)
+    cache = DynamicCache()
+    # tokens not yet in the cache: the prompt at first, then [last residual token, next cb0]
+    start = 0
+    with vocab_slice.applied(model) if vocab_slice is not None else nullcontext():
+        for frames_idx in range(codec_ids.shape[1]):
+            pos = len_prompt + frames_idx * frame_len
+            if not persistent_cache:
+                cache, start = DynamicCache(), 0
+            output[:, pos] = codec_ids[:, frames_idx]
+            pos += 1
+            for _ in range(tokens_per_frame):
+                if attention_mask is not None:
+                    forward_kwargs.update(attention_mask=full_mask[:, :pos], position_ids=position_ids[:, start:pos])
+                out = model(input_ids=output[:, start:pos], past_key_values=cache, use_cache=True, **forward_kwargs)
+                cache = out.past_key_values
+                start = pos
+                scores = out.logits[:, -1, :].float()
+                if logits_processor is not None:
+                    scores = logits_processor(output[:, :pos], scores)
+                next_tokens = scores.argmax(dim=-1)
+                output[:, pos] = vocab_slice.to_full(next_tokens) if vocab_slice is not None else next_tokens
+                pos += 1
+    return output
+
+
+class StaticTeacherForcing(object):
+    r"""
+    Stage 2 teacher forcing with static shapes, so one compiled graph is replayed for every step.
+
+    - the KV cache is a preallocated `StaticCache` of `max_cache_len` positions, one per batch bucket,
+      reused (and zeroed) across calls
+    - the batch is padded up to the nearest of `batch_buckets` (rows beyond the largest bucket are split)
+    - the prompt is prefilled eagerly; afterwards every token, including the teacher-forced codebook-0
+      ones, goes through the same (bucket, 1)-shaped step that runs the model, the block mask and the argmax
+
+    Left-padded prompts (`attention_mask`) are supported with a (bucket, max_cache_len) mask, so the
+    step keeps its shape; batches without padding skip the mask.
+
+    On CUDA the step is compiled with `mode="reduce-overhead"`, i.e. captured into a CUDA graph; on CPU it
+    is compiled with the default mode (or runs eagerly with `compile=False`). Tokens are the same as
+    `teacher_forcing` up to the rounding differences between one- and two-token forwards.
+
+    `stats` accumulates prefill/decode wall time and the number of steps over all calls (so it includes
+    the compile time of the first one); `last_step_ms` is the per-step latency of the latest call.
+    """
+    def __init__(self, model, max_cache_len, blocked_ranges=(), vocab_slice=None, batch_buckets=(1, 2, 4, 8, 16),
+                 tokens_per_frame=7, compile=True):
+        self.model = getattr(model, "_orig_mod", model)
+        self.max_cache_len = max_cache_len
+        self.vocab_slice = vocab_slice
+        self.blocked_ranges = [] if vocab_slice is not None else list(blocked_ranges)
+        self.batch_buckets = sorted(batch_buckets)
+        self.tokens_per_frame = tokens_per_frame
+        self.device = next(self.model.parameters()).device
+        self.dtype = next(self.model.parameters()).dtype
+        self.forward_kwargs = logits_to_keep_kwargs(self.model)
+        self._caches = {}
+        self._mask = None
+        self._step = self._forward_step
+        if compile:
+            mode = "reduce-overhead" if self.device.type == "cuda" else None
+            self._step = torch.compile(self._forward_step, mode=mode, dynamic=False)
+        self.stats = {"prefill_s": 0.0, "decode_s": 0.0, "steps": 0}
+        self.last_step_ms = 0.0
+
+    def step_latency_ms(self):
+        return self.stats["decode_s"] / max(self.stats["steps"], 1) * 1000
+
+    def _bucket(self, batch_size):
+        for bucket in self.batch_buckets:
+            if bucket >= batch_size:
+                return bucket
+        return self.batch_buckets[-1]
+
+    def _cache(self, batch_size):
+        if batch_size not in self._caches:
+            config = self.model.config
+            # older transformers take the shape up front, newer ones allocate on the first update
+            self._caches[batch_size] = StaticCache(config=config, max_batch_size=batch_size,
+                max_cache_len=self.max_cache_len, device=self.device, dtype=self.dtype)
+        cache = self._caches[batch_size]
+        cache.reset()
+        return cache
+
+    def _scores(self, logits):
+        scores = logits[:, -1, :].float()
+        if self._mask is not None:
+            scores = scores.masked_fill(self._mask, -float("inf"))
+        return scores
+
+    def _synchronize(self):
+        if self.device.type == "cuda":
+            torch.cuda.synchronize(self.device)
+
+    def _forward_step(self, input_ids, cache_position, position_ids, attention_mask, cache):
+        logits = self.model(input_ids=input_ids, past_key_values=cache, cache_position=cache_position,
+                            position_ids=position_ids, attention_mask=attention_mask, use_cache=True).logits
+        return self._scores(logits).argmax(dim=-1, keepdim=True)
+
+    @torch.no_grad()
+    def __call__(self, prompt_ids, codec_ids, attention_mask=None):
+        """
+        prompt_ids: (B, L) tensor, codec_ids: (B, T) codebook-0 tensor, attention_mask: optional (B, L)
+        mask of left-padded prompts. Returns (B, L + T * (1 + tokens_per_frame)).
+        """
+        bucket = self._bucket(prompt_ids.shape[0])
+        if prompt_ids.shape[0] > bucket:
+            return torch.cat([self(prompt_ids[i:i+bucket], codec_ids[i:i+bucket],
+                                   None if attention_mask is None else attention_mask[i:i+bucket])
+                              for i in range(0, prompt_ids.shape[0], bucket)], dim=0)
+        batch_size, len_prompt = prompt_ids.shape
+        total_len = len_prompt + codec_ids.shape[1] * (1 + self.tokens_per_frame)
+        assert total_len <= self.max_cache_len, f"{total_len} tokens do not fit the static cache of {self.max_cache_len}"
+        # pad the batch with copies of the first row; their outputs are dropped
+        padding = [0] * (bucket - batch_size)
+        prompt_ids = torch.cat([prompt_ids, prompt_ids[padding]], dim=0).to(self.device, torch.long)
+        codec_ids = torch.cat([codec_ids, codec_ids[padding]], dim=0).to(self.device, torch.long)
+        full_mask, pad_lengths = None, torch.zeros((bucket, 1), dtype=torch.long, device=self.device)
+        if attention_mask is not None and not bool(attention_mask.all()):
+            attention_mask = torch.cat([attention_mask, attention_mask[padding]], dim=0).to(self.device, torch.long)
+            full_mask = torch.ones((bucket, self.max_cache_len), dtype=torch.long, device=self.device)
+            full_mask[:, :len_prompt] = attention_mask
+            pad_lengths = len_prompt - attention_mask.sum(dim=-1, keepdim=True)
+
+        frame_len = 1 + self.tokens_per_frame
+        output = torch.empty((bucket, total_len), dtype=torch.long, device=self.device)
+        output[:, :len_prompt] = prompt_ids
+        for frames_idx in range(codec_ids.shape[1]):
+            output[:, len_prompt + frames_idx * frame_len] = codec_ids[:, frames_idx]
+        cache = self._cache(bucket)
+        with self.vocab_slice.applied(self.model) if self.vocab_slice is not None else nullcontext():
+            if self.blocked_ranges and self._mask is None:
+                vocab_size = self.model.get_output_embeddings().weight.shape[0]
+                self._mask = block_mask(self.blocked_ranges, vocab_size, self.device)
+
+            start_time = time.perf_counter()
+            # the prefill stops before the last prompt token, which goes through the first step
+            cache_position = torch.arange(len_prompt - 1, device=self.device)
+            self.model(input_ids=output[:, :len_prompt - 1], past_key_values=cache, use_cache=True,
+                       cache_position=cache_position, position_ids=(cache_position - pad_lengths).clamp(min=0),
+                       attention_mask=full_mask, **self.forward_kwargs)
+            self._synchronize()
+            decode_start = time.perf_counter()
+            for pos in range(len_prompt - 1, total_len - 1):
+                cache_position = torch.tensor([pos], device=self.device)
+                position_ids = (cache_position - pad_lengths).clamp(min=0)
+                next_tokens = self._step(output[:, pos:pos+1].clone(), cache_position, position_ids, full_mask, cache)
+                # predictions of the (teacher-forced) codebook-0 slots are discarded
+                if (pos + 1 - len_prompt) % frame_len != 0:
+                    if self.vocab_slice is not None:
+                        next_tokens = self.vocab_slice.to_full(next_tokens)
+                    output[:, pos+1:pos+2] = next_tokens
+            self._synchronize()
+            self.last_step_ms = (time.perf_counter() - decode_start) / (total_len - len_prompt) * 1000
+            self.stats["prefill_s"] += decode_start - start_time
+            self.stats["decode_s"] += time.perf_counter() - decode_start
+            self.stats["steps"] += total_len - len_prompt
+        return output[:batch_size]
+
+
+class Stage2Scheduler(object):
+    r"""
+    Global Stage 2 work queue.
+
+    Every track added (vocals and instrumental, of one or several songs) is cut into `window_frames`
+    windows, and all windows are decoded together in batches of up to `batch_size`, instead of one
+    track at a time with the trailing remainder run on its own. Windows are ordered longest first so
+    the short tails end up sharing a batch; a batch with windows of different lengths left-pads the
+    shorter prompts (with an attention mask) and repeats their last codebook-0 code, and the frames
+    decoded past a window's end are dropped.
+
+    decode_fn(prompt_ids, codec_ids, attention_mask) -> (B, L + T * (1 + tokens_per_frame)) runs one
+    batch, e.g. `teacher_forcing` or a `StaticTeacherForcing`; `attention_mask` is None without padding.
+    """
+    def __init__(self, decode_fn, batch_size, prefix_ids, suffix_ids, pad_id=0, window_frames=300, tokens_per_frame=7):
+        self.decode_fn = decode_fn
+        self.batch_size = batch_size
+        self.prefix_ids = list(prefix_ids)
+        self.suffix_ids = list(suffix_ids)
+        self.pad_id = pad_id
+        self.window_frames = window_frames
+        self.frame_len = 1 + tokens_per_frame
+        self.pending = []
+        self.keys = []
+        self.num_batches = 0
+
+    def add(self, key, codec_ids):
+        """
+        Queue a track; codec_ids is its 1-D sequence of (offset) codebook-0 ids.
+        """
+        codec_ids = np.asarray(codec_ids).reshape(-1)
+        self.keys.append(key)
+        for start in range(0, len(codec_ids), self.window_frames):
+            self.pending.append((key, start, codec_ids[start:start + self.window_frames]))
+
+    def batches(self):
+        windows = sorted(self.pending, key=lambda window: -len(window[2]))
+        return [windows[i:i + self.batch_size] for i in range(0, len(windows), self.batch_size)]
+
+    def decode_batch(self, batch, device):
+        """
+        Decode one batch of (key, start, codes) windows; returns the (B, T * frame_len) new ids.
+        """
+        num_frames = max(len(codes) for _, _, codes in batch)
+        len_prompt = len(self.prefix_ids) + num_frames + len(self.suffix_ids)
+        prompt_ids = np.full((len(batch), len_prompt), self.pad_id, dtype=np.int64)
+        attention_mask = np.zeros((len(batch), len_prompt), dtype=np.int64)
+        codec_ids = np.zeros((len(batch), num_frames), dtype=np.int64)
+        for row, (_, _, codes) in enumerate(batch):
+            prompt = self.prefix_ids + codes.tolist() + self.suffix_ids
+            prompt_ids[row, len_prompt - len(prompt):] = prompt
+            attention_mask[row, len_prompt - len(prompt):] = 1
+            codec_ids[row, :len(codes)] = codes
+            codec_ids[row, len(codes):] = codes[-1]
+        attention_mask = torch.as_tensor(attention_mask).to(device) if not attention_mask.all() else None
+        output = self.decode_fn(torch.as_tensor(prompt_ids).to(device), torch.as_tensor(codec_ids).to(device), attention_mask)
+        self.num_batches += 1
+        return output[:, len_prompt:].cpu().numpy()
+
+    def run(self, device, progress=None, done=None, on_batch=None):
+        """
+        Decode every queued window. Returns {key: 1-D array of the track's interleaved 8-codebook ids}.
+        progress: optional iterable wrapper such as `tqdm`.
+        done: {key: {start: ids}} windows decoded earlier (e.g. by an interrupted run), not decoded again.
+        on_batch(windows): called after every batch with its decoded [(key, start, ids), ...].
+        """
+        pieces = {}
+        done = done or {}
+        pending = []
+        for key, start, codes in self.pending:
+            ids = done.get(key, {}).get(start)
+            if ids is not None and len(ids) == len(codes) * self.frame_len:
+                pieces.setdefault(key, []).append((start, ids))
+            else:
+                pending.append((key, start, codes))
+        self.pending = pending
+        batches = self.batches()
+        for batch in (progress(batches) if progress is not None else batches):
+            output = self.decode_batch(batch, device)
+            windows = [(key, start, output[row, :len(codes) * self.frame_len]) for row, (key, start, codes) in enumerate(batch)]
+            for key, start, ids in windows:
+                pieces.setdefault(key, []).append((start, ids))
+            if on_batch is not None:
+                on_batch(windows)
+        outputs = {key: np.concatenate([piece for _, piece in sorted(pieces[key], key=lambda p: p[0])])
+                   for key in self.keys if key in pieces}
+        self.pending, self.keys = [], []
+        return outputs
@@ -0,0 +1,148 @@
+from contextlib import nullcontext
+import queue
+import threading
+import time
+import numpy as np
+import torch
+
+
+class FrameDemuxer(object):
+    r"""
+    Cuts the interleaved vocal/instrumental codebook-0 ids Stage 1 samples into Stage 2 windows while
+    decoding is still running.
+
+    Feed it every generated id (e.g. as the Stage 1 engine's `on_tokens` callback) and call
+    `end_segment` after each segment. Like the offline `.npy` path, everything from the segment's
+    <EOA> on is dropped, an odd trailing id is cut, even ids go to the vocal track and odd ones to the
+    instrumental track, and each track is cut into `window_frames` windows across segment boundaries.
+    `on_window(key, start, codes)` receives every complete window (`start` in frames of that track)
+    and `close` flushes the partial last ones. The ids are passed on as they are: Stage 2 prompts
+    hold the same offset codebook-0 ids as Stage 1 output.
+
+    Sampled ids stay on the device and are only copied to the host every `flush_tokens` ids.
+    """
+    def __init__(self, keys, on_window, eos_token_id, window_frames=300, flush_tokens=None):
+        self.keys = list(keys)
+        self.on_window = on_window
+        self.eos_token_id = eos_token_id
+        self.window_frames = window_frames
+        self.flush_tokens = flush_tokens if flush_tokens is not None else 2 * window_frames
+        self.pending = []
+        self.num_pending = 0
+        # host ids of the current segment not forming a full frame yet, and whether <EOA> was seen
+        self.carry = np.zeros(0, dtype=np.int64)
+        self.segment_ended = False
+        self.tracks = [[] for _ in self.keys]
+        self.emitted = [0 for _ in self.keys]
+
+    def feed(self, ids):
+        """
+        ids: generated ids of one row, any shape; device tensors or arrays.
+        """
+        ids = torch.as_tensor(ids).reshape(-1)
+        self.pending.append(ids)
+        self.num_pending += ids.shape[0]
+        if self.num_pending >= self.flush_tokens:
+            self._flush()
+
+    def end_segment(self):
+        self._flush()
+        self.carry = self.carry[:0]
+        self.segment_ended = False
+
+    def close(self):
+        self.end_segment()
+        for track in range(len(self.keys)):
+            self._emit(track, final=True)
+
+    def _flush(self):
+        if not self.pending:
+            return
+        ids = torch.cat(self.pending).cpu().numpy().astype(np.int64)
+        self.pending, self.num_pending = [], 0
+        if self.segment_ended:
+            return
+        eos = np.flatnonzero(ids == self.eos_token_id)
+        if len(eos):
+            ids = ids[:eos[0]]
+            self.segment_ended = True
+        ids = np.concatenate([self.carry, ids])
+        num_frames = len(ids) // len(self.keys)
+        frames = ids[:num_frames * len(self.keys)].reshape(num_frames, len(self.keys))
+        self.carry = ids[num_frames * len(self.keys):]
+        for track in range(len(self.keys)):
+            self.tracks[track].extend(frames[:, track].tolist())
+            self._emit(track)
+
+    def _emit(self, track, final=False):
+        codes = self.tracks[track]
+        while len(codes) >= self.window_frames or (final and codes):
+            window, codes = codes[:self.window_frames], codes[self.window_frames:]
+            self.on_window(self.keys[track], self.emitted[track], np.asarray(window, dtype=np.int32))
+            self.emitted[track] += len(window)
+        self.tracks[track] = codes
+
+
+class Stage2Worker(object):
+    r"""
+    Stage 2 on a background thread, fed window by window (e.g. by a `FrameDemuxer`) while Stage 1 is
+    still decoding. The worker takes whatever windows are queued, up to `scheduler.batch_size`, and
+    decodes them with `Stage2Scheduler.decode_batch`, on its own CUDA stream so its kernels can run
+    alongside Stage 1's. `close` waits for the queue to drain and returns the same
+    {key: 1-D interleaved 8-codebook ids} as `Stage2Scheduler.run`; an error raised on the worker is
+    re-raised there.
+    """
+    def __init__(self, scheduler, device):
+        self.scheduler = scheduler
+        self.device = device
+        self.queue = queue.Queue()
+        self.keys = []
+        self.pieces = {}
+        self.error = None
+        self.num_windows = 0
+        # seconds spent decoding, and how long close() still had to wait for the queue to drain
+        self.busy_seconds = 0.0
+        self.drain_seconds = 0.0
+        self.thread = threading.Thread(target=self._run, name="stage2-worker", daemon=True)
+        self.thread.start()
+
+    def add(self, key, start, codes):
+        if key not in self.keys:
+            self.keys.append(key)
+        self.queue.put((key, start, np.asarray(codes)))
+
+    def _run(self):
+        stream = torch.cuda.Stream(self.device) if self.device.type == "cuda" else None
+        with torch.cuda.stream(stream) if stream is not None else nullcontext(), torch.no_grad():
+            done = False
+            while not done:
+                batch = [self.queue.get()]
+                while len(batch) < self.scheduler.batch_size and batch[-1] is not None:
+                    try:
+                        batch.append(self.queue.get_nowait())
+                    except queue.Empty:
+                        break
+                done = batch[-1] is None
+                batch = [window for window in batch if window is not None]
+                if not batch or self.error is not None:
+                    continue
+                try:
+                    start = time.perf_counter()
+                    output = self.scheduler.decode_batch(batch, self.device)
+                    self.busy_seconds += time.perf_counter() - start
+                except Exception as e:
+                    self.error = e
+                    continue
+                self.num_windows += len(batch)
+                for row, (key, frame, codes) in enumerate(batch):
+                    self.pieces.setdefault(key, []).append((frame, output[row, :len(codes) * self.scheduler.frame_len]))
+
+    def close(self):
+        start = time.perf_counter()
+        self.queue.put(None)
+        self.thread.join()
+        self.drain_seconds = time.perf_counter() - start
+        if self.error is not None:
+            raise self.error
+        return {key: np.concatenate([piece for _, piece in sorted(self.pieces[key], key=lambda p: p[0])])
+                for key in self.keys if key in self.pieces}
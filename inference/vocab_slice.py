@@ -0,0 +1,115 @@
+from contextlib import contextmanager
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+class SlicedLMHead(nn.Module):
+    r"""
+    Drop-in replacement for `lm_head` that only produces logits for `token_ids`.
+    Column i of the output is the logit of `token_ids[i]`.
+    """
+    def __init__(self, lm_head, token_ids):
+        super().__init__()
+        weight = lm_head.weight.detach().index_select(0, token_ids.to(lm_head.weight.device))
+        self.weight = nn.Parameter(weight, requires_grad=False)
+        if getattr(lm_head, "bias", None) is not None:
+            bias = lm_head.bias.detach().index_select(0, token_ids.to(lm_head.bias.device))
+            self.bias = nn.Parameter(bias, requires_grad=False)
+        else:
+            self.bias = None
+
+    def forward(self, hidden_states):
+        return F.linear(hidden_states, self.weight, self.bias)
+
+
+class VocabSlice(object):
+    r"""
+    Compact decoding space for constrained generation.
+
+    Instead of computing ~83k logits and masking everything outside the allowed codec range,
+    the LM head is sliced to the allowed ids, so the matmul, softmax, top-k/top-p sort and sampling
+    all run over `len(token_ids)` columns and the sampled index is mapped back with `to_full`.
+
+    Token ids outside the slice (e.g. lyrics text in the history) map to the extra sink column
+    `sink`; decode-time scores are padded with a -inf sink so history-based processors such as the
+    repetition penalty can gather over compact ids without special casing.
+
+    allowed_ranges: list of [start, end) id ranges
+    """
+    def __init__(self, allowed_ranges, vocab_size):
+        token_ids = torch.cat([torch.arange(start, end) for start, end in allowed_ranges])
+        self.token_ids = torch.unique(token_ids)
+        assert self.token_ids.min() >= 0 and self.token_ids.max() < vocab_size, \
+            f"allowed_ranges={allowed_ranges} not within vocab_size={vocab_size}"
+        self.vocab_size = vocab_size
+        self.sink = len(self.token_ids)
+        self.full_to_compact = torch.full((vocab_size,), self.sink, dtype=torch.long)
+        self.full_to_compact[self.token_ids] = torch.arange(len(self.token_ids))
+        self._heads = {}
+        self._device_tables = {}
+
+    @classmethod
+    def from_blocked_ranges(cls, blocked_ranges, vocab_size):
+        """
+        The complement of `BlockTokenRangeProcessor` ranges, i.e. exactly the ids they leave sampleable.
+        """
+        allowed = torch.ones(vocab_size, dtype=torch.bool)
+        for start, end in blocked_ranges:
+            allowed[start:end] = False
+        return cls(_contiguous_ranges(allowed.nonzero().squeeze(-1)), vocab_size)
+
+    def __len__(self):
+        return len(self.token_ids)
+
+    def _tables(self, device):
+        if device not in self._device_tables:
+            self._device_tables[device] = (self.token_ids.to(device), self.full_to_compact.to(device))
+        return self._device_tables[device]
+
+    def to_full(self, compact_ids):
+        token_ids, _ = self._tables(compact_ids.device)
+        return token_ids[compact_ids]
+
+    def to_compact(self, full_ids):
+        _, full_to_compact = self._tables(full_ids.device)
+        return full_to_compact[full_ids]
+
+    def pad_scores(self, scores):
+        """
+        Append the -inf sink column so `to_compact` ids of out-of-slice tokens index a valid column.
+        """
+        return F.pad(scores, (0, 1), value=-float("inf"))
+
+    def lm_head_for(self, model):
+        model = getattr(model, "_orig_mod", model)
+        key = id(model)
+        if key not in self._heads:
+            self._heads[key] = SlicedLMHead(model.get_output_embeddings(), self.token_ids)
+        return self._heads[key]
+
+    @contextmanager
+    def applied(self, model):
+        """
+        Temporarily swap the model's LM head for the sliced one, so forward returns compact logits.
+        """
+        inner = getattr(model, "_orig_mod", model)
+        original = inner.get_output_embeddings()
+        inner.set_output_embeddings(self.lm_head_for(model))
+        try:
+            yield
+        finally:
+            inner.set_output_embeddings(original)
+
+
+def _contiguous_ranges(ids):
+    ids = ids.tolist()
+    ranges = []
+    start = prev = ids[0]
+    for i in ids[1:]:
+        if i != prev + 1:
+            ranges.append((start, prev + 1))
+            start = i
+        prev = i
+    ranges.append((start, prev + 1))
+    return ranges
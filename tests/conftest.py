@@ -0,0 +1,27 @@
+import os
+import sys
+import pytest
+import torch
+from transformers import LlamaConfig, LlamaForCausalLM
+
+# the inference modules are imported flat, the way infer.py and the Gradio app import them
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "inference"))
+
+# the mm_tokenizer vocabulary, so the real id ranges (text < 32002 <= specials < 45334 <= codec) apply
+VOCAB_SIZE = 83734
+
+
+@pytest.fixture(scope="session")
+def tiny_llama():
+    """
+    Factory of small random-weight Llamas with the YuE vocabulary, small enough to decode on the CPU.
+    """
+    def build(seed=0, attn_implementation="eager", **config):
+        torch.manual_seed(seed)
+        config = LlamaConfig(**{
+            "vocab_size": VOCAB_SIZE, "hidden_size": 64, "intermediate_size": 128, "num_hidden_layers": 2,
+            "num_attention_heads": 4, "num_key_value_heads": 2, "max_position_embeddings": 4096,
+            "attn_implementation": attn_implementation, **config,
+        })
+        return LlamaForCausalLM(config).eval()
+    return build
@@ -0,0 +1,56 @@
+import copy
+from collections import Counter
+import numpy as np
+import pytest
+from codec_repair import fix_invalid_codes
+
+
+def legacy_fix_invalid_codes(output):
+    # the nested-loop repair stage2_inference used before codec_repair.py
+    fixed_output = copy.deepcopy(output)
+    for i, line in enumerate(output):
+        for j, element in enumerate(line):
+            if element < 0 or element > 1023:
+                counter = Counter(line)
+                most_frequant = sorted(counter.items(), key=lambda x: x[1], reverse=True)[0][0]
+                fixed_output[i, j] = most_frequant
+    return fixed_output
+
+
+def stage2_codes(num_frames=500, invalid_ratio=0.02, seed=0):
+    # uint32 like CodecManipulator.ids2npy: an id below its codebook's offset wraps to ~4.29e9
+    rng = np.random.RandomState(seed)
+    codes = rng.randint(0, 1024, (8, num_frames)).astype(np.uint32)
+    invalid = rng.rand(8, num_frames) < invalid_ratio
+    codes[invalid] = rng.randint(1024, 2048, invalid.sum())
+    wrapped = invalid & (rng.rand(8, num_frames) < 0.5)
+    codes[wrapped] = (-rng.randint(1, 1024, wrapped.sum())).astype(np.uint32)
+    return codes
+
+
+def test_mode_matches_legacy_loop_with_wrapped_codes():
+    codes = stage2_codes()
+    assert (codes > 2**31).any()
+    np.testing.assert_array_equal(fix_invalid_codes(codes), legacy_fix_invalid_codes(codes))
+
+
+def test_mode_ties_go_to_the_first_value():
+    codes = np.array([[7, 5, 5, 7, 4000000000, 3]], dtype=np.uint32)
+    np.testing.assert_array_equal(fix_invalid_codes(codes), [[7, 5, 5, 7, 7, 3]])
+
+
+def test_nearest_uses_the_closest_valid_code():
+    codes = np.array([[1, 2000, 2000, 4, 2000], [2000, 2000, 2000, 2000, 2000]])
+    np.testing.assert_array_equal(fix_invalid_codes(codes, strategy="nearest"), [[1, 1, 4, 4, 4], [2000] * 5])
+
+
+def test_input_is_left_untouched():
+    codes = stage2_codes()
+    original = codes.copy()
+    fix_invalid_codes(codes, strategy="nearest")
+    np.testing.assert_array_equal(codes, original)
+
+
+def test_unknown_strategy():
+    with pytest.raises(ValueError):
+        fix_invalid_codes(np.zeros((8, 4), dtype=np.uint32), strategy="median")
@@ -0,0 +1,91 @@
+import numpy as np
+import pytest
+import torch
+from transformers import LogitsProcessorList
+from journal import Stage1Journal, Stage2Journal, rng_state, set_rng_state
+from logits_processors import BlockTokenRangeProcessor
+from stage1 import Stage1Engine
+from stage2 import Stage2Scheduler, teacher_forcing
+
+CPU = torch.device("cpu")
+EOA = 32002
+PARAMS = {"genres": "pop", "seed": 7}
+
+
+def stage1_engine(model):
+    return Stage1Engine(model, eos_token_id=EOA, blocked_ranges=[(0, 32002), (46358, 83734)], device=CPU,
+                        max_context=150, generators=[torch.Generator().manual_seed(7)])
+
+
+def decode_segments(stage1, prompts, start=0):
+    for i in range(start, len(prompts)):
+        stage1.generate_segment(prompts[i], max_new_tokens=40, min_new_tokens=10, guidance_scale=1.5 if i <= 1 else 1.2,
+                                num_pinned=30 if i == 0 else 0)
+
+
+@pytest.mark.parametrize("include_cache", [False, True])
+def test_resumed_stage1_matches_the_uninterrupted_run(tiny_llama, tmp_path, include_cache):
+    model = tiny_llama()
+    generator = torch.Generator().manual_seed(4)
+    prompts = [torch.randint(45334, 46358, (1, length), generator=generator) for length in (40, 12, 12, 12)]
+    reference = stage1_engine(model)
+    decode_segments(reference, prompts)
+
+    interrupted = stage1_engine(model)
+    decode_segments(interrupted, prompts[:2])
+    journal = Stage1Journal(str(tmp_path / "take"), PARAMS, [("take_vtrack.npy", "take_itrack.npy")])
+    journal.save_segment(1, interrupted.state_dict(include_cache=include_cache), rng_state(CPU, interrupted.generators))
+    del interrupted
+
+    torch.manual_seed(999)
+    assert Stage1Journal.find(str(tmp_path), {**PARAMS, "seed": 8}) is None
+    journal = Stage1Journal.find(str(tmp_path), PARAMS)
+    state = journal.load_segment()
+    resumed = stage1_engine(model)
+    resumed.load_state_dict(state["engine"])
+    set_rng_state(state["rng"], CPU, resumed.generators)
+    decode_segments(resumed, prompts, start=state["segment"] + 1)
+    assert torch.equal(resumed.raw_output, reference.raw_output)
+    # the song outgrew max_context, so the resumed segments slid the window
+    assert reference.raw_output.shape[-1] > 150
+
+    journal.finish_stage1()
+    assert Stage1Journal.find(str(tmp_path), PARAMS).stage1_done and journal.load_segment() is None
+    journal.close()
+    assert Stage1Journal.find(str(tmp_path), PARAMS) is None
+
+
+def stage2_scheduler(model):
+    block_list = LogitsProcessorList([BlockTokenRangeProcessor(0, 46358), BlockTokenRangeProcessor(53526, 83734)])
+
+    def decode(prompt_ids, codec_ids, attention_mask=None):
+        return teacher_forcing(model, prompt_ids, codec_ids, logits_processor=block_list, attention_mask=attention_mask)
+    return Stage2Scheduler(decode, 2, prefix_ids=[32001, 32013], suffix_ids=[32017], pad_id=EOA, window_frames=4)
+
+
+def test_resumed_stage2_decodes_only_the_missing_windows(tiny_llama, tmp_path):
+    model = tiny_llama()
+    codes = np.random.RandomState(0).randint(45334, 46358, 14)
+    reference = stage2_scheduler(model)
+    reference.add("track", codes)
+    expected = reference.run(CPU)["track"]
+
+    # the interrupted run journaled its first batch, then died
+    journal = Stage2Journal(str(tmp_path / "track"), {"prompt": "a"})
+    interrupted = stage2_scheduler(model)
+    interrupted.add("track", codes)
+
+    def save_first_batch(windows):
+        if interrupted.num_batches == 1:
+            for key, start, ids in windows:
+                journal.save(start, ids)
+    interrupted.run(CPU, on_batch=save_first_batch)
+
+    resumed = stage2_scheduler(model)
+    resumed.add("track", codes)
+    done = {"track": Stage2Journal(str(tmp_path / "track"), {"prompt": "a"}).windows()}
+    assert sorted(done["track"]) == [0, 4]
+    np.testing.assert_array_equal(resumed.run(CPU, done=done)["track"], expected)
+    assert resumed.num_batches == 1
+    # windows journaled for another input are discarded
+    assert Stage2Journal(str(tmp_path / "track"), {"prompt": "b"}).windows() == {}
@@ -0,0 +1,51 @@
+import pytest
+import torch
+from transformers import (LogitsProcessorList, MinNewTokensLengthLogitsProcessor, RepetitionPenaltyLogitsProcessor,
+                          TemperatureLogitsWarper, TopKLogitsWarper, TopPLogitsWarper)
+from logits_processors import BlockTokenRangeProcessor, FusedSamplingProcessor, IncrementalRepetitionPenaltyProcessor
+
+VOCAB_SIZE, EOA = 83734, 32002
+BLOCKED_RANGES = [(0, 32002), (46358, VOCAB_SIZE)]
+
+
+def test_windowed_repetition_penalty_matches_the_stock_processor_on_the_tail():
+    vocab_size, window, steps = 1025, 300, 3000
+    generator = torch.Generator().manual_seed(0)
+    # few distinct ids, so ids keep leaving the window and coming back
+    history = torch.randint(0, 400, (2, 50 + steps), generator=generator)
+    incremental = IncrementalRepetitionPenaltyProcessor(1.3, window=window)
+    reference = RepetitionPenaltyLogitsProcessor(1.3)
+    for length in range(50, history.shape[-1] + 1):
+        scores = torch.randn(2, vocab_size, generator=generator)
+        input_ids = history[:, :length]
+        expected = reference(input_ids[:, -window:], scores.clone())
+        assert torch.equal(incremental(input_ids, scores.clone()), expected), f"step {length}"
+
+
+@pytest.mark.parametrize("resolution", [None, 1.0, 4.0])
+def test_fused_sampling_matches_the_generate_chain(resolution):
+    # a coarse `resolution` rounds the scores, so top-k and top-p cuts fall between tied scores
+    generator = torch.Generator().manual_seed(0)
+    prompt_length, min_new_tokens = 100, 20
+    history = torch.randint(45334, 46358, (2, prompt_length + 40), generator=generator)
+    chain = LogitsProcessorList([
+        RepetitionPenaltyLogitsProcessor(1.1),
+        MinNewTokensLengthLogitsProcessor(prompt_length, min_new_tokens, EOA),
+        *[BlockTokenRangeProcessor(start, end) for start, end in BLOCKED_RANGES],
+        TemperatureLogitsWarper(0.9),
+        TopKLogitsWarper(50),
+        TopPLogitsWarper(0.93),
+    ])
+    fused = FusedSamplingProcessor(blocked_ranges=BLOCKED_RANGES, repetition_penalty=1.1, temperature=0.9, top_k=50,
+                                   top_p=0.93, eos_token_id=EOA)
+    fused.begin_segment(prompt_length, min_new_tokens)
+    for length in range(prompt_length, history.shape[-1] + 1, 5):
+        scores = torch.randn(2, VOCAB_SIZE, generator=generator) * 3
+        if resolution is not None:
+            scores = (scores * resolution).round() / resolution
+        # <EOA> wins once min_new_tokens are generated, and is blocked before
+        scores[:, EOA] = 20
+        input_ids = history[:, :length]
+        expected = chain(input_ids, scores.clone())
+        assert torch.equal(fused(input_ids, scores.clone()), expected), f"step {length}"
+        assert bool(expected[0, EOA].isinf()) == (length - prompt_length < min_new_tokens)
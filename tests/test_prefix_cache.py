@@ -0,0 +1,47 @@
+import torch
+from prefix_cache import PrefixCache
+from stage1 import Stage1Engine
+
+EOA = 32002
+HEADER_LENGTH = 30
+
+
+def decode(model, prefix_cache, prompts, seed=0):
+    torch.manual_seed(seed)
+    stage1 = Stage1Engine(model, eos_token_id=EOA, blocked_ranges=[(0, 32002), (46358, 83734)],
+                          device=torch.device("cpu"), prefix_cache=prefix_cache)
+    for i, prompt_ids in enumerate(prompts):
+        stage1.generate_segment(prompt_ids, max_new_tokens=40, min_new_tokens=10, guidance_scale=1.5 if i <= 1 else 1.2,
+                                num_pinned=HEADER_LENGTH if i == 0 else 0)
+    return stage1.raw_output
+
+
+def test_cold_warm_and_spilled_prefixes_decode_the_same_tokens(tiny_llama, tmp_path):
+    model = tiny_llama()
+    generator = torch.Generator().manual_seed(5)
+    prompts = [torch.randint(45334, 46358, (1, length), generator=generator) for length in (HEADER_LENGTH + 10, 12, 12)]
+    prefix_cache = PrefixCache(namespace="tiny", spill_dir=str(tmp_path))
+    cold = decode(model, prefix_cache, prompts)
+    assert (prefix_cache.hits, prefix_cache.misses) == (0, 1)
+    warm = decode(model, prefix_cache, prompts)
+    assert (prefix_cache.hits, prefix_cache.misses) == (1, 1)
+    # another process: nothing in memory, the entry is read back from the spill directory
+    spilled_cache = PrefixCache(namespace="tiny", spill_dir=str(tmp_path))
+    spilled = decode(model, spilled_cache, prompts)
+    assert (spilled_cache.hits, spilled_cache.misses) == (1, 0)
+    assert torch.equal(warm, cold) and torch.equal(spilled, cold)
+    # a different model never reads these states
+    assert PrefixCache(namespace="other", spill_dir=str(tmp_path)).get(prompts[0][:, :HEADER_LENGTH]) is None
+
+
+def test_least_recently_used_entries_are_evicted():
+    prefix_cache = PrefixCache(max_entries=2)
+    layers = [(torch.zeros(1, 2, 3, 4), torch.zeros(1, 2, 3, 4))]
+    for ids in ([1], [2], [3]):
+        prefix_cache.put(torch.tensor(ids), layers)
+    assert len(prefix_cache.entries) == 2 and prefix_cache.get(torch.tensor([1])) is None
+    # reading [2] makes [3] the least recently used
+    assert prefix_cache.get(torch.tensor([2])) is not None
+    prefix_cache.put(torch.tensor([4]), layers)
+    assert prefix_cache.get(torch.tensor([3])) is None
+    assert prefix_cache.get(torch.tensor([2])) is not None and prefix_cache.get(torch.tensor([4])) is not None
@@ -0,0 +1,81 @@
+import torch
+from model_pool import ModelPool
+from residency import ResidencyManager
+
+CPU = torch.device("cpu")
+
+
+class Weights(torch.nn.Module):
+    def __init__(self, nbytes):
+        super().__init__()
+        self.register_buffer("weight", torch.zeros(nbytes // 4, dtype=torch.float32))
+
+
+def models(options, **sizes):
+    """
+    A CPU pool of models of the given sizes (bytes) and a manager simulating the given budgets. The
+    sizes of models not loaded yet are announced up front, like YuEPipeline does for the LMs.
+    """
+    pool = ModelPool(CPU)
+    residency = ResidencyManager(CPU, pool, **options)
+    for name, nbytes in sizes.items():
+        pool.register(name, lambda nbytes=nbytes: Weights(nbytes))
+        residency.expect(name, nbytes)
+    return pool, residency
+
+
+def test_keeps_a_model_when_the_next_stages_still_fit():
+    pool, residency = models(dict(reserve_bytes=100, device_budget=1000, host_budget=0), stage1=400, stage2=200, vocoder=100)
+    pool.get("stage1")
+    # 600 free, 300 upcoming + 100 reserve
+    assert residency.release("stage1", upcoming=["stage2", "vocoder"]) == "keep"
+    assert pool.residency["stage1"] == "device"
+    # models already on the device do not count as upcoming: 400 free, 100 upcoming + 100 reserve
+    pool.get("stage2")
+    assert residency.release("stage1", upcoming=["stage2", "vocoder"]) == "keep"
+    assert residency.release("stage2", upcoming=["vocoder", "stage1"]) == "keep"
+
+
+def test_offloads_to_host_until_it_is_full_then_evicts():
+    pool, residency = models(dict(reserve_bytes=0, device_budget=500, host_budget=500), stage1=400, stage2=400, vocoder=100)
+    pool.get("stage1")
+    assert residency.release("stage1", upcoming=["stage2"]) == "host"
+    pool.get("stage2")
+    # the host already holds stage1, so stage2 does not fit there any more
+    assert residency.release("stage2", upcoming=["vocoder", "stage1"]) == "evict"
+    assert residency.decisions == [("stage1", "host"), ("stage2", "evict")]
+    assert pool.residency == {"stage1": "host", "stage2": "disk", "vocoder": "disk"}
+    # 100 bytes of host memory are left next to stage1
+    pool.get("vocoder")
+    assert residency.release("vocoder", upcoming=["stage2", "stage1"]) == "host"
+
+
+def test_one_shot_runs_never_offload_to_host():
+    pool, residency = models(dict(reserve_bytes=0, device_budget=500, host_budget=10**9), stage1=400, stage2=400)
+    pool.get("stage1")
+    assert residency.release("stage1", upcoming=["stage2"], reuse=False) == "evict"
+
+
+def test_expected_size_is_used_until_the_model_is_loaded():
+    calls = []
+    pool, residency = models(dict(reserve_bytes=0, device_budget=700, host_budget=0), stage1=400, stage2=200)
+    residency.expect("stage2", lambda: calls.append("stage2") or 350)
+    pool.get("stage1")
+    # 300 free < 350 expected
+    assert residency.release("stage1", upcoming=["stage2"]) == "evict"
+    assert residency.model_bytes("stage2") == 350 and calls == ["stage2"]
+    pool.get("stage2")
+    assert residency.model_bytes("stage2") == 200
+
+
+def test_prefetch_restores_an_offloaded_model_that_fits():
+    pool, residency = models(dict(reserve_bytes=0, device_budget=500, host_budget=1000), stage1=400, stage2=200)
+    pool.get("stage2")
+    pool.offload("stage2")
+    pool.get("stage1")
+    # 100 free on the device, stage2 needs 200
+    assert not residency.prefetch("stage2")
+    pool.evict("stage1")
+    assert residency.prefetch("stage2")
+    residency.wait("stage2")
+    assert pool.residency["stage2"] == "device"
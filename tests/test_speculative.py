@@ -0,0 +1,83 @@
+import torch
+from logits_processors import IncrementalRepetitionPenaltyProcessor
+from speculative import DraftModelDrafter, NGramDrafter, speculative_accept
+from stage1 import Stage1Engine
+
+EOA = 32002
+
+
+def test_ngram_drafter_proposes_the_continuation_of_the_latest_match():
+    drafter = NGramDrafter(num_draft=3, max_ngram=3, min_ngram=2)
+    tokens = torch.tensor([[1, 2, 3, 4, 9, 2, 3, 5, 6, 7, 2, 3]])
+    # [2, 3] last occurred before 5, 6, 7
+    drafts, probs = drafter.propose(tokens)
+    assert drafts.tolist() == [[5, 6, 7]] and probs is None
+    # the longer [9, 2, 3] match wins over the more recent [2, 3]
+    drafts, _ = drafter.propose(torch.tensor([[9, 2, 3, 4, 2, 3, 8, 9, 2, 3]]), num_draft=2)
+    assert drafts.tolist() == [[4, 2]]
+    assert drafter.propose(torch.tensor([[1, 2, 3, 4]]))[0].shape == (1, 0)
+
+
+def test_speculative_accept_keeps_the_target_distribution():
+    probs = torch.tensor([[0.1, 0.2, 0.3, 0.4]])
+    draft_probs = torch.tensor([[0.4, 0.3, 0.2, 0.1]])
+    generator = torch.Generator().manual_seed(0)
+    counts = torch.zeros(4)
+    num_trials = 20000
+    for _ in range(num_trials):
+        draft_id = int(torch.multinomial(draft_probs, 1, generator=generator))
+        accepted, residual = speculative_accept(probs, draft_id, draft_probs, generator)
+        token = draft_id if accepted else int(torch.multinomial(residual, 1, generator=generator))
+        counts[token] += 1
+    assert torch.allclose(counts / num_trials, probs[0], atol=0.015)
+
+
+def test_deterministic_draft_is_rejected_when_the_target_excludes_it():
+    probs = torch.tensor([[0.5, 0.0, 0.5]])
+    accepted, residual = speculative_accept(probs, 1)
+    assert not accepted and residual[0, 1] == 0
+    accepted, residual = speculative_accept(torch.tensor([[0.0, 1.0, 0.0]]), 1)
+    assert accepted and residual is None
+
+
+def decode(model, prompt_ids, drafter=None, top_k=1, temperature=1.0, seed=0):
+    torch.manual_seed(seed)
+    stage1 = Stage1Engine(model, eos_token_id=EOA, blocked_ranges=[(0, 32002)], top_k=top_k, temperature=temperature,
+                          repetition_penalty=1.0, device=torch.device("cpu"), drafter=drafter)
+    stage1.generate_segment(prompt_ids, max_new_tokens=60, min_new_tokens=60, guidance_scale=1.5)
+    return stage1
+
+
+def test_ngram_speculation_keeps_greedy_tokens(tiny_llama):
+    model = tiny_llama()
+    # a repetitive prompt; without a repetition penalty greedy decoding of a random model loops as well
+    prompt_ids = torch.cat([torch.arange(45334, 45360).repeat(3), torch.tensor([32001, 32016])]).unsqueeze(0)
+    plain = decode(model, prompt_ids)
+    speculative = decode(model, prompt_ids, drafter=NGramDrafter(num_draft=8))
+    assert torch.equal(speculative.raw_output, plain.raw_output)
+    stats = speculative.spec_stats[-1]
+    assert stats["accepted"] > 0
+    assert stats["forwards"] < plain.spec_stats[-1]["forwards"]
+
+
+def test_draft_model_repetition_state_follows_the_accepted_tokens(tiny_llama):
+    model = tiny_llama()
+    drafter = DraftModelDrafter(model, eos_token_id=EOA, num_draft=3, blocked_ranges=[(0, 32002)],
+                                repetition_ranges=[(EOA, EOA + 1), (45334, 46358)], device=torch.device("cpu"))
+    torch.manual_seed(0)
+    tokens = torch.randint(45334, 45400, (1, 20))
+    drafts, _ = drafter.propose(tokens)
+    assert drafts.shape == (1, 3)
+    # the target accepts the first draft and replaces the second with an id the song has not used yet
+    replacement = torch.tensor([[46000]])
+    assert replacement not in drafts
+    tokens = torch.cat([tokens, drafts[:, :1], replacement], dim=1)
+    drafts, _ = drafter.propose(tokens)
+
+    # the penalty state matches one built from scratch over what the drafter sampled from
+    history = torch.cat([tokens, drafts[:, :-1]], dim=1)
+    penalty = drafter.sampler.repetition_penalty
+    fresh = IncrementalRepetitionPenaltyProcessor(penalty.penalty, token_ranges=penalty.token_ranges)
+    fresh(history, torch.zeros(1, 83734))
+    assert penalty.seen == history.shape[-1]
+    assert torch.equal(penalty.state, fresh.state)
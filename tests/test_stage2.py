@@ -0,0 +1,106 @@
+import numpy as np
+import torch
+from transformers import LogitsProcessorList
+from logits_processors import BlockTokenRangeProcessor
+from stage2 import Stage2Scheduler, StaticTeacherForcing, teacher_forcing
+from vocab_slice import VocabSlice
+
+# Stage 2 emits codebook 1-7 ids only
+BLOCKED_RANGES = [(0, 46358), (53526, 83734)]
+PREFIX_IDS, SUFFIX_IDS, PAD_ID = [32001, 32013], [32017], 32002
+
+
+def block_list():
+    return LogitsProcessorList([BlockTokenRangeProcessor(start, end) for start, end in BLOCKED_RANGES])
+
+
+def window_prompt(codec_ids):
+    batch_size = codec_ids.shape[0]
+    return torch.cat([torch.tensor([PREFIX_IDS]).expand(batch_size, -1), codec_ids,
+                      torch.tensor([SUFFIX_IDS]).expand(batch_size, -1)], dim=1)
+
+
+def test_persistent_cache_matches_per_frame_prefill(tiny_llama):
+    model = tiny_llama()
+    codec_ids = torch.randint(45334, 46358, (2, 6))
+    prompt_ids = window_prompt(codec_ids)
+    reference = teacher_forcing(model, prompt_ids, codec_ids, logits_processor=block_list(), persistent_cache=False)
+    assert torch.equal(teacher_forcing(model, prompt_ids, codec_ids, logits_processor=block_list()), reference)
+
+
+def test_vocab_slice_matches_block_list(tiny_llama):
+    model = tiny_llama()
+    codec_ids = torch.randint(45334, 46358, (2, 6))
+    prompt_ids = window_prompt(codec_ids)
+    reference = teacher_forcing(model, prompt_ids, codec_ids, logits_processor=block_list())
+    sliced = teacher_forcing(model, prompt_ids, codec_ids, vocab_slice=VocabSlice([(46358, 53526)], 83734))
+    assert torch.equal(sliced, reference)
+
+
+def test_static_decoder_matches_dynamic_cache(tiny_llama):
+    model = tiny_llama()
+    # 3 rows go through the bucket of 4, padded with a copy of the first row
+    codec_ids = torch.randint(45334, 46358, (3, 6))
+    prompt_ids = window_prompt(codec_ids)
+    reference = teacher_forcing(model, prompt_ids, codec_ids, logits_processor=block_list())
+    static = StaticTeacherForcing(model, max_cache_len=prompt_ids.shape[1] + 6 * 8, blocked_ranges=BLOCKED_RANGES,
+                                  batch_buckets=(1, 4), compile=False)
+    # the second call reuses (and has to reset) the static cache of the first
+    for _ in range(2):
+        assert torch.equal(static(prompt_ids, codec_ids), reference)
+
+
+def test_static_decoder_matches_dynamic_cache_with_padding(tiny_llama):
+    model = tiny_llama()
+    codec_ids = torch.randint(45334, 46358, (2, 6))
+    prompt_ids = window_prompt(codec_ids)
+    # the second row's prompt is two tokens shorter, left-padded
+    prompt_ids[1, :2] = PAD_ID
+    attention_mask = torch.ones_like(prompt_ids)
+    attention_mask[1, :2] = 0
+    reference = teacher_forcing(model, prompt_ids, codec_ids, logits_processor=block_list(), attention_mask=attention_mask)
+    static = StaticTeacherForcing(model, max_cache_len=prompt_ids.shape[1] + 6 * 8, blocked_ranges=BLOCKED_RANGES,
+                                  batch_buckets=(2,), compile=False)
+    assert torch.equal(static(prompt_ids, codec_ids, attention_mask), reference)
+
+
+def scheduler(model, batch_size, window_frames=4):
+    def decode(prompt_ids, codec_ids, attention_mask=None):
+        return teacher_forcing(model, prompt_ids, codec_ids, logits_processor=block_list(), attention_mask=attention_mask)
+    return Stage2Scheduler(decode, batch_size, prefix_ids=PREFIX_IDS, suffix_ids=SUFFIX_IDS, pad_id=PAD_ID,
+                           window_frames=window_frames)
+
+
+def test_scheduler_padding_matches_unbatched_windows(tiny_llama):
+    model = tiny_llama()
+    rng = np.random.RandomState(0)
+    # windows of 4, 3, 4, 1 and 2 frames: batches mix lengths, so shorter prompts are left-padded
+    tracks = {"vocals": rng.randint(45334, 46358, 7), "instrumental": rng.randint(45334, 46358, 5),
+              "short": rng.randint(45334, 46358, 2)}
+    outputs = {}
+    for batch_size in (1, 4):
+        batched = scheduler(model, batch_size)
+        for key, codes in tracks.items():
+            batched.add(key, codes)
+        outputs[batch_size] = batched.run(torch.device("cpu"))
+    for key, codes in tracks.items():
+        assert len(outputs[4][key]) == len(codes) * 8
+        np.testing.assert_array_equal(outputs[4][key], outputs[1][key])
+        # codebook 0 comes back at the start of every frame
+        np.testing.assert_array_equal(outputs[4][key][::8], codes)
+
+
+def test_scheduler_skips_done_windows(tiny_llama):
+    model = tiny_llama()
+    codes = np.random.RandomState(0).randint(45334, 46358, 10)
+    reference = scheduler(model, 2)
+    reference.add("track", codes)
+    windows = []
+    expected = reference.run(torch.device("cpu"), on_batch=windows.extend)
+
+    resumed = scheduler(model, 2)
+    resumed.add("track", codes)
+    done = {"track": {start: ids for key, start, ids in windows if start != 4}}
+    np.testing.assert_array_equal(resumed.run(torch.device("cpu"), done=done)["track"], expected["track"])
+    # only the missing window was decoded
+    assert resumed.num_batches == 1
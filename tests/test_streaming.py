@@ -0,0 +1,61 @@
+import numpy as np
+import torch
+from transformers import LogitsProcessorList
+from logits_processors import BlockTokenRangeProcessor
+from preview import stage1_tracks
+from stage1 import Stage1Engine
+from stage2 import Stage2Scheduler, teacher_forcing
+from streaming import FrameDemuxer, Stage2Worker
+
+CPU = torch.device("cpu")
+SOA, EOA = 32001, 32002
+# only <EOA> and 20 codebook-0 ids can be sampled, so segments end on a sampled <EOA> well before the limit
+STAGE1_BLOCKED_RANGES = [(0, SOA + 1), (EOA + 1, 45334), (45354, 83734)]
+
+
+class IdentityCodec(object):
+    # the streamed windows carry Stage 1 ids as they are, so the offline tracks are not shifted either
+    def ids2npy(self, ids):
+        return np.asarray(ids)[None]
+
+
+def stage2_scheduler(model):
+    block_list = LogitsProcessorList([BlockTokenRangeProcessor(0, 46358), BlockTokenRangeProcessor(53526, 83734)])
+
+    def decode(prompt_ids, codec_ids, attention_mask=None):
+        return teacher_forcing(model, prompt_ids, codec_ids, logits_processor=block_list, attention_mask=attention_mask)
+    return Stage2Scheduler(decode, 2, prefix_ids=[SOA, 32013], suffix_ids=[32017], pad_id=EOA, window_frames=4)
+
+
+def test_streamed_stage2_matches_the_offline_scheduler(tiny_llama):
+    stage1_model, stage2_model = tiny_llama(seed=0), tiny_llama(seed=1)
+    worker = Stage2Worker(stage2_scheduler(stage2_model), CPU)
+    keys = [(f"row{row}_vtrack", f"row{row}_itrack") for row in range(2)]
+    demuxers = [FrameDemuxer(row_keys, worker.add, eos_token_id=EOA, window_frames=4, flush_tokens=5) for row_keys in keys]
+    stage1 = Stage1Engine(stage1_model, eos_token_id=EOA, blocked_ranges=STAGE1_BLOCKED_RANGES, device=CPU, batch_size=2,
+                          generators=[torch.Generator().manual_seed(seed) for seed in (1, 2)],
+                          on_tokens=lambda ids: [demuxer.feed(ids[row]) for row, demuxer in enumerate(demuxers)])
+    generator = torch.Generator().manual_seed(6)
+    torch.manual_seed(0)
+    for i in range(3):
+        # every segment prompt ends with <SOA>, like the real ones
+        prompt_ids = torch.cat([torch.randint(45334, 46358, (1, 12), generator=generator), torch.tensor([[SOA]])], dim=1)
+        new_ids = stage1.generate_segment(prompt_ids, max_new_tokens=60, min_new_tokens=5, guidance_scale=1.5 if i <= 1 else 1.2)
+        for demuxer in demuxers:
+            demuxer.end_segment()
+    for demuxer in demuxers:
+        demuxer.close()
+    streamed = worker.close()
+
+    # the offline path: the Stage 1 .npy tracks of every row, then all their windows through one scheduler
+    offline = stage2_scheduler(stage2_model)
+    for row, (vocal_key, inst_key) in enumerate(keys):
+        vocals, instrumentals = stage1_tracks(stage1.row_output(row)[0].numpy(), IdentityCodec(), SOA, EOA)
+        offline.add(vocal_key, vocals[0])
+        offline.add(inst_key, instrumentals[0])
+    expected = offline.run(CPU)
+    assert sorted(streamed) == sorted(expected)
+    for key in expected:
+        np.testing.assert_array_equal(streamed[key], expected[key])
+    # the demuxer had something to cut: a row that sampled <EOA> first was fed padding after it
+    assert bool((new_ids == stage1.pad_token_id).any())